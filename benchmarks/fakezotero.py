@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# Minimal in-memory implementation of the parts of the Zotero web API
+# used by the importer, for benchmarks. Each request is delayed by a
+# fixed latency to simulate a round trip to the real server. Write
+# tokens, item keys and library versions behave as in the real API,
+# and file uploads go through the full authorize/upload/register
+# sequence. Nothing is validated.
+#
+# Usage: python benchmarks/fakezotero.py [--port PORT] [--latency MS]
+from argparse import ArgumentParser
+import json
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+
+KEY_CHARS = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+
+# Fields of the templates returned for new items
+TEMPLATE_FIELDS = ("title", "abstractNote", "publicationTitle", "bookTitle", "volume",
+    "issue", "pages", "date", "DOI", "ISBN", "ISSN", "url", "extra", "publisher",
+    "place", "edition", "language", "rights", "university", "series", "seriesNumber")
+ATTACHMENT_FIELDS = ("title", "note", "contentType", "charset", "filename", "md5", "mtime")
+
+def new_key():
+    return "".join(random.choice(KEY_CHARS) for i in range(8))
+
+def new_template(item_type, link_mode=None):
+    if item_type == 'note':
+        return dict(itemType='note', note='', tags=[], collections=[], relations={})
+    if item_type == 'attachment':
+        item = dict((f, '') for f in ATTACHMENT_FIELDS)
+        item.update(itemType='attachment', linkMode=link_mode, tags=[], relations={})
+        return item
+    item = dict((f, '') for f in TEMPLATE_FIELDS)
+    item.update(itemType=item_type, creators=[dict(creatorType='author', firstName='', lastName='')],
+        tags=[], collections=[], relations={})
+    return item
+
+# State of the fake library. All access is serialized by lock.
+class Library(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.items = {}
+        self.collections = {}
+        self.deleted = {}
+        self.tokens = set()
+        self.requests = 0
+
+    # Store objects in a write request; returns the write response
+    def write(self, objects, store):
+        with self.lock:
+            self.version += 1
+            status = dict(success={}, successful={}, unchanged={}, failed={})
+            for idx, obj in enumerate(objects):
+                key = obj.get('key') or new_key()
+                existing = store.get(key)
+                if existing is not None and 'version' in obj and obj['version'] < existing['version']:
+                    status['failed'][str(idx)] = dict(key=key, code=412,
+                        message="Object has been modified since specified version")
+                    continue
+                data = dict(existing or {})
+                data.update(obj)
+                data.update(key=key, version=self.version)
+                store[key] = data
+                status['success'][str(idx)] = key
+                status['successful'][str(idx)] = dict(key=key, version=self.version, data=data)
+            return status
+
+LIBRARY = Library()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=None, headers=None):
+        data = b"" if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Last-Modified-Version", str(LIBRARY.version))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length)
+
+    def _start(self):
+        with LIBRARY.lock:
+            LIBRARY.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        url = urlparse(self.path)
+        return url.path.rstrip('/'), dict(parse_qsl(url.query))
+
+    def _page(self, objects, query):
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 25))
+        return list(dict(key=o['key'], version=o['version'], data=o)
+            for o in objects[start:start+limit])
+
+    def do_GET(self):
+        path, query = self._start()
+        since = int(query.get('since', 0))
+        if path == '/items/new':
+            self._send(200, new_template(query.get('itemType'), query.get('linkMode')))
+        elif path.endswith('/collections'):
+            objects = sorted(LIBRARY.collections.values(), key=lambda o: o['key'])
+            if query.get('format') == 'versions':
+                self._send(200, dict((o['key'], o['version']) for o in objects))
+            else:
+                self._send(200, self._page(objects, query), {'Total-Results': str(len(objects))})
+        elif path.endswith('/items') or path.endswith('/items/top'):
+            objects = sorted((o for o in LIBRARY.items.values() if o['version'] > since),
+                key=lambda o: o['key'])
+            if path.endswith('/top'):
+                objects = list(o for o in objects if not o.get('parentItem'))
+            if 'itemKey' in query:
+                keys = set(query['itemKey'].split(','))
+                objects = list(o for o in objects if o['key'] in keys)
+            if query.get('format') == 'versions':
+                self._send(200, dict((o['key'], o['version']) for o in objects))
+            else:
+                self._send(200, self._page(objects, query), {'Total-Results': str(len(objects))})
+        elif path.endswith('/deleted'):
+            self._send(200, dict(items=list(k for k, v in LIBRARY.deleted.items() if v > since),
+                collections=[], searches=[], tags=[], settings=[]))
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        path, query = self._start()
+        body = self._read_body()
+        token = self.headers.get('zotero-write-token')
+        if token is not None:
+            with LIBRARY.lock:
+                if token in LIBRARY.tokens:
+                    return self._send(412)
+                LIBRARY.tokens.add(token)
+        if path.endswith('/collections'):
+            self._send(200, LIBRARY.write(json.loads(body.decode('utf-8')), LIBRARY.collections))
+        elif path.endswith('/items'):
+            self._send(200, LIBRARY.write(json.loads(body.decode('utf-8')), LIBRARY.items))
+        elif path.endswith('/file'):
+            form = dict(parse_qsl(body.decode('utf-8')))
+            if 'upload' in form:
+                # register upload
+                self._send(204)
+            else:
+                # authorize upload
+                self._send(200, dict(url="http://{0}:{1}/upload".format(*self.server.server_address),
+                    params=dict(key=new_key()), uploadKey=new_key()))
+        elif path == '/upload':
+            self._send(201)
+        else:
+            self._send(404)
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+# Start a server in a background thread. Returns the server; its URL
+# is http://127.0.0.1:<server.server_address[1]>.
+def start(port=0, latency=0):
+    Handler.latency = latency
+    server = Server(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = ArgumentParser(description="Run a fake Zotero API server")
+    parser.add_argument("-p", "--port", type=int, default=8085)
+    parser.add_argument("-l", "--latency", type=float, default=50,
+        help="Delay added to each request, in ms")
+    args = parser.parse_args()
+    server = start(args.port, args.latency / 1000.0)
+    print("Listening on http://127.0.0.1:{0}".format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Generate a synthetic Papers2 library for benchmarks. The database
+# contains the tables and columns used by this package, filled with
+# random (but reproducible) publications, authors, keywords,
+# collections and attachments.
+#
+# Usage: python benchmarks/fixture.py FOLDER [--pubs N] [--files]
+from argparse import ArgumentParser
+import os
+import random
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE metadata (ROWID INTEGER PRIMARY KEY, key TEXT, value TEXT);
+CREATE TABLE Publication (ROWID INTEGER PRIMARY KEY, uuid TEXT, citekey TEXT,
+    imported_date REAL, subtype INTEGER, marked_deleted INTEGER, marked_duplicate INTEGER,
+    manuscript INTEGER, title TEXT, attributed_title TEXT, summary TEXT, doi TEXT,
+    publication_date TEXT, bundle TEXT, bundle_string TEXT, version TEXT, number TEXT,
+    language TEXT, document_number TEXT, startpage TEXT, endpage TEXT, place TEXT,
+    publisher TEXT, copyright TEXT, volume TEXT, notes TEXT, times_read INTEGER,
+    label INTEGER, created_at REAL, updated_at REAL, full_author_string TEXT);
+CREATE TABLE Author (ROWID INTEGER PRIMARY KEY, uuid TEXT, prename TEXT, surname TEXT,
+    initial TEXT, fullname TEXT, affiliation TEXT, institutional INTEGER);
+CREATE TABLE OrderedAuthor (ROWID INTEGER PRIMARY KEY, author_id INTEGER, object_id INTEGER,
+    priority INTEGER, type INTEGER);
+CREATE TABLE SyncEvent (ROWID INTEGER PRIMARY KEY, device_id TEXT, source_id TEXT,
+    remote_id TEXT, updated_at REAL);
+CREATE TABLE PDF (ROWID INTEGER PRIMARY KEY, object_id INTEGER, path TEXT, mime_type TEXT,
+    is_primary INTEGER);
+CREATE TABLE Keyword (ROWID INTEGER PRIMARY KEY, name TEXT, type INTEGER);
+CREATE TABLE KeywordItem (ROWID INTEGER PRIMARY KEY, keyword_id INTEGER, object_id INTEGER,
+    type INTEGER);
+CREATE TABLE Collection (ROWID INTEGER PRIMARY KEY, uuid TEXT, name TEXT, type INTEGER,
+    parent TEXT, priority INTEGER);
+CREATE TABLE CollectionItem (ROWID INTEGER PRIMARY KEY, collection INTEGER, object_id INTEGER);
+CREATE TABLE Review (ROWID INTEGER PRIMARY KEY, object_id INTEGER, content TEXT,
+    rating INTEGER, is_mine INTEGER);
+INSERT INTO metadata (key, value) VALUES ('version', '2');
+"""
+
+WORDS = ("gene genome cell protein expression regulation chromatin sequencing rna dna "
+         "analysis model network variant human mouse cancer immune signal pathway").split()
+
+# Publication subtypes, weighted towards journal articles
+SUBTYPES = (0, 10, 400, 400, 400, 400, 415, 420, 700)
+
+# Collections as (uuid, name, type, parent uuid)
+COLLECTIONS = (
+    ("C1", "Top", 0, None),
+    ("C2", "Child", 0, "C1"),
+    ("C3", "Grandchild", 0, "C2"),
+    ("C4", "Other", 5, None),
+    ("C5", "Smart", 3, None)
+)
+
+NUM_KEYWORDS = 30
+
+# Minimal valid PDF, used for attachments when files are created
+PDF = (b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+       b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+       b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+       b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+def words(n):
+    return " ".join(random.choice(WORDS) for i in range(n))
+
+# Create a library with num_pubs publications in folder, and return
+# the path to the database. Every 50th publication is a journal
+# (the bundle of other publications). If files is True, an
+# attachment file is created for each publication.
+def make_library(folder, num_pubs=1000, files=False, seed=1):
+    random.seed(seed)
+    lib = os.path.join(folder, "Library.papers2")
+    if not os.path.isdir(lib):
+        os.makedirs(lib)
+    db = os.path.join(lib, "Database.papersdb")
+    if os.path.exists(db):
+        os.remove(db)
+    if files and not os.path.isdir(os.path.join(folder, "Files")):
+        os.makedirs(os.path.join(folder, "Files"))
+
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+
+    num_authors = max(10, num_pubs // 3)
+    for a in range(1, num_authors + 1):
+        inst = 1 if a % 17 == 0 else 0
+        conn.execute("INSERT INTO Author VALUES (?,?,?,?,?,?,?,?)", (a, "A{0}".format(a),
+            None if inst else "First{0}".format(a),
+            "Inst{0}".format(a) if inst else "Last{0}".format(a),
+            "F", "First{0} Last{0}".format(a), None, inst))
+    for k in range(1, NUM_KEYWORDS + 1):
+        conn.execute("INSERT INTO Keyword VALUES (?,?,?)", (k, "kw{0}".format(k), 0))
+    for i, (uuid, name, kind, parent) in enumerate(COLLECTIONS):
+        conn.execute("INSERT INTO Collection VALUES (?,?,?,?,?,0)", (i + 1, uuid, name, kind, parent))
+
+    for p in range(1, num_pubs + 1):
+        title = words(6).capitalize()
+        subtype = random.choice(SUBTYPES)
+        if p % 50 == 0:
+            title = "Journal of {0}".format(random.choice(WORDS))
+            subtype = -100
+        year = random.randint(1990, 2015)
+        pub_date = "99{0:04d}{1:02d}{2:02d}1200000000222000".format(
+            year, random.randint(0, 12), random.randint(0, 28))
+        bundle = str(50 * random.randint(1, num_pubs // 50)) if num_pubs >= 50 else None
+        conn.execute("INSERT INTO Publication (ROWID, uuid, citekey, imported_date, subtype, "
+            "marked_deleted, marked_duplicate, manuscript, title, summary, doi, publication_date, "
+            "bundle, bundle_string, volume, number, startpage, endpage, notes, times_read, label, "
+            "created_at, updated_at) VALUES (?,?,?,?,?,0,0,0,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (p, "P{0}".format(p), "Key:{0}".format(p), 3e8 + p, subtype, title,
+             "Abstract about {0}".format(words(20)),
+             "10.1000/{0}".format(p) if p % 3 else None, pub_date, bundle,
+             "J. {0}".format(random.choice(WORDS)),
+             str(random.randint(1, 50)), str(random.randint(1, 12)), str(p), str(p + 10),
+             "note {0}".format(p) if p % 7 == 0 else None,
+             random.randint(0, 3), random.randint(0, 7), 3e8 + p, 3e8 + p))
+        for i, a in enumerate(random.sample(range(1, num_authors + 1), random.randint(1, 6))):
+            conn.execute("INSERT INTO OrderedAuthor (author_id, object_id, priority, type) "
+                "VALUES (?,?,?,?)", (a, p, i, 0 if i < 5 else 1))
+        for k in random.sample(range(1, NUM_KEYWORDS + 1), random.randint(0, 4)):
+            conn.execute("INSERT INTO KeywordItem (keyword_id, object_id, type) VALUES (?,?,?)",
+                (k, p, random.choice((0, 99))))
+        if p % 2:
+            conn.execute("INSERT INTO SyncEvent (device_id, source_id, remote_id, updated_at) "
+                "VALUES (?,?,?,?)", ("P{0}".format(p), "gov.nih.nlm.ncbi.pubmed", str(100000 + p), 1.0))
+        conn.execute("INSERT INTO SyncEvent (device_id, source_id, remote_id, updated_at) "
+            "VALUES (?,?,?,?)", ("P{0}".format(p), "com.mekentosj.papers2.user",
+            "http://example.org/{0}".format(p), 2.0))
+        path = "Files/{0}.pdf".format(p)
+        conn.execute("INSERT INTO PDF (object_id, path, mime_type, is_primary) VALUES (?,?,?,1)",
+            (p, path, "application/pdf"))
+        if files:
+            with open(os.path.join(folder, path), "wb") as o:
+                o.write(PDF)
+        conn.execute("INSERT INTO CollectionItem (collection, object_id) VALUES (?,?)",
+            (random.randint(1, len(COLLECTIONS)), p))
+        if p % 5 == 0:
+            conn.execute("INSERT INTO Review (object_id, content, rating, is_mine) VALUES (?,?,?,1)",
+                (p, "Good paper", 4))
+
+    conn.commit()
+    conn.close()
+    return db
+
+def main():
+    parser = ArgumentParser(description="Generate a synthetic Papers2 library")
+    parser.add_argument("folder", help="Papers2 folder to create")
+    parser.add_argument("-n", "--pubs", type=int, default=1000, help="Number of publications")
+    parser.add_argument("--files", action="store_true", default=False,
+        help="Create an attachment file for each publication")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    print(make_library(args.folder, args.pubs, args.files, args.seed))
+
+if __name__ == "__main__":
+    main()
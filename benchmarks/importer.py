@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Compare the upload throughput of ZoteroImporter and
+# ConcurrentZoteroImporter. A synthetic library is exported to a
+# local fake Zotero server that adds a fixed latency to every request,
+# so the results reflect how well each importer overlaps requests
+# rather than the speed of the server.
+#
+# Usage: python benchmarks/importer.py [--pubs N] [--latency MS]
+from argparse import ArgumentParser
+import logging as log
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakezotero
+from fixture import make_library
+from papers2.schema import Papers2
+from papers2.zotero import ZoteroImporter, ConcurrentZoteroImporter
+
+def reset_server():
+    fakezotero.LIBRARY.__init__()
+
+def run(importer_class, papers2, endpoint, num_pubs, **kwargs):
+    reset_server()
+    start = time.time()
+    importer = importer_class("1", "user", "key", papers2, endpoint=endpoint, **kwargs)
+    num_added = 0
+    for pub in papers2.get_publications():
+        if importer.add_pub(pub):
+            num_added += 1
+        if num_added >= num_pubs:
+            break
+    importer.close()
+    elapsed = time.time() - start
+    library = fakezotero.LIBRARY
+    return dict(seconds=elapsed, pubs=num_added, requests=library.requests,
+        objects=len(library.items))
+
+def main():
+    parser = ArgumentParser(description="Benchmark the Zotero importers")
+    parser.add_argument("-n", "--pubs", type=int, default=500,
+        help="Number of publications to upload")
+    parser.add_argument("-l", "--latency", type=float, default=50,
+        help="Latency of each request to the fake server, in ms")
+    parser.add_argument("--max-requests", type=int, default=16,
+        help="Max requests in flight for the concurrent importer")
+    parser.add_argument("--max-batches", type=int, default=4,
+        help="Max batches uploaded at once by the concurrent importer")
+    parser.add_argument("--attachments", choices=("all", "none"), default="all")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+    folder = tempfile.mkdtemp()
+    try:
+        make_library(folder, args.pubs + args.pubs // 49 + 1, files=args.attachments == "all")
+        papers2 = Papers2(folder, cache_folder=os.path.join(folder, "cache"))
+        server = fakezotero.start(latency=args.latency / 1000.0)
+        endpoint = "http://127.0.0.1:{0}".format(server.server_address[1])
+
+        results = []
+        for name, cls, kwargs in (
+                ("sync", ZoteroImporter, {}),
+                ("concurrent", ConcurrentZoteroImporter, dict(
+                    max_requests=args.max_requests, max_batches=args.max_batches))):
+            kwargs.update(upload_attachments=args.attachments)
+            result = run(cls, papers2, endpoint, args.pubs, **kwargs)
+            results.append(result)
+            print("{0:<12} {1:8.2f} s  {2:8.1f} pubs/s  {3:6d} requests  {4:6d} objects".format(
+                name, result['seconds'], result['pubs'] / result['seconds'],
+                result['requests'], result['objects']))
+
+        if results[0]['objects'] != results[1]['objects']:
+            print("WARNING: importers created different numbers of objects")
+        print("speedup: {0:.1f}x".format(results[0]['seconds'] / results[1]['seconds']))
+        papers2.close()
+        server.shutdown()
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    main()
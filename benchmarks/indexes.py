@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Measure the effect of the indexes created by IndexAdvisor on the
+# queries used during export. A snapshot of the database is made (the
+# original is never modified), the plan of each accessor's query is
+# printed, and the time to run it is compared before and after the
+# index was created.
+#
+# Usage: python benchmarks/indexes.py [--pubs N | --folder PAPERS2_FOLDER]
+from argparse import ArgumentParser
+import logging as log
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixture import make_library
+from papers2.indexes import IndexAdvisor, format_reports
+from papers2.schema import Papers2
+
+def main():
+    parser = ArgumentParser(description="Benchmark export queries with and without indexes")
+    parser.add_argument("-n", "--pubs", type=int, default=20000,
+        help="Number of publications in the synthetic library")
+    parser.add_argument("-f", "--folder", default=None,
+        help="Use an existing Papers2 folder rather than a synthetic library")
+    parser.add_argument("-s", "--sample", type=int, default=200,
+        help="Number of publications to run per-publication queries for")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+        help="Print query plans before and after")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = args.folder
+        if folder is None:
+            folder = tmp
+            make_library(folder, args.pubs)
+        papers2 = Papers2(folder, cache_folder=os.path.join(tmp, "cache"), snapshot=True)
+        advisor = IndexAdvisor(papers2, args.sample)
+        reports = advisor.optimize()
+        advisor.close()
+        papers2.close()
+
+        if args.verbose:
+            for r in reports:
+                print(r.accessor)
+                print("  before: {0}".format("; ".join(r.plan_before)))
+                print("  after:  {0}".format("; ".join(r.plan_after)))
+        print(format_reports(reports))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Measure what a snapshot costs and what it saves while Papers2 is
+# writing to its database. A writer thread repeatedly updates
+# publications, holding an exclusive lock for a few milliseconds each
+# time (as Papers2 does when it saves), while the queries made by an
+# export (each publication's journal, keywords, collections, reviews
+# and attachments) are run against the live database, a copy, and a
+# single read transaction. For each mode, the time taken to make the
+# snapshot, the total time, and the number of statements that waited
+# for a lock and the time they waited are printed. The database is put in WAL mode
+# for the transaction mode, in which readers never wait for writers.
+#
+# Usage: python benchmarks/snapshot.py [--pubs N] [--hold MS] [--interval MS]
+from argparse import ArgumentParser
+import logging as log
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixture import make_library
+from papers2.schema import Papers2, KeywordType
+from papers2.snapshot import COPY, TRANSACTION
+
+# Update a publication every interval seconds, holding an exclusive
+# lock for hold seconds, until stop is set
+def write(db, hold, interval, stop):
+    conn = sqlite3.connect(db, isolation_level=None, timeout=60)
+    rowid = 0
+    while not stop.is_set():
+        rowid += 1
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.execute("UPDATE Publication SET times_read = times_read + 1 WHERE ROWID = ?",
+            (rowid % 1000 + 1,))
+        time.sleep(hold)
+        conn.execute("COMMIT")
+        time.sleep(interval)
+    conn.close()
+
+# The per-publication queries of an export
+def read(papers2):
+    for pub in papers2.get_publications():
+        papers2.get_bundle(pub)
+        papers2.get_keywords(pub, KeywordType.USER).all()
+        papers2.get_collections(pub)
+        papers2.get_reviews(pub)
+        list(papers2.get_attachments(pub))
+
+def run(folder, cache, mode, hold, interval):
+    stop = threading.Event()
+    db = os.path.join(folder, "Library.papers2", "Database.papersdb")
+    writer = threading.Thread(target=write, args=(db, hold, interval, stop))
+    writer.start()
+    try:
+        start = time.time()
+        papers2 = Papers2(folder, cache_folder=cache, snapshot=mode)
+        read(papers2)
+        papers2.close()
+        elapsed = time.time() - start
+    finally:
+        stop.set()
+        writer.join()
+    stats = papers2.lock_stats
+    return (papers2.snapshot or "live", papers2.snapshot_seconds, elapsed, stats.statements,
+        stats.waits, stats.seconds)
+
+def main():
+    parser = ArgumentParser(description="Benchmark reads with and without a snapshot")
+    parser.add_argument("-n", "--pubs", type=int, default=2000,
+        help="Number of publications in the synthetic library")
+    parser.add_argument("--hold", type=float, default=20,
+        help="Milliseconds the writer holds its lock for each update")
+    parser.add_argument("--interval", type=float, default=50,
+        help="Milliseconds between updates")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.ERROR)
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = os.path.join(tmp, "library")
+        make_library(folder, args.pubs)
+        print("{0:<18} {1:>12} {2:>10} {3:>11} {4:>7} {5:>11}".format("mode", "snapshot (s)",
+            "total (s)", "statements", "waits", "waited (s)"))
+        results = []
+        for mode in (None, COPY):
+            results.append(run(folder, os.path.join(tmp, "cache"), mode,
+                args.hold / 1000.0, args.interval / 1000.0))
+        conn = sqlite3.connect(os.path.join(folder, "Library.papers2", "Database.papersdb"))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+        for mode in (None, TRANSACTION):
+            result = run(folder, os.path.join(tmp, "cache"), mode,
+                args.hold / 1000.0, args.interval / 1000.0)
+            results.append(("{0} (wal)".format(result[0]),) + result[1:])
+        for r in results:
+            print("{0:<18} {1:12.3f} {2:10.2f} {3:11d} {4:7d} {5:11.2f}".format(*r))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
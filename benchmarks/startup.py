@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Measure the startup time of the command line scripts, and check
+# that importing them does not load any of the heavy optional
+# dependencies (which are only imported when they are first used).
+# Exits with a non-zero status if a script is slower than the
+# budget or a heavy module is imported at startup.
+#
+# Usage: python benchmarks/startup.py [--repeat N] [--budget MS]
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SCRIPTS = ("papers2zotero.py", "papers2search.py")
+
+# Modules that must not be imported just to start a script
+HEAVY_MODULES = ("sqlalchemy", "pyzotero", "requests", "numpy", "pypdf", "PyPDF2")
+
+CHECK_IMPORTS = """
+import runpy, sys
+sys.argv = [sys.argv[0], '--help']
+try:
+    runpy.run_path({0!r}, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(m for m in {1!r} if m in sys.modules))
+"""
+
+def get_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (ROOT, env.get('PYTHONPATH')) if p)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+def run(args, env):
+    with open(os.devnull, "w") as devnull:
+        p = subprocess.Popen(args, stdout=devnull, stderr=subprocess.PIPE, env=env)
+        err = p.communicate()[1]
+    return err.decode('utf-8', 'replace')
+
+# Returns the best wall time, in ms, of running the script with --help
+def time_script(script, repeat, env):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        run((sys.executable, script, "--help"), env)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def get_heavy_imports(script, env):
+    err = run((sys.executable, "-c", CHECK_IMPORTS.format(script, HEAVY_MODULES)), env)
+    return err.strip().split()
+
+# Returns the (cumulative us, module) pairs of the slowest imports,
+# or None if the interpreter does not support -X importtime (3.7+).
+def get_import_times(script, env, top=10):
+    if sys.version_info < (3, 7):
+        return None
+    err = run((sys.executable, "-X", "importtime", script, "--help"), env)
+    times = []
+    for line in err.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            times.append((int(fields[1]), fields[2].strip()))
+        except (IndexError, ValueError):
+            continue
+    # only report top-level modules
+    times = list(t for t in times if "." not in t[1])
+    return sorted(times, reverse=True)[:top]
+
+def main():
+    parser = ArgumentParser(description="Benchmark command line startup time")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+        help="Number of times to run each script; the best time is reported")
+    parser.add_argument("-b", "--budget", type=float, default=300,
+        help="Max startup time, in ms")
+    args = parser.parse_args()
+
+    env = get_env()
+    failed = False
+    for name in SCRIPTS:
+        script = os.path.join(ROOT, "bin", name)
+        ms = time_script(script, args.repeat, env)
+        heavy = get_heavy_imports(script, env)
+        ok = ms <= args.budget and len(heavy) == 0
+        failed = failed or not ok
+        print("{0:<20} {1:8.1f} ms  {2}".format(name, ms, "ok" if ok else "FAIL"))
+        if len(heavy) > 0:
+            print("  heavy modules imported at startup: {0}".format(", ".join(heavy)))
+        times = get_import_times(script, env)
+        if times is not None:
+            for us, module in times:
+                print("  {0:8.1f} ms  {1}".format(us / 1000.0, module))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
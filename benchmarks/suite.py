@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# Benchmark the hot paths of papers2.schema, papers2.zotero and
+# papers2.util over a synthetic library, and track regressions. "run"
+# times each benchmark several times and prints the best and median
+# time per operation (e.g. per publication, or per checkpoint commit);
+# the results can be saved as a JSON baseline. "compare" compares a
+# new result file with a baseline (or run --baseline compares the new
+# run directly), and exits with a non-zero status if any benchmark is
+# slower than the baseline by more than the threshold. Only results
+# measured on the same machine, with the same --pubs, are comparable.
+#
+# Usage: python benchmarks/suite.py run [--pubs N] [--repeat N] [--output FILE]
+#            [--baseline FILE] [--threshold PERCENT] [BENCHMARK ...]
+#        python benchmarks/suite.py compare BASELINE RESULTS [--threshold PERCENT]
+#        python benchmarks/suite.py list
+from argparse import ArgumentParser
+from collections import OrderedDict
+import datetime
+import gc
+import json
+import logging as log
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakezotero
+from fixture import make_library
+from papers2.schema import Papers2, IDSource, KeywordType
+from papers2.util import Checkpoint, JSONWriter
+from papers2.zotero import Extractor, ZoteroImporter
+
+# Version of the results file format
+RESULTS_VERSION = 1
+
+# Checkpoint commits timed by each run of the checkpoint benchmarks
+CHECKPOINT_COMMITS = 20
+
+# Percent by which a benchmark must be slower than its baseline to be
+# reported as a regression. Timings vary by a few percent between
+# runs, and much more for benchmarks that write files.
+THRESHOLD = 25.0
+
+# The library and the objects shared by the benchmarks. Objects that
+# must be closed once the benchmarks are done are added to cleanup.
+class Context(object):
+    def __init__(self, folder, cache_folder):
+        self.folder = folder
+        self.cache_folder = cache_folder
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        self.cleanup = []
+
+    def new_papers2(self):
+        papers2 = Papers2(self.folder, cache_folder=self.cache_folder)
+        self.cleanup.append(papers2.close)
+        return papers2
+
+    def close(self):
+        for fn in reversed(self.cleanup):
+            fn()
+        self.cleanup = []
+
+# Each benchmark is set up by a function that takes the Context and
+# returns a function that does the timed work and returns the number
+# of operations it did. BENCHMARKS maps the name of each benchmark to
+# (setup function, unit of operations).
+BENCHMARKS = OrderedDict()
+
+def benchmark(name, unit):
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+    return register
+
+# Opening the database: creating the engine, reflecting the schema
+# and creating the indexes in the cache folder
+@benchmark("papers2_init", "open")
+def setup_init(context):
+    def run():
+        Papers2(context.folder, cache_folder=context.cache_folder).close()
+        return 1
+    return run
+
+@benchmark("get_publications", "publication")
+def setup_get_publications(context):
+    papers2 = context.new_papers2()
+    def run():
+        # start from an empty identity map, as an export does
+        papers2.get_session().expunge_all()
+        return sum(1 for pub in papers2.get_publications())
+    return run
+
+def setup_accessor(accessor):
+    def setup(context):
+        papers2 = context.new_papers2()
+        pubs = papers2.get_publications().all()
+        def run():
+            for pub in pubs:
+                list(accessor(papers2, pub))
+            return len(pubs)
+        return run
+    return setup
+
+for name, accessor in (
+        ("get_pub_authors",     lambda papers2, pub: papers2.get_pub_authors(pub)),
+        ("get_identifiers",     lambda papers2, pub: papers2.get_identifiers(pub, IDSource.PUBMED)),
+        ("get_keywords",        lambda papers2, pub: papers2.get_keywords(pub, KeywordType.USER)),
+        ("get_attachments",     lambda papers2, pub: papers2.get_attachments(pub))):
+    benchmark(name, "publication")(setup_accessor(accessor))
+
+# Extracting each publication and adding it to a batch, with the
+# batches written to /dev/null as in a dry run. Item templates are
+# fetched once from a local fake server, and then cached by pyzotero.
+@benchmark("add_pub", "publication")
+def setup_add_pub(context):
+    papers2 = context.new_papers2()
+    pubs = papers2.get_publications().all()
+    server = fakezotero.start()
+    context.cleanup.append(server.shutdown)
+    importer = ZoteroImporter("1", "user", "key", papers2, dryrun=os.devnull,
+        endpoint="http://127.0.0.1:{0}".format(server.server_address[1]))
+    context.cleanup.append(importer.close)
+    def run():
+        for pub in pubs:
+            importer.add_pub(pub)
+        importer.flush()
+        return len(pubs)
+    return run
+
+def setup_checkpoint(num_ids):
+    def setup(context):
+        checkpoint = Checkpoint(os.path.join(context.cache_folder, "checkpoint.pickle"))
+        checkpoint.ids = set(range(num_ids))
+        def run():
+            for i in range(CHECKPOINT_COMMITS):
+                checkpoint.add(num_ids + i)
+                checkpoint.commit()
+            return CHECKPOINT_COMMITS
+        return run
+    return setup
+
+for num_ids in (10000, 100000):
+    benchmark("checkpoint_commit_{0}k".format(num_ids // 1000), "commit")(
+        setup_checkpoint(num_ids))
+
+# Writing items (as extracted from every publication) to /dev/null
+@benchmark("json_writer", "item")
+def setup_json_writer(context):
+    papers2 = context.new_papers2()
+    extractor = Extractor(papers2, fakezotero.new_template)
+    items = []
+    for pub in papers2.get_publications():
+        extraction = extractor.extract(pub)
+        items.append((extraction.get_item({}), list(extraction.get_attachments())))
+    def run():
+        writer = JSONWriter(os.devnull)
+        for item, attachments in items:
+            writer.write(item, attachments)
+        writer.close()
+        return len(items)
+    return run
+
+# Time fn repeat times. Returns (ops, seconds of each run).
+def measure(fn, repeat):
+    ops = None
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        ops = fn()
+        times.append(time.time() - start)
+    return ops, times
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+def get_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = subprocess.check_output(("git", "rev-parse", "--short", "HEAD"), cwd=ROOT,
+                stderr=devnull)
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run the named benchmarks (all, if names is empty) over a library
+# of num_pubs publications, and return the results
+def run_benchmarks(names, num_pubs, repeat):
+    tmp = tempfile.mkdtemp()
+    results = OrderedDict()
+    try:
+        folder = os.path.join(tmp, "library")
+        make_library(folder, num_pubs)
+        for name, (setup, unit) in BENCHMARKS.items():
+            if len(names) > 0 and name not in names:
+                continue
+            context = Context(folder, os.path.join(tmp, "cache"))
+            try:
+                ops, times = measure(setup(context), repeat)
+            finally:
+                context.close()
+            per_op = list(t * 1e6 / ops for t in times)
+            results[name] = OrderedDict((("unit", unit), ("ops", ops),
+                ("best", min(per_op)), ("median", median(per_op)), ("times", per_op)))
+            print("{0:<24} {1:>8} {2:>12} {3:>14.1f} {4:>14.1f}".format(name, ops, unit,
+                min(per_op), median(per_op)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp)
+    return OrderedDict((
+        ("version", RESULTS_VERSION),
+        ("date", datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+        ("commit", get_commit()),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("pubs", num_pubs),
+        ("repeat", repeat),
+        ("benchmarks", results)))
+
+def load_results(filename):
+    with open(filename) as i:
+        results = json.load(i, object_pairs_hook=OrderedDict)
+    if results.get("version") != RESULTS_VERSION:
+        raise ValueError("{0} is not a version {1} results file".format(filename,
+            RESULTS_VERSION))
+    return results
+
+def describe(results):
+    return "{0} ({1}, python {2}, {3} pubs)".format(results.get("commit") or "unknown commit",
+        results["date"], results["python"], results["pubs"])
+
+# Print the change of each benchmark from the baseline, comparing the
+# best times. Returns the names of the benchmarks that are slower by
+# more than threshold percent. Benchmarks of the baseline that are
+# missing from the results are listed, unless only some were run.
+def compare(baseline, results, threshold=THRESHOLD, partial=False):
+    print("baseline: {0}".format(describe(baseline)))
+    print("results:  {0}".format(describe(results)))
+    if baseline["pubs"] != results["pubs"] or baseline["python"] != results["python"]:
+        log.warning("The results were not measured with the same library size and Python "
+            "version as the baseline, so they are not comparable")
+    print("{0:<24} {1:>14} {2:>14} {3:>9}".format("benchmark", "baseline (us)", "result (us)",
+        "change"))
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print("{0:<24} {1:>14} {2:14.1f} {3:>9}".format(name, "-", result["best"], "new"))
+            continue
+        change = (result["best"] / base["best"] - 1) * 100 if base["best"] > 0 else 0.0
+        status = ""
+        if change > threshold:
+            status = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            status = "  faster"
+        print("{0:<24} {1:14.1f} {2:14.1f} {3:+8.1f}%{4}".format(name, base["best"],
+            result["best"], change, status))
+    for name in baseline["benchmarks"]:
+        if not partial and name not in results["benchmarks"]:
+            print("{0:<24} {1:14.1f} {2:>14} {3:>9}".format(name,
+                baseline["benchmarks"][name]["best"], "-", "missing"))
+    if len(regressions) > 0:
+        print("{0} of {1} benchmarks are more than {2:g}% slower than the baseline: {3}".format(
+            len(regressions), len(results["benchmarks"]), threshold, ", ".join(regressions)))
+    return regressions
+
+def main():
+    parser = ArgumentParser(description="Benchmark suite with regression tracking")
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("names", nargs="*", metavar="BENCHMARK",
+        help="Benchmarks to run (default: all)")
+    run_parser.add_argument("-n", "--pubs", type=int, default=2000,
+        help="Number of publications in the synthetic library")
+    run_parser.add_argument("-r", "--repeat", type=int, default=5,
+        help="Number of times each benchmark is run")
+    run_parser.add_argument("-o", "--output", default=None,
+        help="Save the results to this JSON file")
+    run_parser.add_argument("-b", "--baseline", default=None,
+        help="Compare the results with this JSON file")
+    run_parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD,
+        help="Percent by which a benchmark must be slower than the baseline to fail")
+
+    compare_parser = commands.add_parser("compare", help="Compare results with a baseline")
+    compare_parser.add_argument("baseline", help="JSON file of the baseline results")
+    compare_parser.add_argument("results", help="JSON file of the results to compare")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD,
+        help="Percent by which a benchmark must be slower than the baseline to fail")
+
+    commands.add_parser("list", help="List the benchmarks")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+    if args.command == "list":
+        for name, (setup, unit) in BENCHMARKS.items():
+            print("{0:<24} per {1}".format(name, unit))
+        return 0
+
+    if args.command == "compare":
+        baseline = load_results(args.baseline)
+        results = load_results(args.results)
+        partial = False
+
+    else:
+        unknown = list(n for n in args.names if n not in BENCHMARKS)
+        if len(unknown) > 0:
+            parser.error("unknown benchmark(s): {0}".format(", ".join(unknown)))
+        baseline = load_results(args.baseline) if args.baseline is not None else None
+        print("{0:<24} {1:>8} {2:>12} {3:>14} {4:>14}".format("benchmark", "ops", "unit",
+            "best (us/op)", "median (us/op)"))
+        results = run_benchmarks(args.names, args.pubs, args.repeat)
+        if args.output is not None:
+            with open(args.output, "w") as o:
+                json.dump(results, o, indent=2, separators=(',', ': '))
+                o.write("\n")
+        if baseline is None:
+            return 0
+        print("")
+        partial = len(args.names) > 0
+
+    return 1 if len(compare(baseline, results, args.threshold, partial)) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
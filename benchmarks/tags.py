@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Compare the cost of building the tags of each publication with
+# per-publication keyword queries (as ExtractKeywords used to) and with
+# a TagIndex. For each method, the time and the number of objects
+# allocated per publication are printed. Allocations are measured with
+# tracemalloc if it is available (memory blocks still allocated, and
+# peak bytes); otherwise, the number of objects tracked by the garbage
+# collector is counted, with the tags of every publication kept alive.
+#
+# Usage: python benchmarks/tags.py [--pubs N | --folder PAPERS2_FOLDER]
+from argparse import ArgumentParser
+import gc
+import logging as log
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixture import make_library
+from papers2.schema import Papers2, KeywordType, Label
+from papers2.zotero import TagIndex
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+KEYWORD_TYPES = ('user', 'auto', 'label')
+LABEL_MAP = dict((l.name, "Label{0}".format(l.name)) for l in Label.__values__)
+LABEL_MAP[Label.NONE.name] = None
+
+def query_tags(papers2, pubs):
+    result = []
+    for pub in pubs:
+        tags = []
+        tags.extend(k.name for k in papers2.get_keywords(pub, KeywordType.USER))
+        tags.extend(k.name for k in papers2.get_keywords(pub, KeywordType.AUTO))
+        label = LABEL_MAP.get(papers2.get_label_name(pub), None)
+        if label is not None:
+            tags.append(label)
+        result.append(tags)
+    return result
+
+def index_tags(papers2, pubs):
+    index = TagIndex(papers2, KEYWORD_TYPES, LABEL_MAP)
+    return list(index.get_tags(pub) for pub in pubs)
+
+# Run fn, and return (seconds, allocations, peak bytes). Peak bytes
+# is None without tracemalloc.
+def measure(fn, *args):
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        blocks = sum(s.count for s in snapshot.statistics('filename'))
+        return (elapsed, blocks, peak)
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        objects = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    del result
+    return (elapsed, objects, None)
+
+def main():
+    parser = ArgumentParser(description="Benchmark building the tags of publications")
+    parser.add_argument("-n", "--pubs", type=int, default=5000,
+        help="Number of publications in the synthetic library")
+    parser.add_argument("-f", "--folder", default=None,
+        help="Use an existing Papers2 folder rather than a synthetic library")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.WARNING)
+    folder = args.folder
+    tmp = None
+    if folder is None:
+        tmp = folder = tempfile.mkdtemp()
+        make_library(folder, args.pubs)
+    try:
+        print("{0:<10} {1:>10} {2:>12} {3:>14} {4:>12}".format("method", "seconds", "us/pub",
+            "objects/pub" if tracemalloc is None else "blocks/pub", "peak KB"))
+        for name, fn in (("queries", query_tags), ("index", index_tags)):
+            # a fresh session for each method, so that neither
+            # benefits from objects loaded by the other
+            papers2 = Papers2(folder)
+            pubs = papers2.get_publications().all()
+            elapsed, allocations, peak = measure(fn, papers2, pubs)
+            print("{0:<10} {1:10.3f} {2:12.1f} {3:14.1f} {4:>12}".format(name, elapsed,
+                elapsed * 1e6 / len(pubs), float(allocations) / len(pubs),
+                "-" if peak is None else "{0:.0f}".format(peak / 1024.0)))
+            papers2.close()
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,8 @@ import re, os, time, sys, glob, itertools, sqlite3
 from optparse import OptionParser
 from ConfigParser import ConfigParser, NoOptionError
 
+from papers2 import dates
+
 ## You can overide these values in ~/.papersc
 DEFAULTS = {
   'dbpath' : "~/Documents/Papers2/Library.papers2/Database.papersdb",
@@ -41,12 +43,6 @@ def dict_factory(cursor, row):
 class Papers(object):
     """Interface to Papers2.app"""
     
-    _xlate_month = {
-        '01' : 'Jan', '02' : 'Feb', '03' : 'Mar', '04' : 'Apr',
-        '05' : 'May', '06' : 'Jun', '07' : 'Jul', '08' : 'Aug',
-        '09' : 'Sep', '10' : 'Oct', '11' : 'Nov', '12' : 'Dec'
-    }
-    
     def __init__(self, dbpath):
         self.dbpath = dbpath
         self.dbconn = sqlite3.connect(dbpath)
@@ -59,22 +55,17 @@ class Papers(object):
             raise ValueError("Invalid Papers database")
         self.dbconn.row_factory = dict_factory
     
-    def parse_publication_date(self, pub_date, translate_month=True, month=(6,7),
-                               year=(2,5)):
+    def parse_publication_date(self, pub_date, translate_month=True):
         """99200406011200000000222000 == Jun 2004
-        returns (month, year) as strings
+        returns dict with 'month' and 'year' strings, omitting unknown parts
         """
-        try:
-            cmonth = pub_date[month[0]:month[1]+1]
-            if translate_month:
-                cmonth = Papers._xlate_month[cmonth]
-        except:
-            cmonth = ''
-        try:
-            cyear = pub_date[year[0]:year[1]+1]
-        except:
-            cyear = ''
-        return {'month' : cmonth, 'year' : cyear}
+        return self._format_publication_date(dates.decode(pub_date), translate_month)
+    
+    def _format_publication_date(self, date, translate_month=True):
+        fields = dates.to_bibtex(date)
+        if not translate_month and 'month' in fields:
+            fields['month'] = "%02d" % date.month
+        return fields
     
     def query_papers_by_citekey(self, citekeys, n=100):
         """Returns summary information for each paper matched to citekey(s).
@@ -109,8 +100,11 @@ class Papers(object):
             cites = ','.join(cites)
             citekeys = citekeys[take:]
             c.execute(query % cites)
-            for row in c:
-                date = self.parse_publication_date(row['publication_date'])
+            rows = c.fetchall()
+            ## decode the whole chunk of dates in one pass
+            pub_dates = dates.decode_many(row['publication_date'] for row in rows)
+            for row, pub_date in zip(rows, pub_dates):
+                date = self._format_publication_date(pub_date)
                 citekey = row['citekey']
                 entry = {
                   'title' : row['attributed_title'],
@@ -118,10 +112,7 @@ class Papers(object):
                   'journal' : row['bundle_string'],
                   'citekey' : citekey
                 }            
-                if date['month'] is not None:
-                    entry['month'] = date['month']
-                if date['year'] is not None:
-                    entry['year'] = date['year']
+                entry.update(date)
                 if row['number'] is not None:
                     entry['number'] = row['number']
                 if row['volume'] is not None:
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# Check the attachment files of a Papers2 library, and print the
+# attachments whose files are missing, empty, or do not match their
+# MIME type, as tab-delimited rows: publication ID, problem, MIME type
+# in Papers2, MIME type of the file's contents, path.
+import logging as log
+
+from papers2.attachments import AttachmentIndex
+from papers2.schema import Papers2
+from papers2.stats import STAT_THREADS
+from papers2.util import parse_with_config
+
+def add_arguments(parser):
+    parser.add_argument("-f", "--papers2-folder", default="~/Papers2", help="Path to Papers2 folder")
+    parser.add_argument("--threads", type=int, default=STAT_THREADS,
+        help="Number of threads used to check attachment files")
+    parser.add_argument("--log-level", metavar="LEVEL", default="INFO",
+        choices=log._levelNames.keys(), help="Logger level")
+
+def main():
+    args = parse_with_config(add_arguments, ('Papers2',))
+
+    log.basicConfig(level=log._levelNames[args.log_level])
+
+    p = Papers2(args.papers2_folder)
+    index = AttachmentIndex(p, threads=args.threads)
+    index.update()
+    problems = index.get_problems()
+    index.close()
+    p.close()
+
+    for object_id, mime_type, status in sorted(problems):
+        print(u"{0}\t{1}\t{2}\t{3}\t{4}".format(object_id, status.problem, mime_type or "",
+            status.mime_type or "", status.path).encode("utf-8"))
+
+if __name__ == "__main__":
+    main()
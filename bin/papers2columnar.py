@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Export the tables of a Papers2 database to Parquet (or Arrow) files
+# for analysis with pandas, DuckDB, etc.
+import logging as log
+import sys
+
+from papers2.columnar import ColumnarExporter, FORMATS, TABLE_NAMES
+from papers2.schema import Papers2
+from papers2.util import parse_with_config
+
+def add_arguments(parser):
+    parser.add_argument("-f", "--papers2-folder", default="~/Papers2", help="Path to Papers2 folder")
+    parser.add_argument("-o", "--output-folder", default="papers2-columnar",
+        help="Folder where the files are written (one per table)")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), default="parquet",
+        help="Output format: Parquet files, or Arrow IPC files (which can be memory-mapped)")
+    parser.add_argument("--tables", default=None,
+        help="Comma-delimited list of tables to export ({0}). Defaults to all "\
+             "tables.".format(", ".join(TABLE_NAMES)))
+    parser.add_argument("--chunk-size", type=int, default=10000,
+        help="Number of rows to read from the database at a time")
+    parser.add_argument("--log-level", metavar="LEVEL", default="INFO",
+        choices=log._levelNames.keys(), help="Logger level")
+
+def main():
+    args = parse_with_config(add_arguments, ('Papers2',))
+
+    log.basicConfig(level=log._levelNames[args.log_level])
+
+    tables = None
+    if args.tables is not None:
+        tables = args.tables.split(",")
+        unknown = set(tables) - set(TABLE_NAMES)
+        if len(unknown) > 0:
+            sys.exit("Unknown tables: {0}".format(", ".join(sorted(unknown))))
+
+    p = Papers2(args.papers2_folder)
+    exporter = ColumnarExporter(p, args.format, args.chunk_size)
+    stats = exporter.export(args.output_folder, tables)
+    p.close()
+
+    for s in stats:
+        print("{0}\t{1}\t{2}".format(s.path, s.rows, s.bytes))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Search the publications in a Papers2 database.
+import logging as log
+import time
+
+from papers2.schema import Papers2
+from papers2.fulltext import FullTextIndex
+from papers2.search import SearchIndex
+from papers2.util import parse_with_config
+
+def add_arguments(parser):
+    parser.add_argument("-f", "--papers2-folder", default="~/Papers2", help="Path to Papers2 folder")
+    parser.add_argument("--cache-folder", default="~/.papers2",
+        help="Folder where the search index is stored")
+    parser.add_argument("-n", "--limit", type=int, default=20,
+        help="Max number of results to return")
+    parser.add_argument("--rebuild", action="store_true", default=False,
+        help="Rebuild the search index from scratch")
+    parser.add_argument("--no-update", action="store_true", default=False,
+        help="Search the existing index without first updating it")
+    parser.add_argument("--pdfs", action="store_true", default=False,
+        help="Search the text of attached PDFs rather than publication metadata")
+    parser.add_argument("--processes", type=int, default=None,
+        help="Number of processes to use for extracting text from PDFs "\
+             "(defaults to the number of CPUs)")
+    parser.add_argument("--log-level", metavar="LEVEL", default="WARNING",
+        choices=log._levelNames.keys(), help="Logger level")
+    parser.add_argument("query", nargs="*",
+        help="Search terms. The full SQLite FTS5 query syntax is supported, "\
+             "e.g. 'title:chromatin AND authors:smith'.")
+
+def main():
+    args = parse_with_config(add_arguments, ('Papers2',))
+
+    log.basicConfig(level=log._levelNames[args.log_level])
+
+    p = Papers2(args.papers2_folder, args.cache_folder)
+    if args.pdfs:
+        index = FullTextIndex(p)
+        if args.rebuild:
+            index.rebuild(args.processes)
+        elif not args.no_update:
+            index.update(args.processes)
+    else:
+        index = SearchIndex(p)
+        if args.rebuild:
+            index.rebuild()
+        elif not args.no_update:
+            index.update()
+
+    if len(args.query) > 0:
+        start = time.time()
+        hits = index.search(" ".join(args.query), args.limit)
+        log.info("Found {0} results in {1:.1f} ms".format(len(hits), 1000 * (time.time() - start)))
+        for hit in hits:
+            print(u"{0}\t{1}".format(hit.id, hit.path if args.pdfs else hit.title).encode('utf-8'))
+
+    index.close()
+    p.close()
+
+if __name__ == "__main__":
+    main()
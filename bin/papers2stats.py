@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# Print summary statistics of a Papers2 library as JSON.
+import json
+import logging as log
+import sys
+
+from papers2.schema import Papers2
+from papers2.stats import LibraryStats, STAT_THREADS
+from papers2.util import parse_with_config
+
+def add_arguments(parser):
+    parser.add_argument("-f", "--papers2-folder", default="~/Papers2", help="Path to Papers2 folder")
+    parser.add_argument("-o", "--output", default=None,
+        help="File to write the statistics to (defaults to stdout)")
+    parser.add_argument("--top-keywords", type=int, default=50,
+        help="Number of most frequently assigned keywords of each type to list")
+    parser.add_argument("--no-files", action="store_true", default=False,
+        help="Do not check attachment files (their sizes and whether they exist)")
+    parser.add_argument("--threads", type=int, default=STAT_THREADS,
+        help="Number of threads used to check attachment files")
+    parser.add_argument("--log-level", metavar="LEVEL", default="WARNING",
+        choices=log._levelNames.keys(), help="Logger level")
+
+def main():
+    args = parse_with_config(add_arguments, ('Papers2',))
+
+    log.basicConfig(level=log._levelNames[args.log_level])
+
+    p = Papers2(args.papers2_folder)
+    stats = LibraryStats(p, args.top_keywords, args.threads).compute(files=not args.no_files)
+    p.close()
+
+    if args.output is None:
+        json.dump(stats, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as o:
+            json.dump(stats, o, indent=2)
+
+if __name__ == "__main__":
+    main()
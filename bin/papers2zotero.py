@@ -1,13 +1,56 @@
 #!/usr/bin/env python
 # Export publications from a Papers2 database to
 # a Zotero account.
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from datetime import datetime, timedelta
 import logging as log
+import os
 import sys
 
+from papers2 import dates
+from papers2.attachments import AttachmentIndex
+from papers2.bibtex import BibTeXWriter
+from papers2.dedup import DuplicateFinder
+from papers2.fanout import FanOut, FileTarget, BibTeXTarget
+from papers2.indexes import IndexAdvisor, format_reports
+from papers2.progress import Progress, PROGRESS_INTERVAL
 from papers2.schema import Papers2, Label
-from papers2.zotero import ZoteroImporter
-from papers2.util import Checkpoint, parse_with_config
+from papers2.snapshot import COPY, SNAPSHOT_MODES
+from papers2.zotero import ZoteroImporter, ConcurrentZoteroImporter
+from papers2.util import Checkpoint, Counters, ItemVersions, Journal, JSONWriter, RetryQueue, \
+    RETRY_ATTEMPTS, RETRY_BACKOFF, parse_with_config
+from papers2.watch import LibraryWatcher, POLL_INTERVAL
+
+# Argument type for publication dates (YYYY, YYYY-MM or YYYY-MM-DD)
+def pub_date(value):
+    try:
+        dates.to_bound(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid date: {0}".format(value))
+    return value
+
+# Argument type for dates (YYYY-MM-DD)
+def iso_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ArgumentTypeError("invalid date: {0}".format(value))
+
+# Argument type for additional export targets (TYPE:ID)
+TARGET_TYPES = ("user", "group", "json", "bibtex")
+def target(value):
+    target_type, sep, target_id = value.partition(":")
+    if target_type not in TARGET_TYPES or len(target_id) == 0:
+        raise ArgumentTypeError("invalid target: {0}; expected one of {1} followed by "\
+            "':' and a library ID or file name".format(value, ", ".join(TARGET_TYPES)))
+    return (target_type, target_id)
+
+# Insert a suffix into a file name, before its extension
+def target_file(filename, suffix):
+    if filename is None or suffix is None:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return "{0}-{1}{2}".format(root, suffix, ext)
 
 def add_arguments(parser):
     parser.add_argument("-a", "--api-key", help="Zotero API key")
@@ -25,21 +68,131 @@ def add_arguments(parser):
         help="Comma-delimited list of database IDs of publications to process.")
     parser.add_argument("-t", "--library-type", default="user", choices=("user","group"),
         help="Zotero library type (user or group)")
+    parser.add_argument("-T", "--target", type=target, action="append", default=[],
+        metavar="TYPE:ID", help="Also export to another Zotero library (user:ID or "\
+             "group:ID, with the same API key) or file (json:FILE or bibtex:FILE). May be "\
+             "given more than once. Publications are only read once for all targets, which "\
+             "are exported to in parallel. The checkpoint, journal, versions, retry and "\
+             "cache files of another library are named after those of the main library, "\
+             "with -TYPE-ID appended.")
     parser.add_argument("--batch-size", type=int, default=50, 
         help="Number of articles that will be uploaded to Zotero at a time.")
+    parser.add_argument("--batch-bytes", type=int, default=None,
+        help="Max size, in bytes, of the item metadata uploaded in a single request. "\
+             "Batches are uploaded early if adding an article would exceed this size.")
+    parser.add_argument("--max-requests", type=int, default=1,
+        help="Max number of requests to have in flight at once. If greater than 1, "\
+             "batches are uploaded in the background while publications are read, "\
+             "and notes and attachments are uploaded concurrently.")
+    parser.add_argument("--requests-per-second", type=float, default=None,
+        help="Max number of requests to send per second (only with --max-requests).")
+    parser.add_argument("--snapshot", nargs="?", const=COPY, default=None, choices=SNAPSHOT_MODES,
+        help="Read a consistent snapshot of the Papers2 database, so that changes made "\
+             "while exporting are not seen and reads never wait for Papers2's locks. With "\
+             "'copy' (the default), read from a copy of the database, and add indexes to "\
+             "the copy to speed up the queries used during export; with 'transaction', "\
+             "read the database itself in a single read transaction (only if it is in WAL "\
+             "mode).")
+    parser.add_argument("--export-view", action="store_true", default=False,
+        help="Read publications from a materialized view of the library, which is "\
+             "built on the first run and updated incrementally on later runs.")
+    parser.add_argument("--check-attachments", action="store_true", default=False,
+        help="Check every attachment file before exporting, and do not upload attachments "\
+             "whose files are missing or empty. The results are cached, so later checks "\
+             "only read files that have changed.")
+    parser.add_argument("--watch", action="store_true", default=False,
+        help="After exporting, keep running and export publications as they are added "\
+             "to (or, with --sync, modified in) Papers2, until interrupted.")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+        help="Seconds between checks for changes to the Papers2 database (with --watch)")
+    parser.add_argument("--flush-deadline", type=float, default=5,
+        help="Max number of seconds a publication found by --watch waits for its batch "\
+             "to fill up before the batch is uploaded anyway.")
     parser.add_argument("--checkpoint-file", default="papers2zotero.pickle",
         help="File where list of Papers2 database IDs for successfully uploaded items "\
              "will be stored so that the program can be stopped and resumed.")
+    parser.add_argument("--journal-file", default="papers2zotero-journal.jsonl",
+        help="File where each upload is recorded before and while it is sent, so that "\
+             "uploads interrupted by a crash are completed on the next run without "\
+             "creating duplicate items.")
+    parser.add_argument("--retry-file", default="papers2zotero-retry.pickle",
+        help="File where notes and attachments that could not be uploaded will be "\
+             "stored so that they are retried on the next run.")
+    parser.add_argument("--max-attempts", type=int, default=RETRY_ATTEMPTS,
+        help="Number of times an upload that fails is attempted before it is given up "\
+             "on. Failed items are retried individually, after a delay that doubles with "\
+             "each attempt, while the rest of their batch goes ahead.")
+    parser.add_argument("--retry-backoff", type=float, default=RETRY_BACKOFF,
+        help="Number of seconds to wait before the first retry of a failed upload.")
+    parser.add_argument("--collection-cache", default="papers2zotero-collections.pickle",
+        help="File where the keys of Zotero collections will be cached so that they "\
+             "do not need to be fetched again on subsequent runs.")
+    parser.add_argument("--versions-file", default="papers2zotero-versions.pickle",
+        help="File where the keys and versions of uploaded items, and hashes of their "\
+             "contents, will be stored for use with --sync.")
+    parser.add_argument("--sync", action="store_true", default=False,
+        help="Update the Zotero items of previously uploaded publications that have "\
+             "changed since they were uploaded. Only the changed fields are sent, and "\
+             "items that have been modified in Zotero are not overwritten.")
+    parser.add_argument("--match-existing", choices=("skip", "update"), default=None,
+        help="Before uploading, download the items in the Zotero library and match "\
+             "publications against them by DOI or title and year. Matching publications "\
+             "are either skipped or used to update the existing items.")
+    parser.add_argument("--library-cache", default="papers2zotero-library.pickle",
+        help="File where the items downloaded for --match-existing will be cached, so "\
+             "that subsequent runs only download items that have changed.")
     parser.add_argument("--dryrun", nargs="?", const="stdout", default=None,
         help="Just print out the item JSON that will be sent to Zotero, " \
              "rather than actually sending it. If a file name is specified, the JSON will be "\
              "written to the file rather than stdout.")
+    parser.add_argument("--dedup", action="store_true", default=False,
+        help="Skip publications that duplicate another publication (same DOI, "\
+             "PubMed/PMC ID, or near-identical title, first author and year).")
     parser.add_argument("--max-pubs", type=int, default=None,
         help="Max number of publications to upload.")
+    parser.add_argument("--in-collections", default=None,
+        help="Comma-delimited list of collections; only publications in these "\
+             "collections (or their subcollections) are exported")
+    parser.add_argument("--with-keywords", default=None,
+        help="Comma-delimited list of keywords; only publications with at least "\
+             "one of these keywords are exported")
+    parser.add_argument("--with-labels", default=None,
+        help="Comma-delimited list of label colors (e.g. 'Red,Blue'); only "\
+             "publications with one of these labels are exported")
+    parser.add_argument("--by-authors", default=None,
+        help="Comma-delimited list of author surnames; only publications by at "\
+             "least one of these authors are exported")
+    parser.add_argument("--published-from", type=pub_date, default=None,
+        help="Only export publications published on or after this date "\
+             "(YYYY, YYYY-MM or YYYY-MM-DD)")
+    parser.add_argument("--published-to", type=pub_date, default=None,
+        help="Only export publications published on or before this date "\
+             "(YYYY, YYYY-MM or YYYY-MM-DD)")
+    parser.add_argument("--imported-from", type=iso_date, default=None,
+        help="Only export publications imported into Papers2 on or after this "\
+             "date (YYYY-MM-DD)")
+    parser.add_argument("--imported-to", type=iso_date, default=None,
+        help="Only export publications imported into Papers2 on or before this "\
+             "date (YYYY-MM-DD)")
+    parser.add_argument("--min-times-read", type=int, default=None,
+        help="Only export publications that have been read at least this many times")
+    parser.add_argument("--max-times-read", type=int, default=None,
+        help="Only export publications that have been read at most this many times "\
+             "(0 for unread publications)")
     parser.add_argument("--attachments", choices=("all", "unread", "none"), default="all",
         help="Which attachments to upload")
     parser.add_argument("--no-collections", action="store_true", default=False,
         help="Do not convert Papers2 collections into Zotero collections")
+    parser.add_argument("--progress", action="store_true", default=False,
+        help="Show the progress of the export on a line of the terminal: the number of "\
+             "publications read and items exported, how many publications are read, "\
+             "items exported, requests sent and bytes uploaded per second, the estimated "\
+             "time remaining, and the number of items waiting at each stage.")
+    parser.add_argument("--status-file", default=None,
+        help="File where the progress of the export is written as JSON, so that it can "\
+             "be monitored by another program. The file is replaced at every update.")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL,
+        help="Seconds between updates of the progress (with --progress or --status-file)")
     parser.add_argument("--log-level", metavar="LEVEL", default="WARNING",
         choices=log._levelNames.keys(), help="Logger level")
     parser.add_argument("--sql-log-level", metavar="LEVEL", default="WARNING",
@@ -54,11 +207,6 @@ def main():
     log.getLogger('sqlalchemy.engine').setLevel(log._levelNames[args.sql_log_level])
     log.getLogger('requests').setLevel(log._levelNames[args.http_log_level])
 
-    # create checkpoint for tracking uploaded items
-    checkpoint = None
-    if args.dryrun is None and args.checkpoint_file is not None:
-        checkpoint = Checkpoint(args.checkpoint_file)
-    
     keyword_types = args.keyword_types.split(",")
     
     add_to_collections = [] if args.no_collections else None
@@ -73,17 +221,68 @@ def main():
         if label.name not in label_map:
             label_map[label.name] = "{0}{1}".format(args.label_tags_prefix, label.name)
     
+    # Select the publications to process; all filters are
+    # applied in the database query
+    query_args = dict(
+        published_from=args.published_from,
+        published_to=args.published_to,
+        imported_from=args.imported_from,
+        min_times_read=args.min_times_read,
+        max_times_read=args.max_times_read)
+    if args.in_collections is not None:
+        query_args['collections'] = args.in_collections.split(",")
+    if args.with_keywords is not None:
+        query_args['keywords'] = args.with_keywords.split(",")
+    if args.with_labels is not None:
+        labels = dict((l.name.lower(), l) for l in Label.__values__)
+        try:
+            query_args['labels'] = list(labels[name.lower()] for name in args.with_labels.split(","))
+        except KeyError as e:
+            sys.exit("Unknown label: {0}".format(e.args[0]))
+    if args.by_authors is not None:
+        query_args['authors'] = args.by_authors.split(",")
+    if args.imported_to is not None:
+        # include the whole day
+        query_args['imported_to'] = args.imported_to + timedelta(days=1, microseconds=-1)
+    
+    if args.watch and args.snapshot:
+        sys.exit("--watch cannot be used with --snapshot")
+    if args.dryrun is not None and any(t[0] in ("user", "group") for t in args.target):
+        sys.exit("--dryrun cannot be used with other Zotero libraries; use a json target")
+    
     # open database
-    p = Papers2(args.papers2_folder)
+    p = Papers2(args.papers2_folder, snapshot=args.snapshot)
+    if p.snapshot == COPY:
+        advisor = IndexAdvisor(p)
+        log.info("Query times with indexes:\n{0}".format(format_reports(advisor.optimize())))
+        advisor.close()
+    view = p.get_export_view() if args.export_view else None
+    attachment_index = None
+    if args.check_attachments and args.attachments != "none":
+        attachment_index = AttachmentIndex(p)
+        attachment_index.update()
     
-    # initialize Zotero client
-    z = ZoteroImporter(args.library_id, args.library_type, args.api_key, p, 
-        keyword_types, label_map, add_to_collections, args.attachments,
-        args.batch_size, checkpoint, dryrun=args.dryrun)
+    # initialize Zotero client; all importers add to the same counters
+    counters = Counters()
+    z = new_importer(args, p, args.library_id, args.library_type, keyword_types, label_map,
+        add_to_collections, view, attachment_index, counters=counters)
+    
+    # export to other targets from the same extraction
+    if len(args.target) > 0:
+        targets = [z]
+        for target_type, target_id in args.target:
+            if target_type == "json":
+                targets.append(FileTarget(JSONWriter(target_id), args.attachments, counters))
+            elif target_type == "bibtex":
+                targets.append(BibTeXTarget(BibTeXWriter(target_id), args.attachments,
+                    counters))
+            else:
+                targets.append(new_importer(args, p, target_id, target_type, keyword_types,
+                    label_map, add_to_collections, view, attachment_index, z.extractor,
+                    "{0}-{1}".format(target_type, target_id), counters))
+        z = FanOut(z.extractor, targets)
     
     # Limit the number of publications to process
-    # TODO: add additional options for filtering pubs to import
-    query_args = {}
     max_pubs = args.max_pubs
     row_ids = None
     if args.rowids is not None:
@@ -92,6 +291,18 @@ def main():
         if max_pubs is None or max_pubs > num_ids:
             max_pubs = num_ids
     
+    # Find duplicates to skip
+    duplicates = set()
+    if args.dedup:
+        duplicates = DuplicateFinder(p).get_duplicate_ids(**query_args)
+        log.info("Skipping {0} duplicate publications".format(len(duplicates)))
+    
+    # Start watching before the library is read, so that publications
+    # added while it is exported are found by the first poll
+    watcher = None
+    if args.watch:
+        watcher = LibraryWatcher(p, query_args, args.poll_interval)
+    
     # Prepare query
     q = p.get_publications(**query_args)
     
@@ -100,7 +311,22 @@ def main():
     
     num_added = 0
     
-    for pub in q:
+    progress = None
+    if args.progress or args.status_file is not None:
+        progress = Progress(max_pubs, counters, z.get_queue_depths, args.progress_interval,
+            sys.stderr if args.progress else None, args.status_file)
+    
+    pubs = q
+    if view is not None:
+        Publication = p.get_table("Publication")
+        pubs = view.get_records(row[0] for row in q.with_entities(Publication.ROWID))
+    
+    for pub in pubs:
+        counters.add(pubs=1)
+        if pub.ROWID in duplicates:
+            log.debug(u"Skipping duplicate: {0}".format(pub.title))
+            continue
+        
         try:
             if z.add_pub(pub):
                 log.debug(u"Added to batch: {0}".format(pub.title))
@@ -112,10 +338,108 @@ def main():
         except Exception as e:
             log.error("Error converting publication {0} to Zotero".format(pub.ROWID), exc_info=e)
 
+    if watcher is not None:
+        num_added += watch(p, z, view, watcher, args.flush_deadline)
+
     p.close()
-    z.close()
+    try:
+        z.close()
+    finally:
+        if attachment_index is not None:
+            attachment_index.close()
+        if progress is not None:
+            progress.close()
 
     log.info("Exported {0} papers to Zotero".format(num_added))
+    report_reads(p)
+
+# Report the cost of the snapshot (if any), and the time spent
+# waiting for Papers2 to release its locks on the database
+def report_reads(p):
+    stats = p.lock_stats
+    if p.snapshot is not None:
+        log.info("Took a {0} snapshot of the Papers2 database in {1:.2f} seconds, {2:.2f} of "\
+            "them waiting for locks; reads of the snapshot never wait for locks".format(
+            p.snapshot, p.snapshot_seconds, stats.seconds))
+    else:
+        report = log.warning if stats.waits > 0 else log.info
+        report("{0} of {1} statements on the Papers2 database waited for locks, for {2:.2f} "\
+            "seconds{3}".format(stats.waits, stats.statements, stats.seconds,
+            "; use --snapshot to avoid this" if stats.waits > 0 else ""))
+
+# Create the importer for a Zotero library. The checkpoint, journal,
+# versions, retry and cache files of libraries other than the main
+# one are named with suffix.
+def new_importer(args, p, library_id, library_type, keyword_types, label_map,
+        add_to_collections, view, attachment_index, extractor=None, suffix=None,
+        counters=None):
+    # create checkpoint for tracking uploaded items
+    checkpoint = None
+    if args.dryrun is None and args.checkpoint_file is not None:
+        checkpoint = Checkpoint(target_file(args.checkpoint_file, suffix))
+    
+    # record uploaded item versions for incremental syncing
+    versions = None
+    if args.dryrun is None and args.versions_file is not None:
+        versions = ItemVersions(target_file(args.versions_file, suffix))
+    
+    # record uploads in progress so that they can be resumed
+    journal = None
+    if args.dryrun is None and args.journal_file is not None:
+        journal = Journal(target_file(args.journal_file, suffix))
+    
+    # retry uploads that fail, rather than aborting the export
+    retry_queue = None
+    if args.dryrun is None:
+        retry_queue = RetryQueue(target_file(args.retry_file, suffix), args.max_attempts,
+            args.retry_backoff)
+    
+    importer_class = ZoteroImporter
+    importer_args = {}
+    if args.max_requests > 1:
+        importer_class = ConcurrentZoteroImporter
+        importer_args = dict(max_requests=args.max_requests,
+            requests_per_second=args.requests_per_second)
+    return importer_class(library_id, library_type, args.api_key, p,
+        keyword_types, label_map, add_to_collections, args.attachments,
+        args.batch_size, checkpoint, dryrun=args.dryrun,
+        collection_cache=target_file(args.collection_cache, suffix),
+        library_cache=target_file(args.library_cache, suffix),
+        on_match=args.match_existing, versions=versions, sync=args.sync,
+        batch_bytes=args.batch_bytes, journal=journal, view=view,
+        attachment_index=attachment_index, retry_queue=retry_queue,
+        extractor=extractor, counters=counters, **importer_args)
+
+# Export publications as they are added or modified, uploading each
+# batch when it is full or flush_deadline seconds after its first
+# publication was added, until interrupted. Returns the number of
+# publications added.
+def watch(p, z, view, watcher, flush_deadline):
+    z.flush()
+    log.info("Watching {0} for new publications".format(p.db))
+    num_added = 0
+    try:
+        while True:
+            age = z.batch_age
+            timeout = None if age is None else max(flush_deadline - age, 0)
+            if watcher.wait(timeout):
+                pubs = watcher.poll()
+                z.refresh(pub.ROWID for pub in pubs)
+                if view is not None:
+                    view.update()
+                    pubs = view.get_records(pub.ROWID for pub in pubs)
+                for pub in pubs:
+                    try:
+                        if z.add_pub(pub):
+                            log.info(u"Added to batch: {0}".format(pub.title))
+                            num_added += 1
+                    except Exception as e:
+                        log.error("Error converting publication {0} to Zotero".format(pub.ROWID),
+                            exc_info=e)
+            z.flush(flush_deadline)
+    except KeyboardInterrupt:
+        log.info("Stopped watching")
+    return num_added
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,177 @@
+# Integrity index of attachment files.
+#
+# Papers2 stores the paths of attachments relative to the library
+# folder, and nothing checks that the files still exist until they
+# are uploaded. AttachmentIndex checks every attachment up front: a
+# pool of threads stats each file and reads the first bytes of new
+# or changed files to determine their actual type. The results (size,
+# mtime and detected MIME type) are cached in a sidecar SQLite
+# database, so later updates only have to stat the files, and only
+# read those whose size or mtime has changed.
+
+from collections import namedtuple
+import logging as log
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import time
+
+from .stats import STAT_THREADS
+
+INDEX_FILE = "attachments.sqlite"
+
+# Number of bytes read from the start of a file to detect its type
+SNIFF_SIZE = 1024
+
+# File signatures, as (MIME type, lowercase prefix, max offset of the
+# prefix); files are matched case-insensitively, in this order
+SIGNATURES = (
+    ("application/pdf",         b"%pdf-",               SNIFF_SIZE),
+    ("application/zip",         b"pk\x03\x04",          0),
+    ("application/rtf",         b"{\\rtf",              0),
+    ("application/postscript",  b"%!ps",                0),
+    ("image/png",               b"\x89png\r\n\x1a\n",   0),
+    ("image/jpeg",              b"\xff\xd8\xff",        0),
+    ("image/gif",               b"gif8",                0),
+    ("image/tiff",              b"ii*\x00",             0),
+    ("image/tiff",              b"mm\x00*",             0),
+    ("text/html",               b"<!doctype html",      SNIFF_SIZE),
+    ("text/html",               b"<html",               SNIFF_SIZE)
+)
+
+# Problems that prevent an attachment from being uploaded
+MISSING = "missing"
+EMPTY = "empty"
+# A problem that is only reported: the contents of the file do not
+# match its MIME type in Papers2 (e.g. an HTML error page saved as
+# a PDF)
+MISMATCH = "mismatch"
+
+# The state of an attachment file. mime_type is the type detected from
+# the file's contents (None if unknown); problem is None, MISSING,
+# EMPTY or MISMATCH.
+FileStatus = namedtuple("FileStatus", ("path", "exists", "size", "mtime", "mime_type", "problem"))
+
+# Summary of an index update
+IntegrityStats = namedtuple("IntegrityStats", ("files", "read", "missing", "empty", "mismatched",
+    "bytes", "seconds"))
+
+# Detect the MIME type of a file from its first bytes, or None
+def sniff_mime_type(path):
+    with open(path, "rb") as i:
+        head = i.read(SNIFF_SIZE)
+    head = head.lower()
+    for mime_type, prefix, offset in SIGNATURES:
+        if head.find(prefix, 0, offset + len(prefix)) >= 0:
+            return mime_type
+    return None
+
+# Check a file. task is (path, cached), where cached is the
+# (size, mtime, mime type) recorded by the last check, or None. The
+# file is only read if it has changed. Returns (path, size, mtime,
+# mime type, was read); size is None if the file does not exist.
+def check_file(task):
+    path, cached = task
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None, None, None, False)
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        return (path, st.st_size, st.st_mtime, cached[2], False)
+    mime_type = None
+    if st.st_size > 0:
+        try:
+            mime_type = sniff_mime_type(path)
+        except IOError:
+            return (path, None, None, None, False)
+    return (path, st.st_size, st.st_mtime, mime_type, True)
+
+class AttachmentIndex(object):
+    def __init__(self, papers2, filename=None, threads=STAT_THREADS):
+        self.papers2 = papers2
+        self.filename = filename or papers2.get_cache_file(INDEX_FILE)
+        self.threads = threads
+        self._conn = sqlite3.connect(self.filename)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                mime_type TEXT)""")
+        self._status = {}
+        self._attachments = []
+    
+    def close(self):
+        self._conn.close()
+    
+    # Check every attachment in the library. Returns IntegrityStats.
+    def update(self):
+        start = time.time()
+        PDF = self.papers2.get_table("PDF")
+        self._attachments = list((object_id, self.papers2.get_attachment_path(path), mime_type)
+            for object_id, path, mime_type in self.papers2.get_session().query(
+                PDF.object_id, PDF.path, PDF.mime_type) if path is not None)
+        declared = dict((path, mime_type) for object_id, path, mime_type in self._attachments)
+        cached = dict((row[0], row[1:]) for row in self._conn.execute(
+            "SELECT path, size, mtime, mime_type FROM files"))
+        
+        pool = ThreadPool(self.threads)
+        try:
+            tasks = list((path, cached.get(path)) for path in declared)
+            results = pool.map(check_file, tasks, chunksize=max(1, len(tasks) // (self.threads * 4)))
+        finally:
+            pool.close()
+        
+        status = {}
+        num_read = 0
+        for path, size, mtime, mime_type, read in results:
+            num_read += read
+            problem = None
+            if size is None:
+                problem = MISSING
+            elif size == 0:
+                problem = EMPTY
+            elif mime_type is not None and declared[path] is not None and \
+                    mime_type != declared[path].lower():
+                problem = MISMATCH
+            status[path] = FileStatus(path, size is not None, size, mtime, mime_type, problem)
+        self._status = status
+        
+        with self._conn:
+            self._conn.execute("DELETE FROM files")
+            self._conn.executemany("INSERT INTO files (path, size, mtime, mime_type) "\
+                "VALUES (?, ?, ?, ?)", ((s.path, s.size, s.mtime, s.mime_type)
+                for s in status.itervalues() if s.exists))
+        
+        problems = list(s.problem for s in status.itervalues())
+        stats = IntegrityStats(len(status), num_read, problems.count(MISSING),
+            problems.count(EMPTY), problems.count(MISMATCH),
+            sum(s.size for s in status.itervalues() if s.exists), time.time() - start)
+        log.info("Checked {0} attachment files in {1:.2f} seconds ({2} read): {3} missing, "\
+            "{4} empty, {5} with mismatched type".format(stats.files, stats.seconds, stats.read,
+            stats.missing, stats.empty, stats.mismatched))
+        return stats
+    
+    # Get the FileStatus of an (absolute) attachment path, or None if
+    # the path was not checked
+    def get(self, path):
+        return self._status.get(path)
+    
+    # Size of an attachment file, or 0 if it is missing or was not checked
+    def get_size(self, path):
+        status = self._status.get(path)
+        return status.size if status is not None and status.exists else 0
+    
+    # Returns True if an attachment can be uploaded, i.e. its file
+    # exists and is not empty. Paths that were not checked are assumed
+    # to be uploadable.
+    def is_uploadable(self, path):
+        status = self._status.get(path)
+        return status is None or status.problem not in (MISSING, EMPTY)
+    
+    # Get (publication ROWID, declared MIME type, FileStatus) for each
+    # attachment with a problem
+    def get_problems(self):
+        return list((object_id, mime_type, self._status[path])
+            for object_id, path, mime_type in self._attachments
+            if self._status[path].problem is not None)
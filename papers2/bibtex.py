@@ -0,0 +1,156 @@
+# Writing Zotero items as BibTeX entries.
+#
+# BibTeXWriter has the same interface as util.JSONWriter, so that it
+# can be used as an export target (see papers2.fanout): it converts
+# the Zotero items extracted from Papers2 publications, rather than
+# the publications themselves, so that a BibTeX file contains exactly
+# what is uploaded to Zotero.
+
+import re
+import sys
+import unicodedata
+
+from . import dates
+
+# BibTeX entry types for Zotero item types; other types are "misc"
+ENTRY_TYPES = {
+    'book'              : 'book',
+    'thesis'            : 'phdthesis',
+    'journalArticle'    : 'article',
+    'newspaperArticle'  : 'article',
+    'conferencePaper'   : 'inproceedings',
+    'report'            : 'techreport'
+}
+
+# BibTeX fields for Zotero item fields, in the order they are written
+FIELDS = (
+    ('title',               'title'),
+    ('publicationTitle',    'journal'),
+    ('university',          'school'),
+    ('edition',             'edition'),
+    ('volume',              'volume'),
+    ('issue',               'number'),
+    ('number',              'number'),
+    ('pages',               'pages'),
+    ('numPages',            'pages'),
+    ('publisher',           'publisher'),
+    ('place',               'address'),
+    ('language',            'language'),
+    ('DOI',                 'doi'),
+    ('ISBN',                'isbn'),
+    ('url',                 'url'),
+    ('abstractNote',        'abstract'),
+    ('extra',               'note'),
+    ('rights',              'copyright')
+)
+
+# Fields that are read verbatim (e.g. by the url package), and so
+# are not escaped
+VERBATIM_FIELDS = ('doi', 'url')
+
+# Fields renamed for some entry types
+ENTRY_FIELDS = {
+    'inproceedings'     : dict(journal='booktitle'),
+    'techreport'        : dict(publisher='institution')
+}
+
+# Characters that must be escaped in field values
+_SPECIAL = re.compile(r"([\\{}&%$#_~^])")
+_ESCAPES = {
+    "\\"    : r"\textbackslash{}",
+    "~"     : r"\textasciitilde{}",
+    "^"     : r"\textasciicircum{}"
+}
+
+# A single hyphen (a page range), not part of an en dash
+_HYPHEN = re.compile(r"(?<!-)-(?!-)")
+
+def escape(value):
+    return _SPECIAL.sub(lambda m: _ESCAPES.get(m.group(1), "\\" + m.group(1)), value)
+
+# Format the creators of the given type as a BibTeX name list
+def format_names(creators, creator_type):
+    names = []
+    for c in creators:
+        if c.get('creatorType') != creator_type:
+            continue
+        if 'name' in c:
+            # institutional names are braced so that they are not split
+            names.append(u"{{{0}}}".format(escape(c['name'] or u"")))
+        else:
+            names.append(u", ".join(escape(n) for n in (c.get('lastName'), c.get('firstName')) if n))
+    return u" and ".join(names)
+
+class BibTeXWriter(object):
+    def __init__(self, file):
+        self._fh = sys.stdout if file == "stdout" else open(file, "w")
+        self._keys = set()
+    
+    def close(self):
+        if self._fh != sys.stdout:
+            self._fh.close()
+    
+    # Generate a unique citation key from the last name of the first
+    # creator and the year, e.g. Smith2004, Smith2004a, Smith2004b
+    def _new_key(self, item, year):
+        name = u"papers2"
+        for c in item.get('creators', ()):
+            name = c.get('lastName') or c.get('name') or name
+            break
+        name = unicodedata.normalize("NFKD", unicode(name)).encode("ascii", "ignore")
+        base = re.sub(r"[^A-Za-z0-9]", "", name) or "papers2"
+        base += year or ""
+        key = base
+        suffix = 0
+        while key in self._keys:
+            key = base + "abcdefghijklmnopqrstuvwxyz"[suffix % 26] * (suffix // 26 + 1)
+            suffix += 1
+        self._keys.add(key)
+        return key
+    
+    # Write an item. pub_date is the Papers2 publication date string,
+    # used for the year and month; the date of the item is always a
+    # complete date, even if the month is unknown.
+    def write(self, item, attachments, pub_date=None):
+        entry_type = ENTRY_TYPES.get(item.get('itemType'), 'misc')
+        renamed = ENTRY_FIELDS.get(entry_type, {})
+        fields = []
+        date = dates.to_bibtex(dates.decode(pub_date)) if pub_date is not None else {}
+        if len(date) == 0 and item.get('date'):
+            date = dict(year=item['date'][0:4])
+        
+        for creator_type, field in (('author', 'author'), ('editor', 'editor')):
+            names = format_names(item.get('creators', ()), creator_type)
+            if len(names) > 0:
+                fields.append((field, names))
+        seen = set()
+        for key, field in FIELDS:
+            value = item.get(key)
+            if value and field not in seen:
+                value = unicode(value)
+                if field == 'pages':
+                    value = _HYPHEN.sub(u"--", value)
+                if field not in VERBATIM_FIELDS:
+                    value = escape(value)
+                fields.append((renamed.get(field, field), value))
+                seen.add(field)
+        if 'year' in date:
+            fields.append(('year', date['year']))
+        if 'month' in date:
+            fields.append(('month', date['month']))
+        tags = item.get('tags') or ()
+        if len(tags) > 0:
+            fields.append(('keywords', u", ".join(escape(t) for t in tags)))
+        if len(attachments) > 0:
+            # JabRef/BibDesk-style file links
+            fields.append(('file', u";".join(u":{0}:{1}".format(path, mime_type or u"")
+                for path, mime_type in attachments)))
+        
+        lines = [u"@{0}{{{1},".format(entry_type, self._new_key(item, date.get('year')))]
+        for field, value in fields:
+            # month macros (jan, feb, ...) are not braced
+            template = u"  {0} = {1}," if field == 'month' else u"  {0} = {{{1}}},"
+            lines.append(template.format(field, value))
+        lines.append(u"}\n")
+        self._fh.write(u"\n".join(lines).encode("utf-8"))
+        self._fh.write("\n")
@@ -0,0 +1,299 @@
+# Columnar export of a Papers2 library, for analytics.
+#
+# Publications, authors, keywords, collections and reviews, and the
+# tables that link them to publications, are each written to an
+# Apache Parquet file (or an Arrow IPC file) that can be loaded
+# directly by pandas, DuckDB, Polars, etc. Rows are read from the
+# database with SQLAlchemy Core (no ORM objects are created) and
+# converted to Arrow record batches CHUNK_SIZE rows at a time, so
+# memory use does not grow with the size of the library. Columns with
+# few distinct values (e.g. journal abbreviations, publishers) are
+# dictionary-encoded; the dictionary of each column is read up front
+# with a SELECT DISTINCT, so that every batch shares it.
+#
+# pyarrow is an optional dependency; it is imported on first use.
+
+from collections import namedtuple
+import logging as log
+import os
+import time
+
+# Number of rows per record batch (and Parquet row group)
+CHUNK_SIZE = 10000
+
+# Output formats and their file extensions
+FORMATS = {
+    "parquet" : "parquet",
+    "arrow"   : "arrow"
+}
+
+# Column kinds
+INT = "int"
+FLOAT = "float"
+STRING = "string"
+CATEGORY = "category"   # dictionary-encoded string
+TIMESTAMP = "timestamp" # POSIX timestamp, in seconds
+
+# An exported column: its name in the output file, its kind, and a
+# function (papers2) -> SQLAlchemy column expression
+Column = namedtuple("Column", ("name", "kind", "expr"))
+
+# An exported table: its name, its columns, and a function
+# (papers2, pub_ids) -> Query that selects the columns, where pub_ids
+# is a query selecting the ROWIDs of the exported publications
+Table = namedtuple("Table", ("name", "columns", "query"))
+
+# Summary of an exported table
+ExportStats = namedtuple("ExportStats", ("table", "path", "rows", "bytes", "seconds"))
+
+def _col(table, attr):
+    return lambda p: getattr(p.get_table(table), attr)
+
+def _query(table, link=None):
+    def query(papers2, columns, pub_ids):
+        q = papers2.get_session().query(*list(c.expr(papers2) for c in columns))
+        t = papers2.get_table(table)
+        if link is not None:
+            q = q.filter(getattr(t, link).in_(pub_ids))
+        return q.order_by(t.ROWID)
+    return query
+
+def _publications(papers2, columns, pub_ids):
+    Publication = papers2.get_table("Publication")
+    return papers2.get_session().query(*list(c.expr(papers2) for c in columns)
+        ).filter(Publication.ROWID.in_(pub_ids)
+        ).order_by(Publication.ROWID)
+
+def _year(p):
+    from sqlalchemy import Integer, cast, func
+    return cast(func.substr(p.get_table("Publication").publication_date, 3, 4), Integer)
+
+TABLES = (
+    Table("publications", (
+        Column("id",                INT,        _col("Publication", "ROWID")),
+        Column("uuid",              STRING,     _col("Publication", "uuid")),
+        Column("citekey",           STRING,     _col("Publication", "citekey")),
+        Column("subtype",           INT,        _col("Publication", "subtype")),
+        Column("title",             STRING,     _col("Publication", "title")),
+        Column("doi",               STRING,     _col("Publication", "doi")),
+        Column("publication_date",  STRING,     _col("Publication", "publication_date")),
+        Column("year",              INT,        _year),
+        Column("bundle",            INT,        _col("Publication", "bundle")),
+        Column("bundle_string",     CATEGORY,   _col("Publication", "bundle_string")),
+        Column("volume",            STRING,     _col("Publication", "volume")),
+        Column("number",            STRING,     _col("Publication", "number")),
+        Column("startpage",         STRING,     _col("Publication", "startpage")),
+        Column("endpage",           STRING,     _col("Publication", "endpage")),
+        Column("publisher",         CATEGORY,   _col("Publication", "publisher")),
+        Column("place",             CATEGORY,   _col("Publication", "place")),
+        Column("language",          CATEGORY,   _col("Publication", "language")),
+        Column("times_read",        INT,        _col("Publication", "times_read")),
+        Column("label",             INT,        _col("Publication", "label")),
+        Column("imported_date",     TIMESTAMP,  _col("Publication", "imported_date")),
+        Column("created_at",        TIMESTAMP,  _col("Publication", "created_at")),
+        Column("updated_at",        TIMESTAMP,  _col("Publication", "updated_at"))
+    ), _publications),
+    Table("authors", (
+        Column("id",                INT,        _col("Author", "ROWID")),
+        Column("prename",           STRING,     _col("Author", "prename")),
+        Column("surname",           STRING,     _col("Author", "surname")),
+        Column("fullname",          STRING,     _col("Author", "fullname")),
+        Column("institutional",     INT,        _col("Author", "institutional"))
+    ), _query("Author")),
+    Table("publication_authors", (
+        Column("publication_id",    INT,        _col("OrderedAuthor", "object_id")),
+        Column("author_id",         INT,        _col("OrderedAuthor", "author_id")),
+        Column("priority",          INT,        _col("OrderedAuthor", "priority")),
+        Column("type",              INT,        _col("OrderedAuthor", "type"))
+    ), _query("OrderedAuthor", "object_id")),
+    Table("keywords", (
+        Column("id",                INT,        _col("Keyword", "ROWID")),
+        Column("name",              STRING,     _col("Keyword", "name"))
+    ), _query("Keyword")),
+    Table("publication_keywords", (
+        Column("publication_id",    INT,        _col("KeywordItem", "object_id")),
+        Column("keyword_id",        INT,        _col("KeywordItem", "keyword_id")),
+        Column("type",              INT,        _col("KeywordItem", "type"))
+    ), _query("KeywordItem", "object_id")),
+    Table("collections", (
+        Column("id",                INT,        _col("Collection", "ROWID")),
+        Column("uuid",              STRING,     _col("Collection", "uuid")),
+        Column("name",              STRING,     _col("Collection", "name")),
+        Column("type",              INT,        _col("Collection", "type")),
+        Column("parent",            STRING,     _col("Collection", "parent"))
+    ), _query("Collection")),
+    Table("publication_collections", (
+        Column("publication_id",    INT,        _col("CollectionItem", "object_id")),
+        Column("collection_id",     INT,        _col("CollectionItem", "collection"))
+    ), _query("CollectionItem", "object_id")),
+    Table("reviews", (
+        Column("publication_id",    INT,        _col("Review", "object_id")),
+        Column("content",           STRING,     _col("Review", "content")),
+        Column("rating",            INT,        _col("Review", "rating")),
+        Column("is_mine",           INT,        _col("Review", "is_mine"))
+    ), _query("Review", "object_id"))
+)
+
+TABLE_NAMES = tuple(t.name for t in TABLES)
+
+# Get the pyarrow module, or raise an exception if it is not installed
+def get_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception("Columnar export requires the pyarrow package")
+    return pyarrow
+
+def arrow_type(pa, kind):
+    if kind == INT:
+        return pa.int64()
+    if kind == FLOAT:
+        return pa.float64()
+    if kind == TIMESTAMP:
+        return pa.timestamp('ms')
+    if kind == CATEGORY:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+def arrow_schema(pa, columns):
+    return pa.schema(list(pa.field(c.name, arrow_type(pa, c.kind)) for c in columns))
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_ms(value):
+    if value is None:
+        return None
+    return int(round(value * 1000))
+
+# The dictionary of a CATEGORY column: an Arrow array of its distinct
+# values, and a dict mapping each value to its index
+class Dictionary(object):
+    def __init__(self, pa, values):
+        values = sorted(v for v in values if v is not None)
+        self.array = pa.array(values, type=pa.string())
+        self.codes = dict((v, i) for i, v in enumerate(values))
+    
+    def encode(self, pa, values):
+        codes = self.codes
+        indices = pa.array(list(codes.get(v) for v in values), type=pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, self.array)
+
+# Convert a chunk of rows (tuples with one value per column) to an
+# Arrow record batch. dictionaries maps the index of each CATEGORY
+# column to its Dictionary.
+def to_record_batch(pa, schema, columns, rows, dictionaries):
+    arrays = []
+    for i, column in enumerate(columns):
+        values = list(row[i] for row in rows)
+        if column.kind == CATEGORY:
+            arrays.append(dictionaries[i].encode(pa, values))
+            continue
+        if column.kind == INT:
+            values = list(_to_int(v) for v in values)
+        elif column.kind == TIMESTAMP:
+            values = list(_to_ms(v) for v in values)
+        arrays.append(pa.array(values, type=schema.field(i).type))
+    return pa.RecordBatch.from_arrays(arrays, schema.names)
+
+# Writes record batches to a Parquet file or an Arrow IPC file. The
+# file is opened when the first batch is written, with the schema of
+# that batch, which (unlike the schema returned by arrow_schema)
+# carries the dictionaries of dictionary-encoded columns.
+class BatchWriter(object):
+    def __init__(self, pa, path, file_format="parquet"):
+        if file_format not in FORMATS:
+            raise ValueError("Unsupported format: {0}".format(file_format))
+        self.pa = pa
+        self.path = path
+        self.file_format = file_format
+        self._writer = None
+        self._sink = None
+    
+    def _open(self, schema):
+        if self.file_format == "parquet":
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.path, schema)
+        else:
+            self._sink = self.pa.OSFile(self.path, 'wb')
+            self._writer = self.pa.RecordBatchFileWriter(self._sink, schema)
+    
+    def write(self, batch):
+        if self._writer is None:
+            self._open(batch.schema)
+        if self.file_format == "parquet":
+            self._writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+    
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+class ColumnarExporter(object):
+    def __init__(self, papers2, file_format="parquet", chunk_size=CHUNK_SIZE):
+        if file_format not in FORMATS:
+            raise ValueError("Unsupported format: {0}".format(file_format))
+        self.pa = get_pyarrow()
+        self.papers2 = papers2
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+    
+    # Export tables (by default, all of TABLES) to files named
+    # <table>.<extension> in folder. Publications are selected by
+    # passing the same criteria as Papers2.get_publications; related
+    # tables only include the rows of the selected publications.
+    # Returns a list of ExportStats.
+    def export(self, folder, tables=None, **query_args):
+        folder = os.path.expanduser(folder)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        Publication = self.papers2.get_table("Publication")
+        pub_ids = self.papers2.get_publications(**query_args).with_entities(Publication.ROWID)
+        stats = []
+        for table in TABLES:
+            if tables is None or table.name in tables:
+                stats.append(self.export_table(table, folder, pub_ids))
+        return stats
+    
+    def export_table(self, table, folder, pub_ids):
+        start = time.time()
+        path = os.path.join(folder, "{0}.{1}".format(table.name, FORMATS[self.file_format]))
+        tmp = "{0}.tmp".format(path)
+        schema = arrow_schema(self.pa, table.columns)
+        query = table.query(self.papers2, table.columns, pub_ids)
+        dictionaries = {}
+        for i, column in enumerate(table.columns):
+            if column.kind == CATEGORY:
+                expr = column.expr(self.papers2)
+                dictionaries[i] = Dictionary(self.pa, (row[0] for row in
+                    query.with_entities(expr).order_by(None).distinct()))
+        result = self.papers2.get_session().execute(query.statement)
+        writer = BatchWriter(self.pa, tmp, self.file_format)
+        num_rows = 0
+        try:
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                # an empty table is written as a single empty batch
+                if len(rows) == 0 and num_rows > 0:
+                    break
+                writer.write(to_record_batch(self.pa, schema, table.columns, rows, dictionaries))
+                num_rows += len(rows)
+                if len(rows) == 0:
+                    break
+        finally:
+            result.close()
+            writer.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        
+        stats = ExportStats(table.name, path, num_rows, os.path.getsize(path), time.time() - start)
+        log.info("Exported {0} rows of {1} in {2:.2f} seconds ({3} bytes)".format(
+            stats.rows, stats.table, stats.seconds, stats.bytes))
+        return stats
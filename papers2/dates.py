@@ -0,0 +1,176 @@
+# Codec for Papers2 publication dates.
+#
+# Papers2 stores dates as 26-character strings, e.g.
+# 99200406011200000000222000, where characters 2-6 hold the
+# year, 6-8 the month and 8-10 the day. Unknown months and days
+# are stored as "00". Dates are decoded into PubDate tuples,
+# which can then be rendered in any of the supported output
+# formats. Decoded values are memoized, since the same dates
+# recur many times in a typical library.
+
+from collections import namedtuple
+import calendar
+
+# A decoded date. month and day are None if unknown.
+PubDate = namedtuple("PubDate", ("year", "month", "day"))
+
+DATE_LENGTH = 26
+MIN_YEAR = 1
+MAX_YEAR = 9999
+
+BIBTEX_MONTHS = (None, 'jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+# Maximum number of distinct values to memoize before
+# the cache is reset.
+MAX_CACHE_SIZE = 100000
+
+_cache = {}
+_MISSING = object()
+
+def _validate(year, month, day):
+    if year < MIN_YEAR or year > MAX_YEAR:
+        return None
+    if month == 0 or month > 12:
+        # a day without a month is meaningless
+        return PubDate(year, None, None)
+    if day == 0 or day > calendar.monthrange(year, month)[1]:
+        return PubDate(year, month, None)
+    return PubDate(year, month, day)
+
+def _decode(value):
+    if value is None or len(value) < 10:
+        return None
+    try:
+        year = int(value[2:6])
+        month = int(value[6:8])
+        day = int(value[8:10])
+    except ValueError:
+        return None
+    return _validate(year, month, day)
+
+def _remember(value, date):
+    if len(_cache) >= MAX_CACHE_SIZE:
+        _cache.clear()
+    _cache[value] = date
+
+# Decode a single Papers2 date string into a PubDate,
+# or None if the value is missing or invalid.
+def decode(value):
+    try:
+        return _cache[value]
+    except KeyError:
+        date = _decode(value)
+        _remember(value, date)
+        return date
+
+# Decode a sequence of Papers2 date strings in one pass. Each
+# distinct value is decoded once. If use_numpy is True and NumPy
+# is installed, the distinct values are decoded as a single
+# character matrix rather than one at a time. The results are
+# collected locally, since the cache may be cleared while they are
+# being remembered.
+def decode_many(values, use_numpy=False):
+    values = list(values)
+    decoded = {}
+    todo = []
+    for v in set(values):
+        date = _cache.get(v, _MISSING)
+        if date is _MISSING:
+            todo.append(v)
+        else:
+            decoded[v] = date
+    if len(todo) > 0:
+        numpy = None
+        if use_numpy:
+            try:
+                import numpy
+            except ImportError:
+                pass
+        if numpy is not None:
+            new = _decode_numpy(todo, numpy)
+        else:
+            new = dict((v, _decode(v)) for v in todo)
+        for v, date in new.iteritems():
+            _remember(v, date)
+        decoded.update(new)
+    return [decoded[v] for v in values]
+
+# Returns a dict of the decoded date of each value
+def _decode_numpy(values, numpy):
+    valid = [v for v in values if v is not None and len(v) >= 10]
+    decoded = dict((v, None) for v in values if v is None or len(v) < 10)
+    if len(valid) == 0:
+        return decoded
+
+    # view each string as a row of digits
+    chars = numpy.array([v[2:10].encode('ascii', 'replace') for v in valid], dtype='S8')
+    digits = chars.view(numpy.uint8).reshape(len(valid), 8).astype(numpy.int32) - ord('0')
+    ok = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    year = digits[:,0] * 1000 + digits[:,1] * 100 + digits[:,2] * 10 + digits[:,3]
+    month = digits[:,4] * 10 + digits[:,5]
+    day = digits[:,6] * 10 + digits[:,7]
+
+    for i, v in enumerate(valid):
+        if ok[i]:
+            decoded[v] = _validate(int(year[i]), int(month[i]), int(day[i]))
+        else:
+            decoded[v] = None
+    return decoded
+
+# Convert an ISO 8601 date or partial date (YYYY, YYYY-MM or
+# YYYY-MM-DD) into a bound on the YYYYMMDD part of Papers2 date
+# strings (characters 2-10), so that dates can be compared in SQL.
+# Missing components extend the range: the lower bound of "2004"
+# is "20040000" (which includes unknown months and days), and the
+# upper bound is "20049999". Raises ValueError for invalid dates,
+# including months and days that are not two digits.
+def to_bound(value, upper=False):
+    parts = value.split("-")
+    if len(parts) > 3 or any(not p.isdigit() or len(p) != (4 if i == 0 else 2)
+            for i, p in enumerate(parts)):
+        raise ValueError("Invalid date: {0}".format(value))
+    parts = list(int(p) for p in parts)
+    if parts[0] < MIN_YEAR or (len(parts) > 1 and not 1 <= parts[1] <= 12) or (
+            len(parts) > 2 and not 1 <= parts[2] <= calendar.monthrange(*parts[:2])[1]):
+        raise ValueError("Invalid date: {0}".format(value))
+    fill = 99 if upper else 0
+    parts.extend([fill] * (3 - len(parts)))
+    return "{0:04d}{1:02d}{2:02d}".format(*parts)
+
+# Format a PubDate as an ISO 8601 date string. If fill is True,
+# unknown months and days are rendered as "01" so that the
+# result is always a complete YYYY-MM-DD date; otherwise the
+# date is truncated at the first unknown component.
+def to_iso(date, fill=True):
+    if date is None:
+        return None
+    parts = ["{0:04d}".format(date.year)]
+    for part in (date.month, date.day):
+        if part is None:
+            if not fill:
+                break
+            part = 1
+        parts.append("{0:02d}".format(part))
+    return "-".join(parts)
+
+# Format a PubDate as a dict of BibTeX fields (year and,
+# if known, month as a three-letter macro name).
+def to_bibtex(date):
+    if date is None:
+        return {}
+    fields = dict(year=str(date.year))
+    if date.month is not None:
+        fields['month'] = BIBTEX_MONTHS[date.month]
+    return fields
+
+# Format a PubDate as a CSL-JSON date variable.
+def to_csl(date):
+    if date is None:
+        return None
+    parts = [date.year]
+    if date.month is not None:
+        parts.append(date.month)
+        if date.day is not None:
+            parts.append(date.day)
+    return {'date-parts': [parts]}
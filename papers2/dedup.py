@@ -0,0 +1,225 @@
+# Detection of duplicate publications.
+#
+# Papers2 only flags the duplicates it detects itself (marked_duplicate).
+# This module finds publications that share a DOI, PubMed ID or PMC ID,
+# or that have near-identical titles. To avoid comparing every pair of
+# publications, candidates are grouped into blocks: one block per
+# identifier value, and one block per locality-sensitive hashing (LSH)
+# band of a MinHash signature computed over the character n-grams of
+# the normalized title. Only publications within the same block are
+# compared, and duplicates are merged into groups using union-find.
+
+from collections import namedtuple
+import logging as log
+import re
+import zlib
+
+from . import dates
+from .schema import IDSource
+
+# Length of the character n-grams used for title signatures
+NGRAM_SIZE = 4
+
+# Number of LSH bands and rows per band. Signatures are computed with
+# one-permutation MinHash: each n-gram is hashed once, and the hash
+# space is split into BANDS * ROWS bins, each of which keeps its
+# minimum value. With 8 bands of 4 rows, titles with a similarity
+# above ~0.6 are likely to share at least one band.
+BANDS = 8
+ROWS = 4
+SIGNATURE_SIZE = BANDS * ROWS
+
+# Min estimated title similarity for two publications to be duplicates
+MIN_SIMILARITY = 0.8
+
+# Title blocks larger than this (e.g. many publications titled
+# "Editorial") are too unspecific to be useful and are skipped
+MAX_BLOCK_SIZE = 50
+
+_MASK = (1 << 32) - 1
+_EMPTY = None
+
+# A group of duplicate publications. keep is the ROWID of the
+# publication to keep (the one with a DOI, if any, and otherwise
+# the earliest imported); duplicates is the set of all other ROWIDs.
+DuplicateGroup = namedtuple("DuplicateGroup", ("keep", "duplicates", "reason"))
+
+def normalize_doi(doi):
+    if doi is None:
+        return None
+    doi = doi.strip().lower()
+    doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:\s*)", "", doi)
+    return doi or None
+
+def normalize_title(title):
+    if title is None:
+        return u""
+    return u" ".join(re.findall(r"\w+", title.lower(), re.UNICODE))
+
+# Compute the MinHash signature of a normalized title
+def minhash(title):
+    if len(title) < NGRAM_SIZE:
+        ngrams = set((title,))
+    else:
+        ngrams = set(title[i:i+NGRAM_SIZE] for i in xrange(len(title) - NGRAM_SIZE + 1))
+    sig = [_EMPTY] * SIGNATURE_SIZE
+    for g in ngrams:
+        h = (zlib.crc32(g.encode('utf-8')) * 2654435761) & _MASK
+        b, v = h % SIGNATURE_SIZE, h // SIGNATURE_SIZE
+        if sig[b] is _EMPTY or v < sig[b]:
+            sig[b] = v
+    return tuple(sig)
+
+# Estimate the Jaccard similarity of two titles from their
+# signatures, ignoring bins that are empty in both
+def similarity(sig1, sig2):
+    same = total = 0
+    for x, y in zip(sig1, sig2):
+        if x is not _EMPTY or y is not _EMPTY:
+            total += 1
+            if x == y:
+                same += 1
+    return same / float(total) if total > 0 else 0.0
+
+class _UnionFind(object):
+    def __init__(self):
+        self.parent = {}
+    
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        if parent != x:
+            parent = self.parent[x] = self.find(parent)
+        return parent
+    
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+    
+    def groups(self):
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), set()).add(x)
+        return list(g for g in groups.itervalues() if len(g) > 1)
+
+class DuplicateFinder(object):
+    def __init__(self, papers2, min_similarity=MIN_SIMILARITY):
+        self.papers2 = papers2
+        self.min_similarity = min_similarity
+    
+    # Find groups of duplicates among the publications returned by
+    # get_publications(**query_args). Returns a list of DuplicateGroups.
+    def find_duplicates(self, **query_args):
+        Publication = self.papers2.get_table("Publication")
+        pubs = dict((p.ROWID, p) for p in self.papers2.get_publications(**query_args).with_entities(
+            Publication.ROWID, Publication.uuid, Publication.doi, Publication.title,
+            Publication.publication_date))
+        
+        groups = _UnionFind()
+        reasons = []
+        def merge(ids, reason):
+            ids = list(ids)
+            for other in ids[1:]:
+                groups.union(ids[0], other)
+            reasons.append((ids[0], reason))
+        
+        # exact identifier blocks
+        blocks = {}
+        for pub in pubs.itervalues():
+            doi = normalize_doi(pub.doi)
+            if doi is not None:
+                blocks.setdefault(('doi', doi), []).append(pub.ROWID)
+        uuids = dict((p.uuid, p.ROWID) for p in pubs.itervalues())
+        for ident in self.papers2.get_all_identifiers((IDSource.PUBMED, IDSource.PMC)):
+            if ident.device_id in uuids and ident.remote_id:
+                key = (ident.source_id, ident.remote_id.strip().lower())
+                blocks.setdefault(key, []).append(uuids[ident.device_id])
+        for key, ids in blocks.iteritems():
+            if len(ids) > 1:
+                merge(set(ids), key[0])
+        
+        # title blocks
+        first_authors = self._get_first_authors(pubs)
+        signatures = {}
+        blocks = {}
+        for pub in pubs.itervalues():
+            title = normalize_title(pub.title)
+            if len(title) == 0:
+                continue
+            sig = signatures[pub.ROWID] = minhash(title)
+            for band in xrange(BANDS):
+                rows = sig[band*ROWS:(band+1)*ROWS]
+                # short titles leave whole bands empty, which would
+                # put all of them in the same block
+                if all(r is _EMPTY for r in rows):
+                    continue
+                blocks.setdefault((band, rows), []).append(pub.ROWID)
+        
+        compared = set()
+        for key, ids in blocks.iteritems():
+            if len(ids) < 2:
+                continue
+            if len(ids) > MAX_BLOCK_SIZE:
+                log.debug("Skipping title block of size {0}".format(len(ids)))
+                continue
+            for i, id1 in enumerate(ids):
+                for id2 in ids[i+1:]:
+                    if (id1, id2) in compared:
+                        continue
+                    compared.add((id1, id2))
+                    if self._is_duplicate(pubs[id1], pubs[id2], signatures, first_authors):
+                        merge((id1, id2), 'title')
+        
+        group_reasons = {}
+        for pub_id, reason in reasons:
+            group_reasons.setdefault(groups.find(pub_id), set()).add(reason)
+        
+        result = []
+        for group in groups.groups():
+            keep = min(group, key=lambda i: (normalize_doi(pubs[i].doi) is None, i))
+            reason = ",".join(sorted(group_reasons[groups.find(keep)]))
+            result.append(DuplicateGroup(keep, group - set((keep,)), reason))
+        
+        log.info("Found {0} duplicate groups among {1} publications ({2} title pairs compared)".format(
+            len(result), len(pubs), len(compared)))
+        return result
+    
+    # Returns the set of ROWIDs of publications that duplicate
+    # another publication and should be skipped.
+    def get_duplicate_ids(self, **query_args):
+        ids = set()
+        for group in self.find_duplicates(**query_args):
+            ids.update(group.duplicates)
+        return ids
+    
+    def _get_first_authors(self, pubs):
+        surnames = dict((a.id, a.surname) for a in self.papers2.get_authors())
+        first_authors = {}
+        for pub_id, author_id, author_type in self.papers2.get_ordered_authors():
+            if pub_id in pubs and pub_id not in first_authors:
+                first_authors[pub_id] = normalize_title(surnames.get(author_id))
+        return first_authors
+    
+    # Compare two publications in the same title block. The cheap
+    # checks are done before the signatures are compared.
+    def _is_duplicate(self, pub1, pub2, signatures, first_authors):
+        # publications with different DOIs are distinct even if their
+        # titles are similar (e.g. errata, or multi-part articles)
+        doi1 = normalize_doi(pub1.doi)
+        doi2 = normalize_doi(pub2.doi)
+        if doi1 is not None and doi2 is not None and doi1 != doi2:
+            return False
+        author1 = first_authors.get(pub1.ROWID)
+        author2 = first_authors.get(pub2.ROWID)
+        if author1 and author2 and author1 != author2:
+            return False
+        year1 = _get_year(pub1.publication_date)
+        year2 = _get_year(pub2.publication_date)
+        if year1 is not None and year2 is not None and year1 != year2:
+            return False
+        return similarity(signatures[pub1.ROWID], signatures[pub2.ROWID]) >= self.min_similarity
+
+def _get_year(pub_date):
+    date = dates.decode(pub_date)
+    return None if date is None else date.year
@@ -0,0 +1,182 @@
+# Exporting a library to several targets from a single extraction.
+#
+# Each target (a ZoteroImporter for a user or group library, or a
+# FileTarget writing JSON or BibTeX) keeps its own batch, checkpoint,
+# journal and retry queue, but every publication is converted only
+# once, by an Extractor shared by all of them, and only if at least
+# one target wants it. Each target is fed by its own thread through a
+# bounded queue, so that the targets upload in parallel, and a slow
+# target (e.g. a library that is being rate limited) does not hold up
+# the others until its queue is full. Extractions are fully loaded
+# before they are queued, so the database session is only ever used
+# by the thread that calls add_pub.
+
+from collections import OrderedDict
+import logging as log
+from Queue import Queue
+import threading
+
+from .util import Counters
+
+# Max number of publications queued for each target
+QUEUE_SIZE = 200
+
+# A target that writes items to a file, with a util.JSONWriter or a
+# bibtex.BibTeXWriter, rather than uploading them. The file is
+# rewritten by every run, so there is no checkpoint, and collections
+# are not written since they only exist in Zotero. Each item written
+# is counted as exported in counters (a util.Counters, which may be
+# shared with the other targets).
+class FileTarget(object):
+    def __init__(self, writer, upload_attachments="all", counters=None):
+        self.writer = writer
+        self.upload_attachments = upload_attachments
+        self.counters = counters if counters is not None else Counters()
+        self.batch_age = None
+    
+    def wants(self, pub):
+        return True
+    
+    def add_extraction(self, extraction):
+        attachments = []
+        if self.upload_attachments == "all" or (
+                self.upload_attachments == "unread" and extraction.times_read == 0):
+            attachments = extraction.get_attachments()
+        self._write(extraction, extraction.get_item({}), attachments)
+        self.counters.add(exported=1)
+        return True
+    
+    def _write(self, extraction, item, attachments):
+        self.writer.write(item, attachments)
+    
+    def flush(self, max_age=None):
+        return False
+    
+    def get_queue_depths(self):
+        return OrderedDict()
+    
+    def close(self):
+        self.writer.close()
+
+# A FileTarget writing a BibTeXWriter, which also needs the Papers2
+# publication date, since the date of a Zotero item does not tell
+# whether the month is known
+class BibTeXTarget(FileTarget):
+    def _write(self, extraction, item, attachments):
+        self.writer.write(item, attachments, extraction.publication_date)
+
+class FanOut(object):
+    def __init__(self, extractor, targets, queue_size=QUEUE_SIZE):
+        self.extractor = extractor
+        self.targets = targets
+        self._queues = []
+        self._threads = []
+        # the errors raised by each target, only appended to by the
+        # target's own thread
+        self._errors = list([] for target in targets)
+        for target, errors in zip(targets, self._errors):
+            queue = Queue(queue_size)
+            thread = threading.Thread(target=self._run, args=(target, queue, errors))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+    
+    # Apply each (function, args) taken from a target's queue, until
+    # a None is taken. Errors are logged and added to errors.
+    def _run(self, target, queue, errors):
+        while True:
+            task = queue.get()
+            try:
+                if task is None:
+                    return
+                fn, args = task
+                fn(*args)
+            except Exception as e:
+                log.error("Error exporting to {0}".format(describe(target)), exc_info=e)
+                errors.append(e)
+            finally:
+                queue.task_done()
+    
+    # Queue a publication for every target that wants it, extracting
+    # it once. Returns True if any target wants it; whether each
+    # target actually exports it is only known to that target.
+    def add_pub(self, pub):
+        queues = list((t, q, e) for t, q, e in zip(self.targets, self._queues, self._errors)
+            if t.wants(pub))
+        if len(queues) == 0:
+            return False
+        extraction = self.extractor.extract(pub)
+        extraction.load()
+        extraction.shared = len(queues) > 1
+        for target, queue, errors in queues:
+            queue.put((self._add, (target, extraction, errors)))
+        return True
+    
+    # Errors are logged and added to errors, so that the other
+    # publications are still exported
+    def _add(self, target, extraction, errors):
+        try:
+            target.add_extraction(extraction)
+        except Exception as e:
+            log.error("Error exporting publication {0} to {1}".format(extraction.rowid,
+                describe(target)), exc_info=e)
+            errors.append(e)
+    
+    # Age of the oldest batch of any target, or None if all are empty
+    @property
+    def batch_age(self):
+        ages = list(t.batch_age for t in self.targets if t.batch_age is not None)
+        return max(ages) if len(ages) > 0 else None
+    
+    # Upload the batch of each target that is at least max_age seconds
+    # old (or every batch, if max_age is None), once the publications
+    # already queued have been added to it
+    def flush(self, max_age=None):
+        for target, queue in zip(self.targets, self._queues):
+            queue.put((target.flush, (max_age,)))
+        self.join()
+    
+    # Wait until every queued publication has been exported
+    def join(self):
+        for queue in self._queues:
+            queue.join()
+    
+    # The number of publications queued for each target, followed by
+    # the queue depths of the target itself, prefixed with its name
+    def get_queue_depths(self):
+        depths = OrderedDict()
+        for target, queue in zip(self.targets, self._queues):
+            name = describe(target)
+            depths["{0} queue".format(name)] = queue.qsize()
+            for stage, depth in target.get_queue_depths().items():
+                depths["{0} {1}".format(name, stage)] = depth
+        return depths
+    
+    # Re-read the data cached for publications that were added or
+    # modified. The extractor is only used by the calling thread, so
+    # it is not necessary to wait for the targets.
+    def refresh(self, pub_ids):
+        self.extractor.refresh(pub_ids)
+    
+    # Export the publications still queued, and close each target
+    # (uploading its last batch) in its own thread. Raises an exception
+    # if any target failed to export a publication or to close.
+    def close(self):
+        for target, queue in zip(self.targets, self._queues):
+            queue.put((target.close, ()))
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        failed = list((target, errors) for target, errors in zip(self.targets, self._errors)
+            if len(errors) > 0)
+        if len(failed) > 0:
+            raise Exception("Export failed: {0}".format("; ".join(
+                "{0} errors exporting to {1}".format(len(errors), describe(target))
+                for target, errors in failed)))
+
+# Describe a target in log messages
+def describe(target):
+    if hasattr(target, "library_id"):
+        return "Zotero {0} library {1}".format(target.library_type, target.library_id)
+    return type(target.writer).__name__
@@ -0,0 +1,204 @@
+# Full-text extraction and search of attached PDFs.
+#
+# Text is extracted with a pure-Python PDF reader (pypdf, or the
+# older PyPDF2), using a pool of worker processes. Extracted text
+# is stored zlib-compressed in a sidecar SQLite database, keyed by
+# path and modification time, so that update() only extracts files
+# that are new or have changed since the last update. The text is
+# also added to a contentless FTS5 table for searching.
+
+from collections import namedtuple
+from itertools import islice
+import logging as log
+from multiprocessing import Pool
+import os
+import re
+import sqlite3
+import time
+import zlib
+
+INDEX_FILE = "fulltext.sqlite"
+
+PDF_MIME_TYPE = "application/pdf"
+
+# Number of extracted files to write to the index per transaction
+COMMIT_SIZE = 50
+
+# A search result; score is the BM25 rank (lower is better)
+FullTextHit = namedtuple("FullTextHit", ("id", "path", "score"))
+
+# Summary of an index update
+IndexStats = namedtuple("IndexStats", ("files", "pages", "errors", "seconds"))
+
+# Get the PDF reader class, or None if no PDF library is installed.
+# The library is imported on first use since it is slow to import.
+def get_pdf_reader():
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        try:
+            from PyPDF2 import PdfFileReader as PdfReader
+        except ImportError:
+            PdfReader = None
+    return PdfReader
+
+# Extract the text of a PDF. Runs in a worker process, so the text
+# is compressed before it is sent back. Returns a tuple
+# (path, mtime, pages, compressed text, error message).
+def extract_text(task):
+    path, mtime = task
+    try:
+        with open(path, "rb") as i:
+            reader = get_pdf_reader()(i)
+            pages = reader.pages if hasattr(reader, 'pages') else list(
+                reader.getPage(n) for n in range(reader.getNumPages()))
+            text = []
+            for page in pages:
+                if hasattr(page, 'extract_text'):
+                    text.append(page.extract_text() or u"")
+                else:
+                    text.append(page.extractText() or u"")
+        text = u"\n".join(text)
+        return (path, mtime, len(pages), zlib.compress(text.encode('utf-8')), None)
+    except Exception as e:
+        return (path, mtime, 0, None, "{0}: {1}".format(type(e).__name__, e))
+
+class FullTextIndex(object):
+    def __init__(self, papers2, filename=None):
+        if get_pdf_reader() is None:
+            raise Exception("Full-text indexing requires the pypdf or PyPDF2 package")
+        self.papers2 = papers2
+        self.filename = filename or papers2.get_cache_file(INDEX_FILE)
+        self._conn = sqlite3.connect(self.filename)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                pub_id INTEGER,
+                mtime REAL,
+                pages INTEGER,
+                text BLOB,
+                error TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(text, content='');
+        """)
+    
+    def close(self):
+        self._conn.close()
+    
+    # Returns a dict mapping the path of each PDF attachment to
+    # its (publication ID, modification time, size). Missing files
+    # are skipped.
+    def _get_files(self):
+        files = {}
+        missing = 0
+        for a in self.papers2.get_pub_attachments():
+            if a.mime_type not in (None, PDF_MIME_TYPE):
+                continue
+            path = self.papers2.get_attachment_path(a.path)
+            try:
+                st = os.stat(path)
+                files[path] = (a.object_id, st.st_mtime, st.st_size)
+            except OSError:
+                log.debug("Attachment does not exist: {0}".format(path))
+                missing += 1
+        if missing > 0:
+            log.warning("{0} attachments do not exist".format(missing))
+        return files
+    
+    # Extract the text of all new and changed PDFs using the given
+    # number of worker processes (defaults to the number of CPUs).
+    # Returns an IndexStats summary.
+    def update(self, processes=None):
+        start = time.time()
+        files = self._get_files()
+        indexed = dict((path, (row_id, mtime)) for row_id, path, mtime in
+            self._conn.execute("SELECT id, path, mtime FROM files"))
+        
+        with self._conn:
+            for path, (row_id, mtime) in indexed.iteritems():
+                if path not in files:
+                    self._delete(row_id)
+        
+        tasks = list((path, mtime) for path, (pub_id, mtime, size) in files.iteritems()
+            if path not in indexed or indexed[path][1] != mtime)
+        # extract the largest files first so that one big file
+        # doesn't hold up the end of the run
+        tasks.sort(key=lambda t: files[t[0]][2], reverse=True)
+        
+        num_files = num_pages = num_errors = 0
+        if len(tasks) > 0:
+            pool = Pool(processes)
+            try:
+                results = pool.imap_unordered(extract_text, tasks)
+                while num_files < len(tasks):
+                    with self._conn:
+                        for path, mtime, pages, text, error in islice(results, COMMIT_SIZE):
+                            if path in indexed:
+                                self._delete(indexed[path][0])
+                            self._add(path, files[path][0], mtime, pages, text, error)
+                            num_files += 1
+                            num_pages += pages
+                            if error is not None:
+                                num_errors += 1
+                                log.warning("Could not extract text from {0}: {1}".format(path, error))
+                    
+                    elapsed = time.time() - start
+                    log.info("Extracted {0}/{1} files ({2:.1f} pages/sec)".format(
+                        num_files, len(tasks), num_pages / max(elapsed, 1e-6)))
+            finally:
+                pool.close()
+                pool.join()
+        
+        stats = IndexStats(num_files, num_pages, num_errors, time.time() - start)
+        log.info("Full-text index updated: {0} files, {1} pages, {2} errors in {3:.1f} seconds "\
+            "({4:.1f} pages/sec)".format(stats.files, stats.pages, stats.errors, stats.seconds,
+            stats.pages / max(stats.seconds, 1e-6)))
+        return stats
+    
+    # Drop all extracted text and re-extract every PDF
+    def rebuild(self, processes=None):
+        with self._conn:
+            self._conn.execute("DELETE FROM files")
+            self._conn.execute("INSERT INTO fts (fts) VALUES ('delete-all')")
+        return self.update(processes)
+    
+    def _add(self, path, pub_id, mtime, pages, text, error):
+        cursor = self._conn.execute("INSERT INTO files (path, pub_id, mtime, pages, text, error) "\
+            "VALUES (?, ?, ?, ?, ?, ?)", (path, pub_id, mtime, pages,
+            None if text is None else sqlite3.Binary(text), error))
+        if text is not None:
+            self._conn.execute("INSERT INTO fts (rowid, text) VALUES (?, ?)",
+                (cursor.lastrowid, zlib.decompress(text).decode('utf-8')))
+    
+    def _delete(self, row_id):
+        # a contentless FTS5 table needs the original text to delete a row
+        text = self.get_text(row_id)
+        if text is not None:
+            self._conn.execute("INSERT INTO fts (fts, rowid, text) VALUES ('delete', ?, ?)",
+                (row_id, text))
+        self._conn.execute("DELETE FROM files WHERE id = ?", (row_id,))
+    
+    # Get the extracted text of a file, by index row ID or path
+    def get_text(self, key):
+        column = "path" if isinstance(key, basestring) else "id"
+        row = self._conn.execute("SELECT text FROM files WHERE {0} = ?".format(column),
+            (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8')
+    
+    # Search the text of all indexed PDFs. Returns a list of
+    # FullTextHits, best match first.
+    def search(self, query, limit=20):
+        sql = "SELECT files.pub_id, files.path, fts.rank FROM fts "\
+              "JOIN files ON files.id = fts.rowid WHERE fts MATCH ? "\
+              "ORDER BY fts.rank LIMIT ?"
+        try:
+            rows = self._conn.execute(sql, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            terms = re.findall(r"\w+", query, re.UNICODE)
+            if len(terms) == 0:
+                return []
+            query = " ".join('"{0}"'.format(t) for t in terms)
+            rows = self._conn.execute(sql, (query, limit)).fetchall()
+        return list(FullTextHit(*row) for row in rows)
@@ -0,0 +1,179 @@
+# Indexes for the queries used during export.
+#
+# The per-publication accessors in schema.py look up rows of related
+# tables by publication (e.g. OrderedAuthor.object_id), and the bulk
+# accessors read those tables ordered by publication. The Papers2
+# schema does not necessarily index these columns, in which case
+# SQLite scans the whole table (or builds a temporary index) for every
+# query. IndexAdvisor inspects the plan of each accessor's query with
+# EXPLAIN QUERY PLAN and, where the query scans its table or sorts its
+# results, creates an index that covers the query. Indexes are only
+# ever created on a snapshot of the database (Papers2(snapshot=True)),
+# never on the original.
+
+from collections import namedtuple
+import logging as log
+import time
+
+from .schema import IDSource
+
+# Max number of publications to run per-publication accessors for
+# when timing them
+SAMPLE_SIZE = 200
+
+# An accessor: name, the table it reads, the columns of the index that
+# covers it, and a function (papers2, sample) -> list of queries, where
+# sample is a Sample of values from the database.
+Accessor = namedtuple("Accessor", ("name", "table", "columns", "queries"))
+
+# Values used to build sample queries
+Sample = namedtuple("Sample", ("pubs", "keyword", "author", "collection"))
+
+# Result of optimizing one accessor. Times are the total time, in ms,
+# to execute its queries before and after the index was created;
+# index is None if no index was needed.
+IndexReport = namedtuple("IndexReport", ("accessor", "index", "plan_before", "plan_after",
+    "ms_before", "ms_after"))
+
+def _each_pub(fn):
+    return lambda papers2, sample: list(fn(papers2, pub) for pub in sample.pubs)
+
+def _attachments(papers2, pub):
+    PDF = papers2.get_table("PDF")
+    return papers2.get_session().query(PDF).filter(PDF.object_id == pub.ROWID
+        ).order_by(PDF.is_primary.desc())
+
+ACCESSORS = (
+    Accessor("get_pub_authors", "OrderedAuthor", ("object_id", "priority", "author_id", "type"),
+        _each_pub(lambda p, pub: p.get_pub_authors(pub))),
+    Accessor("get_ordered_authors", "OrderedAuthor", ("object_id", "priority", "author_id", "type"),
+        lambda p, s: [p.get_ordered_authors()]),
+    Accessor("get_keywords", "KeywordItem", ("object_id", "type", "keyword_id"),
+        _each_pub(lambda p, pub: p.get_keywords(pub))),
+    Accessor("get_pub_keywords", "KeywordItem", ("object_id", "type", "keyword_id"),
+        lambda p, s: [p.get_pub_keywords()]),
+    Accessor("get_collections", "CollectionItem", ("object_id", "collection"),
+        _each_pub(lambda p, pub: p.get_collections(pub))),
+    Accessor("get_attachments", "PDF", ("object_id", "is_primary", "path", "mime_type"),
+        _each_pub(_attachments)),
+    Accessor("get_pub_attachments", "PDF", ("object_id", "is_primary", "path", "mime_type"),
+        lambda p, s: [p.get_pub_attachments()]),
+    Accessor("get_reviews", "Review", ("object_id", "is_mine"),
+        _each_pub(lambda p, pub: p.get_reviews(pub))),
+    Accessor("get_identifiers", "SyncEvent", ("device_id", "source_id", "remote_id"),
+        _each_pub(lambda p, pub: p.get_identifiers(pub, IDSource.PUBMED))),
+    Accessor("get_urls", "SyncEvent", ("device_id", "updated_at"),
+        _each_pub(lambda p, pub: p.get_urls(pub))),
+    Accessor("get_publications(keywords)", "KeywordItem", ("keyword_id", "object_id"),
+        lambda p, s: [p.get_publications(keywords=[s.keyword])] if s.keyword else []),
+    Accessor("get_publications(authors)", "OrderedAuthor", ("author_id", "object_id"),
+        lambda p, s: [p.get_publications(authors=[s.author])] if s.author else []),
+    Accessor("get_publications(collections)", "CollectionItem", ("collection", "object_id"),
+        lambda p, s: [p.get_publications(collections=[s.collection])] if s.collection else [])
+)
+
+def index_name(table, columns):
+    return "papers2_{0}_{1}".format(table, "_".join(columns)).lower()
+
+class IndexAdvisor(object):
+    def __init__(self, papers2, sample_size=SAMPLE_SIZE):
+        if papers2.database == papers2.db:
+            raise Exception("Indexes can only be created on a snapshot of the Papers2 database")
+        self.papers2 = papers2
+        self.sample_size = sample_size
+        self._conn = papers2.engine.raw_connection()
+    
+    def close(self):
+        self._conn.close()
+    
+    def _get_sample(self):
+        p = self.papers2
+        Keyword = p.get_table("Keyword")
+        Author = p.get_table("Author")
+        keyword = p.get_session().query(Keyword.name).first()
+        author = p.get_session().query(Author.surname).filter(Author.surname != None).first()
+        collections = p.get_collection_paths()
+        return Sample(
+            p.get_publications().limit(self.sample_size).all(),
+            keyword[0] if keyword else None,
+            author[0] if author else None,
+            collections.values()[0][-1] if len(collections) > 0 else None)
+    
+    # Compile a query into (SQL, parameters)
+    def _compile(self, query):
+        compiled = query.statement.compile(dialect=self.papers2.engine.dialect)
+        return (unicode(compiled), list(compiled.params[name] for name in compiled.positiontup))
+    
+    def _explain(self, sql, params):
+        cursor = self._conn.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN {0}".format(sql), params)
+        return list(row[-1] for row in cursor.fetchall())
+    
+    # Total time, in ms, to execute the compiled queries
+    def _time(self, compiled):
+        cursor = self._conn.cursor()
+        start = time.time()
+        for sql, params in compiled:
+            cursor.execute(sql, params)
+            cursor.fetchall()
+        return (time.time() - start) * 1000
+    
+    # Returns True if a plan scans the table without an index, or
+    # has SQLite build a temporary (automatic) index on it
+    def _needs_index(self, plan, table):
+        for step in plan:
+            words = step.replace(" TABLE ", " ").split()
+            if len(words) < 2 or words[1] != table:
+                continue
+            if words[0] == "SCAN" and "INDEX" not in words:
+                return True
+            if "AUTOMATIC" in words:
+                return True
+        return False
+    
+    def _get_indexes(self):
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        return set(row[0] for row in cursor.fetchall())
+    
+    # Explain and time every accessor's queries, then create the
+    # indexes that are needed, then time the queries again, so that
+    # the times before are not affected by indexes created for other
+    # accessors on the same table. Returns a list of IndexReports.
+    def optimize(self):
+        sample = self._get_sample()
+        existing = self._get_indexes()
+        accessors = []
+        for accessor in ACCESSORS:
+            compiled = list(self._compile(q) for q in accessor.queries(self.papers2, sample))
+            if len(compiled) > 0:
+                accessors.append((accessor, compiled))
+        before = list((self._explain(*compiled[0]), self._time(compiled))
+            for accessor, compiled in accessors)
+        
+        indexes = []
+        for (accessor, compiled), (plan, ms) in zip(accessors, before):
+            index = None
+            if self._needs_index(plan, accessor.table):
+                index = index_name(accessor.table, accessor.columns)
+                if index not in existing:
+                    log.info("Creating index {0}".format(index))
+                    self._conn.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+                        index, accessor.table, ", ".join(accessor.columns)))
+                    self._conn.commit()
+                    existing.add(index)
+            indexes.append(index)
+        
+        return list(IndexReport(accessor.name, index, plan, self._explain(*compiled[0]),
+                ms, self._time(compiled))
+            for (accessor, compiled), (plan, ms), index in zip(accessors, before, indexes))
+
+# Format IndexReports as a table
+def format_reports(reports):
+    lines = ["{0:<32} {1:>10} {2:>10} {3:>8}  {4}".format(
+        "accessor", "before ms", "after ms", "speedup", "index")]
+    for r in reports:
+        lines.append("{0:<32} {1:10.1f} {2:10.1f} {3:7.1f}x  {4}".format(
+            r.accessor, r.ms_before, r.ms_after, r.ms_before / max(r.ms_after, 0.001),
+            r.index or "-"))
+    return "\n".join(lines)
@@ -0,0 +1,137 @@
+# Reporting the progress of an export.
+#
+# The export loop and the importers only add to a util.Counters as
+# they go (publications read, items exported, and requests and bytes
+# sent while uploading), which costs one lock per publication or
+# request. A Progress thread samples the counters and the queue
+# depths of the importer every few seconds, computes the rates since
+# the previous sample and the time remaining, and shows them on a
+# terminal line and/or writes them to a JSON status file that other
+# programs can poll; nothing is formatted in the export loop itself.
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import logging as log
+import threading
+import time
+
+from .util import Counters, dump_atomic
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 2.0
+
+# Counters that are reported, with their rates
+COUNTERS = ("pubs", "exported", "requests", "bytes")
+
+def write_json(obj, fh):
+    json.dump(obj, fh, indent=2, separators=(',', ': '))
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return "{0:.1f} {1}".format(n, unit)
+        n /= 1024.0
+    return "{0:.1f} GB".format(n)
+
+def format_status(status):
+    parts = []
+    if status['total'] is not None and status['total'] > 0:
+        parts.append("{0}/{1} publications ({2:.0%})".format(status['pubs'], status['total'],
+            min(float(status['pubs']) / status['total'], 1)))
+    else:
+        parts.append("{0} publications".format(status['pubs']))
+    rates = status['rates']
+    parts.append("{0} items exported".format(status['exported']))
+    parts.append("{0:.1f} pubs/s, {1:.1f} items/s, {2:.1f} requests/s, {3}/s".format(
+        rates['pubs'], rates['exported'], rates['requests'], format_bytes(rates['bytes'])))
+    if status['eta'] is not None and status['pubs'] < status['total']:
+        parts.append("ETA {0}".format(timedelta(seconds=int(status['eta']))))
+    elif status['eta'] is not None:
+        parts.append("finishing uploads")
+    elif status['done']:
+        parts.append("done in {0}".format(timedelta(seconds=int(status['elapsed']))))
+    if len(status['queues']) > 0:
+        parts.append("queued: {0}".format(", ".join("{0} {1}".format(name, depth)
+            for name, depth in status['queues'].iteritems())))
+    return " | ".join(parts)
+
+# Reports progress every interval seconds, until closed. total is
+# the number of publications to be read, if known. get_queue_depths
+# is a function returning the number of items waiting at each stage
+# of the export (e.g. ZoteroImporter.get_queue_depths). The status is
+# shown on stream (on a single line, if it is a terminal) and/or
+# written to status_file.
+class Progress(object):
+    def __init__(self, total=None, counters=None, get_queue_depths=None,
+            interval=PROGRESS_INTERVAL, stream=None, status_file=None):
+        self.total = total
+        self.counters = counters if counters is not None else Counters()
+        self.get_queue_depths = get_queue_depths
+        self.interval = interval
+        self.stream = stream
+        self.is_terminal = stream is not None and hasattr(stream, "isatty") and stream.isatty()
+        self.status_file = status_file
+        self._started = time.time()
+        self._last = (self._started, {})
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                log.error("Error reporting progress", exc_info=e)
+    
+    # Sample the counters and queue depths. Rates are per second since
+    # the previous sample. The time remaining (eta, in seconds) assumes
+    # that the remaining publications are read at the average rate so
+    # far; it does not include uploading the last batches.
+    def get_status(self, done=False):
+        now = time.time()
+        counts = self.counters.snapshot()
+        last_time, last_counts = self._last
+        self._last = (now, counts)
+        elapsed = now - self._started
+        window = max(now - last_time, 1e-3)
+        pubs = counts.get("pubs", 0)
+        eta = None
+        if not done and self.total is not None and pubs > 0:
+            eta = max(self.total - pubs, 0) * elapsed / pubs
+        status = OrderedDict((
+            ("time", datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+            ("elapsed", elapsed),
+            ("done", done),
+            ("total", self.total)))
+        for name in COUNTERS:
+            status[name] = counts.get(name, 0)
+        status['rates'] = OrderedDict((name,
+            (counts.get(name, 0) - last_counts.get(name, 0)) / window) for name in COUNTERS)
+        status['eta'] = eta
+        status['queues'] = self.get_queue_depths() if self.get_queue_depths is not None \
+            else OrderedDict()
+        return status
+    
+    def report(self, done=False):
+        status = self.get_status(done)
+        if self.stream is not None:
+            line = format_status(status)
+            if self.is_terminal:
+                # redraw the line in place; the cursor is left at its
+                # start, so that log messages overwrite it
+                self.stream.write("\r\x1b[K{0}{1}".format(line, "\n" if done else "\r"))
+            else:
+                self.stream.write("{0}\n".format(line))
+            self.stream.flush()
+        if self.status_file is not None:
+            dump_atomic(status, self.status_file, write_json)
+        return status
+    
+    # Stop reporting, and make a final report
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        return self.report(done=True)
@@ -0,0 +1,124 @@
+# Local cache of the items in a Zotero library.
+#
+# The cache is used to find Papers2 publications that already exist
+# in the target library (for example because a checkpoint file was
+# lost, or the library was exported from another machine). Items are
+# downloaded once and then kept up to date incrementally, using the
+# library version: each sync only requests the items that were
+# modified or deleted since the last one. Items are indexed by DOI
+# and by normalized title and year.
+
+from collections import namedtuple
+import logging as log
+from multiprocessing.pool import ThreadPool
+import os
+import pickle
+import re
+
+from .dedup import normalize_doi, normalize_title
+from .util import dump_atomic
+
+# Max number of items the Zotero API returns per request
+PAGE_SIZE = 50
+
+# Item types that are never matched against publications
+CHILD_ITEM_TYPES = ('note', 'attachment', 'annotation')
+
+# An existing Zotero item
+RemoteItem = namedtuple("RemoteItem", ("key", "version", "doi", "title", "year"))
+
+def get_year(date):
+    if date:
+        match = re.search(r"\d{4}", date)
+        if match is not None:
+            return int(match.group(0))
+    return None
+
+# Convert Zotero item data into a RemoteItem
+def remote_item(data):
+    return RemoteItem(data['key'], data.get('version'), normalize_doi(data.get('DOI')),
+        normalize_title(data.get('title')), get_year(data.get('date')))
+
+# new_client is a function that returns a new pyzotero client for
+# the library; each request thread uses its own client. library
+# identifies the library (e.g. its type and ID); a cache file that
+# was written for another library is discarded, since syncing it
+# from that library's version would miss most of the items.
+class RemoteLibrary(object):
+    def __init__(self, new_client, filename=None, threads=4, library=None):
+        self.new_client = new_client
+        self.client = new_client()
+        self.filename = filename
+        self.threads = threads
+        self.library = library
+        self.version = 0
+        self.items = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "rb") as i:
+                cache = pickle.load(i)
+            if isinstance(cache, dict) and cache.get('library') == library:
+                self.version, self.items = cache['version'], cache['items']
+            else:
+                log.warning("Discarding library cache {0}, which was written for another library "\
+                    "or by an older version".format(filename))
+        self._index()
+    
+    def _index(self):
+        self._by_doi = {}
+        self._by_title = {}
+        for item in self.items.itervalues():
+            if item.doi is not None:
+                self._by_doi[item.doi] = item
+            if len(item.title) > 0:
+                self._by_title[(item.title, item.year)] = item
+    
+    # Download all items that were added, modified or deleted
+    # since the last sync. Returns the number of changed items.
+    def sync(self):
+        # child items (notes and attachments) are never matched
+        versions = self.client.top(since=self.version, format='versions', limit=None)
+        version = int(self.client.request.headers.get('last-modified-version', self.version))
+        keys = list(key for key, v in versions.iteritems()
+            if key not in self.items or self.items[key].version != v)
+        
+        def fetch(chunk):
+            return self.new_client().items(itemKey=",".join(chunk), limit=PAGE_SIZE)
+        chunks = list(keys[i:i+PAGE_SIZE] for i in xrange(0, len(keys), PAGE_SIZE))
+        pool = ThreadPool(self.threads)
+        try:
+            for page in pool.map(fetch, chunks):
+                for item in page:
+                    data = item['data']
+                    if data.get('itemType') in CHILD_ITEM_TYPES:
+                        self.items.pop(data['key'], None)
+                    else:
+                        self.items[data['key']] = remote_item(data)
+        finally:
+            pool.close()
+        
+        if self.version > 0:
+            for key in self.client.deleted(since=self.version).get('items', ()):
+                self.items.pop(key, None)
+        
+        log.info("Synced Zotero library from version {0} to {1}: {2} items changed".format(
+            self.version, version, len(keys)))
+        self.version = version
+        self._index()
+        self.save()
+        return len(keys)
+    
+    def save(self):
+        if self.filename is not None:
+            dump_atomic(dict(library=self.library, version=self.version, items=self.items),
+                self.filename)
+    
+    # Find the existing item that matches a Zotero item dict, first by
+    # DOI and then by title and year. Returns a RemoteItem or None.
+    def match(self, item):
+        doi = normalize_doi(item.get('DOI'))
+        if doi is not None and doi in self._by_doi:
+            return self._by_doi[doi]
+        title = normalize_title(item.get('title'))
+        if len(title) > 0:
+            return self._by_title.get((title, get_year(item.get('date'))))
+        return None
@@ -5,15 +5,17 @@
 # a list (list(query)).
 
 from collections import namedtuple
+import hashlib
+import logging as log
 import os
+import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import Session
-from sqlalchemy.sql.expression import or_
-
+from . import dates
 from .util import enum
 
+# SQLAlchemy is imported when a database is first opened,
+# so that importing this module is cheap.
+
 PubAttrs = namedtuple("PubAttrs", ("name", "id"))
 PubType = enum('PubType',
     BOOK=               PubAttrs("Book",                0),
@@ -58,38 +60,114 @@ Label = enum("Label",
 )
 label_num_to_label = dict((l.num, l) for l in Label.__values__)
 
+# Convert a local datetime to a POSIX timestamp, keeping its
+# microseconds (which timetuple drops)
+def to_timestamp(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
 # High-level iterface to the Papers2 database. Unless otherwise noted,
 # query methods return a Query object, which can either be iterated 
 # over or all rows can be fetched by calling the .all() method.
+#
+# Derived data (such as search indexes) is never written to the
+# Papers2 database; it is stored in sidecar files under cache_folder.
+# If snapshot is "copy" (or True), queries are run against a copy of
+# the database in cache_folder rather than the database itself; if it
+# is "transaction", they are all run in a single read transaction on
+# the database (see snapshot.py). self.database is the path of the
+# database that is actually read, self.snapshot is the snapshot mode
+# used (or None), self.snapshot_seconds is the time taken to make the
+# snapshot, and self.lock_stats counts the statements run on the
+# Papers2 database and the time they spent waiting for locks.
 class Papers2(object):
-    def __init__(self, folder="~/Papers2"):
+    def __init__(self, folder="~/Papers2", cache_folder="~/.papers2", snapshot=False):
+        from sqlalchemy.ext.automap import automap_base
+        from .snapshot import (COPY, TRANSACTION, SNAPSHOT_FILE, LockStats, create_engine,
+            is_wal, snapshot_database)
         db = os.path.abspath(os.path.expanduser(os.path.join(
             folder, "Library.papers2", "Database.papersdb")))
-        self.engine = create_engine("sqlite:///{0}".format(os.path.abspath(db)))
+        self.db = db
         self.folder = folder
+        self.cache_folder = cache_folder
+        self.database = db
+        self.snapshot = COPY if snapshot is True else (snapshot or None)
+        self.snapshot_seconds = 0
+        self.lock_stats = LockStats()
+        start = time.time()
+        if self.snapshot == TRANSACTION and not is_wal(db, self.lock_stats):
+            log.warning("The Papers2 database is not in WAL mode, so a read transaction "\
+                "would stop Papers2 from saving changes; reading a copy instead")
+            self.snapshot = COPY
+        if self.snapshot == COPY:
+            self.database = snapshot_database(db, self.get_cache_file(SNAPSHOT_FILE),
+                stats=self.lock_stats)
+            # reads of the copy are not counted
+            self.engine = create_engine(self.database, LockStats())
+        else:
+            self.engine = create_engine(self.database, self.lock_stats,
+                transaction=self.snapshot == TRANSACTION)
+        if self.snapshot is not None:
+            self.snapshot_seconds = time.time() - start
         self.schema = automap_base()
         self.schema.prepare(self.engine, reflect=True)
         self._session = None
         self._cache = dict(
             bundle={}
         )
+        self._search_index = None
+        self._export_view = None
     
     def close(self):
         if self._session is not None:
             self._session.close()
+        from .snapshot import TRANSACTION, release_engine
+        if self.snapshot == TRANSACTION:
+            release_engine(self.engine)
+        if self._search_index is not None:
+            self._search_index.close()
+        if self._export_view is not None:
+            self._export_view.close()
+    
+    # Get the path of a sidecar file for this library. Files for
+    # different libraries are kept in separate subfolders of the
+    # cache folder.
+    def get_cache_file(self, name):
+        folder = os.path.join(os.path.expanduser(self.cache_folder),
+            hashlib.md5(self.db.encode('utf-8')).hexdigest()[0:8])
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, name)
     
     def get_session(self):
         if self._session is None:
+            from sqlalchemy.orm import Session
             self._session = Session(self.engine)
         return self._session
     
     def get_table(self, name):
         return self.schema.classes.get(name)
     
-    # Get all publications matching specified criteria.
+    # Get all publications matching specified criteria. In addition
+    # to the publication type and flags, publications can be selected by:
+    # * collections: names of collections; publications in these
+    #   collections or any of their subcollections are selected
+    # * keywords: keyword names
+    # * labels: Label values
+    # * authors: author surnames (case-insensitive)
+    # * published_from, published_to: ISO 8601 dates or partial dates
+    #   (e.g. "2004" or "2004-06"); both bounds are inclusive
+    # * imported_from, imported_to: datetimes
+    # * min_times_read, max_times_read
+    # All criteria are evaluated by SQLite; criteria on related tables
+    # are compiled into subqueries.
     def get_publications(self, row_ids=None, types=None, 
-            include_deleted=False, include_duplicates=False, include_manuscripts=False):
+            include_deleted=False, include_duplicates=False, include_manuscripts=False,
+            collections=None, keywords=None, labels=None, authors=None,
+            published_from=None, published_to=None, imported_from=None, imported_to=None,
+            min_times_read=None, max_times_read=None):
+        from sqlalchemy import func
         Publication = self.get_table("Publication")
+        session = self.get_session()
         criteria = [
             Publication.citekey != None,
             Publication.imported_date != None
@@ -111,7 +189,52 @@ class Papers2(object):
         if not include_manuscripts:
             criteria.append(Publication.manuscript == False)
             
-        q = self.get_session().query(Publication)
+        if collections is not None:
+            CollectionItem = self.get_table("CollectionItem")
+            names = set(collections)
+            collection_ids = list(row_id for row_id, path in self.get_collection_paths().iteritems()
+                if len(names.intersection(path)) > 0)
+            criteria.append(Publication.ROWID.in_(
+                session.query(CollectionItem.object_id).filter(
+                    CollectionItem.collection.in_(collection_ids))))
+        
+        if keywords is not None:
+            Keyword = self.get_table("Keyword")
+            KeywordItem = self.get_table("KeywordItem")
+            criteria.append(Publication.ROWID.in_(
+                session.query(KeywordItem.object_id).filter(KeywordItem.keyword_id.in_(
+                    session.query(Keyword.ROWID).filter(Keyword.name.in_(keywords))))))
+        
+        if labels is not None:
+            criteria.append(Publication.label.in_(list(l.num for l in labels)))
+        
+        if authors is not None:
+            Author = self.get_table("Author")
+            OrderedAuthor = self.get_table("OrderedAuthor")
+            criteria.append(Publication.ROWID.in_(
+                session.query(OrderedAuthor.object_id).filter(OrderedAuthor.author_id.in_(
+                    session.query(Author.ROWID).filter(
+                        func.lower(Author.surname).in_(list(a.lower() for a in authors)))))))
+        
+        if published_from is not None or published_to is not None:
+            pub_date = func.substr(Publication.publication_date, 3, 8)
+            if published_from is not None:
+                criteria.append(pub_date >= dates.to_bound(published_from))
+            if published_to is not None:
+                criteria.append(pub_date <= dates.to_bound(published_to, upper=True))
+        
+        # imported_date is a POSIX timestamp
+        if imported_from is not None:
+            criteria.append(Publication.imported_date >= to_timestamp(imported_from))
+        if imported_to is not None:
+            criteria.append(Publication.imported_date <= to_timestamp(imported_to))
+        
+        if min_times_read is not None:
+            criteria.append(Publication.times_read >= min_times_read)
+        if max_times_read is not None:
+            criteria.append(Publication.times_read <= max_times_read)
+        
+        q = session.query(Publication)
         if len(criteria) > 0:
             q = q.filter(*criteria)
         return q
@@ -157,6 +280,28 @@ class Papers2(object):
             ).filter(OrderedAuthor.object_id == pub.ROWID
             ).order_by(OrderedAuthor.priority)
     
+    # Get all authors in the library
+    def get_authors(self):
+        Author = self.get_table("Author")
+        return self.get_session().query(
+                Author.ROWID.label('id'),
+                Author.prename.label('prename'),
+                Author.surname.label('surname'),
+                Author.institutional.label('institutional'))
+    
+    # Get (object_id, author_id, type) rows for all publications
+    # (or only those in pub_ids), grouped by publication and in
+    # author order.
+    def get_ordered_authors(self, pub_ids=None):
+        OrderedAuthor = self.get_table("OrderedAuthor")
+        q = self.get_session().query(
+                OrderedAuthor.object_id.label('object_id'),
+                OrderedAuthor.author_id.label('author_id'),
+                OrderedAuthor.type.label('type'))
+        if pub_ids is not None:
+            q = q.filter(OrderedAuthor.object_id.in_(pub_ids))
+        return q.order_by(OrderedAuthor.object_id, OrderedAuthor.priority)
+    
     # Returns SyncEvents of the given source type as a list of IDs
     def get_identifiers(self, pub, id_source):
         SyncEvent = self.get_table("SyncEvent")
@@ -164,6 +309,17 @@ class Papers2(object):
             SyncEvent.device_id == pub.uuid,
             SyncEvent.source_id == id_source)
     
+    # Get (device_id, source_id, remote_id) rows for the identifiers of
+    # all publications from the given sources. device_id is the uuid
+    # of the publication.
+    def get_all_identifiers(self, id_sources):
+        SyncEvent = self.get_table("SyncEvent")
+        return self.get_session().query(
+                SyncEvent.device_id.label('device_id'),
+                SyncEvent.source_id.label('source_id'),
+                SyncEvent.remote_id.label('remote_id')
+            ).filter(SyncEvent.source_id.in_(id_sources))
+
     # Returns SyncEvents with remote_ids like urls ('http%'),
     # ordered by most recent
     def get_urls(self, pub):
@@ -183,7 +339,25 @@ class Papers2(object):
             ).filter(PDF.object_id == pub.ROWID
             ).order_by(PDF.is_primary.desc())
         # resolve relative path names
-        return ((os.path.join(self.folder, a.path), a.mime_type) for a in attachments)
+        return ((self.get_attachment_path(a.path), a.mime_type) for a in attachments)
+    
+    # Get (object_id, path, mime_type) rows for the attachments of all
+    # publications (or only those in pub_ids), grouped by publication
+    # with the primary attachment first. Paths are relative to the
+    # Papers2 folder; see get_attachment_path.
+    def get_pub_attachments(self, pub_ids=None):
+        PDF = self.get_table("PDF")
+        q = self.get_session().query(
+                PDF.object_id.label('object_id'),
+                PDF.path.label('path'),
+                PDF.mime_type.label('mime_type'))
+        if pub_ids is not None:
+            q = q.filter(PDF.object_id.in_(pub_ids))
+        return q.order_by(PDF.object_id, PDF.is_primary.desc())
+    
+    # Resolve the path of an attachment relative to the Papers2 folder
+    def get_attachment_path(self, path):
+        return os.path.join(os.path.expanduser(self.folder), path)
     
     def get_keywords(self, pub, kw_type=None):
         Keyword = self.get_table("Keyword")
@@ -193,7 +367,26 @@ class Papers2(object):
             ).filter(KeywordItem.object_id == pub.ROWID)
         if kw_type is not None:
             q = q.filter(KeywordItem.type == kw_type)
-        return q
+        # keep the order stable whichever index is used
+        return q.order_by(KeywordItem.ROWID)
+    
+    # Get (object_id, keyword_id, type, name) rows for the keywords
+    # of all publications (or only those in pub_ids), grouped by
+    # publication.
+    def get_pub_keywords(self, pub_ids=None, kw_type=None):
+        Keyword = self.get_table("Keyword")
+        KeywordItem = self.get_table("KeywordItem")
+        q = self.get_session().query(
+                KeywordItem.object_id.label('object_id'),
+                KeywordItem.keyword_id.label('keyword_id'),
+                KeywordItem.type.label('type'),
+                Keyword.name.label('name')
+            ).join(Keyword, Keyword.ROWID == KeywordItem.keyword_id)
+        if pub_ids is not None:
+            q = q.filter(KeywordItem.object_id.in_(pub_ids))
+        if kw_type is not None:
+            q = q.filter(KeywordItem.type == kw_type)
+        return q.order_by(KeywordItem.object_id, KeywordItem.ROWID)
     
     def get_collections(self, pub=None):
         Collection = self.get_table("Collection")
@@ -201,13 +394,53 @@ class Papers2(object):
         if pub is not None:
             CollectionItem = self.get_table("CollectionItem")
             q = q.join(CollectionItem, Collection.ROWID == CollectionItem.collection
-                ).filter(CollectionItem.object_id == pub.ROWID)
+                ).filter(CollectionItem.object_id == pub.ROWID
+                ).order_by(CollectionItem.ROWID)
         return q.filter(Collection.type.in_((0,5)))
     
+    # Get the path of every collection, as a tuple of collection
+    # names from the top-level collection down, keyed by collection
+    # ROWID. Collection.parent holds the uuid of the parent collection;
+    # parents that are not user collections are ignored.
+    def get_collection_paths(self):
+        collections = list(self.get_collections())
+        by_uuid = dict((c.uuid, c) for c in collections)
+        paths = {}
+        def get_path(c, seen=()):
+            if c.ROWID not in paths:
+                parent = by_uuid.get(c.parent)
+                if parent is None or parent.ROWID in seen:
+                    paths[c.ROWID] = (c.name,)
+                else:
+                    paths[c.ROWID] = get_path(parent, seen + (c.ROWID,)) + (c.name,)
+            return paths[c.ROWID]
+        for c in collections:
+            get_path(c)
+        return paths
+    
     def get_reviews(self, pub, mine_only=True):
         Review = self.get_table("Review")
         q = self.get_session().query(Review
             ).filter(Review.object_id == pub.ROWID)
         if mine_only:
             q = q.filter(Review.is_mine == 1)
-        return q
\ No newline at end of file
+        return q
+    
+    # Search titles, abstracts, authors, keywords, notes and bundle
+    # names. The search index is brought up to date on the first
+    # search. Returns a list of SearchHits, best match first.
+    def search(self, query, limit=20):
+        if self._search_index is None:
+            from .search import SearchIndex
+            self._search_index = SearchIndex(self)
+            self._search_index.update()
+        return self._search_index.search(query, limit)
+
+    # Get the materialized export view of the library (see view.py).
+    # The view is brought up to date the first time it is requested.
+    def get_export_view(self):
+        if self._export_view is None:
+            from .view import ExportView
+            self._export_view = ExportView(self)
+            self._export_view.update()
+        return self._export_view
@@ -0,0 +1,154 @@
+# Full-text search over a Papers2 library.
+#
+# The index is a sidecar SQLite database with an FTS5 table over
+# publication titles, abstracts, authors, keywords, notes and bundle
+# (e.g. journal) names. It is keyed by publication ROWID and records
+# each publication's updated_at time, so that update() only has to
+# re-index publications that were added or changed since the last
+# update. The Papers2 database itself is only ever read.
+
+from collections import namedtuple
+import logging as log
+import re
+import sqlite3
+import time
+
+# A search result. score is the BM25 rank; lower is better.
+SearchHit = namedtuple("SearchHit", ("id", "title", "score"))
+
+INDEX_FILE = "search.sqlite"
+
+# Indexed fields and their relative weights for ranking
+FIELDS = (
+    ("title",       10.0),
+    ("summary",     1.0),
+    ("authors",     5.0),
+    ("keywords",    3.0),
+    ("notes",       1.0),
+    ("bundle",      2.0)
+)
+
+# Number of publications to read from Papers2 at a time
+CHUNK_SIZE = 500
+
+class SearchIndex(object):
+    def __init__(self, papers2, filename=None):
+        self.papers2 = papers2
+        self.filename = filename or papers2.get_cache_file(INDEX_FILE)
+        self._conn = sqlite3.connect(self.filename)
+        try:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    id INTEGER PRIMARY KEY,
+                    updated_at REAL);
+                CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5({0});
+            """.format(", ".join(name for name, weight in FIELDS)))
+        except sqlite3.OperationalError as e:
+            raise Exception("Search requires a version of SQLite with FTS5 support: {0}".format(e))
+    
+    def close(self):
+        self._conn.close()
+    
+    # Bring the index up to date with the Papers2 database.
+    # Returns the number of publications (re-)indexed.
+    def update(self):
+        start = time.time()
+        Publication = self.papers2.get_table("Publication")
+        current = dict(self.papers2.get_publications().with_entities(
+            Publication.ROWID, Publication.updated_at))
+        indexed = dict(self._conn.execute("SELECT id, updated_at FROM docs"))
+        
+        removed = list(i for i in indexed if i not in current)
+        changed = list(i for i, updated_at in current.iteritems()
+            if i not in indexed or indexed[i] != updated_at)
+        changed.sort()
+        
+        authors = None
+        if len(changed) > 0:
+            authors = dict((a.id, a) for a in self.papers2.get_authors())
+        
+        with self._conn:
+            for i in xrange(0, len(removed), CHUNK_SIZE):
+                self._delete(removed[i:i+CHUNK_SIZE])
+            for i in xrange(0, len(changed), CHUNK_SIZE):
+                chunk = changed[i:i+CHUNK_SIZE]
+                self._delete(chunk)
+                self._index(chunk, authors)
+        
+        log.info("Search index updated in {0:.2f} seconds: {1} publications indexed, {2} removed".format(
+            time.time() - start, len(changed), len(removed)))
+        return len(changed)
+    
+    # Drop all indexed publications and rebuild the index
+    def rebuild(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM docs")
+            self._conn.execute("DELETE FROM fts")
+        return self.update()
+    
+    def _delete(self, pub_ids):
+        params = ",".join("?" * len(pub_ids))
+        self._conn.execute("DELETE FROM docs WHERE id IN ({0})".format(params), pub_ids)
+        self._conn.execute("DELETE FROM fts WHERE rowid IN ({0})".format(params), pub_ids)
+    
+    def _index(self, pub_ids, all_authors):
+        Publication = self.papers2.get_table("Publication")
+        pubs = list(self.papers2.get_publications(row_ids=pub_ids).with_entities(
+            Publication.ROWID, Publication.updated_at, Publication.title, Publication.summary,
+            Publication.notes, Publication.bundle, Publication.bundle_string))
+        
+        authors = {}
+        for pub_id, author_id, author_type in self.papers2.get_ordered_authors(pub_ids):
+            author = all_authors.get(author_id)
+            if author is not None:
+                authors.setdefault(pub_id, []).append(
+                    " ".join(filter(None, (author.prename, author.surname))))
+        
+        keywords = {}
+        for kw in self.papers2.get_pub_keywords(pub_ids):
+            keywords.setdefault(kw.object_id, []).append(kw.name)
+        
+        bundle_ids = set()
+        for pub in pubs:
+            try:
+                bundle_ids.add(int(pub.bundle))
+            except (TypeError, ValueError):
+                pass
+        bundles = {}
+        if len(bundle_ids) > 0:
+            bundles = dict(self.papers2.get_session().query(
+                    Publication.ROWID, Publication.title
+                ).filter(Publication.ROWID.in_(bundle_ids)))
+        
+        docs = []
+        rows = []
+        for pub in pubs:
+            try:
+                bundle = bundles.get(int(pub.bundle))
+            except (TypeError, ValueError):
+                bundle = None
+            docs.append((pub.ROWID, pub.updated_at))
+            rows.append((pub.ROWID, pub.title, pub.summary,
+                "; ".join(authors.get(pub.ROWID, ())),
+                "; ".join(keywords.get(pub.ROWID, ())),
+                pub.notes, bundle or pub.bundle_string))
+        
+        self._conn.executemany("INSERT INTO docs (id, updated_at) VALUES (?, ?)", docs)
+        self._conn.executemany("INSERT INTO fts (rowid, {0}) VALUES (?, ?, ?, ?, ?, ?, ?)".format(
+            ", ".join(name for name, weight in FIELDS)), rows)
+    
+    # Search the index. query may use the full FTS5 query syntax, e.g.
+    # 'title:chromatin AND authors:smith'; if it is not a valid FTS5
+    # query, each word is searched for as a plain term.
+    def search(self, query, limit=20):
+        sql = "SELECT rowid, title, bm25(fts, {0}) AS score FROM fts WHERE fts MATCH ? "\
+              "ORDER BY score LIMIT ?".format(", ".join(str(weight) for name, weight in FIELDS))
+        try:
+            rows = self._conn.execute(sql, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            terms = re.findall(r"\w+", query, re.UNICODE)
+            if len(terms) == 0:
+                return []
+            query = " ".join('"{0}"'.format(t) for t in terms)
+            rows = self._conn.execute(sql, (query, limit)).fetchall()
+        return list(SearchHit(*row) for row in rows)
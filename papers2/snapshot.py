@@ -0,0 +1,242 @@
+# Snapshots of the Papers2 database.
+#
+# Papers2 may be running (and writing to its database) while the
+# database is read. Each query then sees the database as it is when
+# the query runs, so a long export can combine rows from different
+# states, and queries have to wait whenever Papers2 holds a lock. A
+# snapshot gives every query the same, consistent state, either as a
+# copy of the database, stored with the other sidecar files, that can
+# be read (and indexed) without ever touching the original, or as a
+# single read transaction on the database itself, held until it is
+# closed. The latter is only possible if the database is in WAL mode;
+# otherwise the transaction would stop Papers2 from saving changes.
+#
+# Connections to the database wait for locks themselves, rather than
+# with SQLite's busy timeout, so that the time spent waiting can be
+# measured.
+
+import logging as log
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+
+from .util import dump_atomic
+
+SNAPSHOT_FILE = "snapshot.papersdb"
+
+# Snapshot modes
+COPY = "copy"
+TRANSACTION = "transaction"
+SNAPSHOT_MODES = (COPY, TRANSACTION)
+
+# Seconds to wait for a lock on the database before giving up
+BUSY_TIMEOUT = 5.0
+
+# Seconds to sleep between attempts to get a lock (the delays used by
+# SQLite's own busy handler); the last is repeated
+BUSY_DELAYS = (0.001, 0.002, 0.005, 0.01, 0.015, 0.02, 0.025, 0.025, 0.025, 0.05, 0.05, 0.1)
+
+# The number of statements executed on a database, and the number
+# of them (and seconds) that had to wait for a lock
+class LockStats(object):
+    def __init__(self):
+        self.statements = 0
+        self.waits = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+    
+    def add(self, wait=None):
+        with self._lock:
+            self.statements += 1
+            if wait is not None:
+                self.waits += 1
+                self.seconds += wait
+
+# Call fn(*args), retrying while the database is locked, for up to
+# BUSY_TIMEOUT seconds. The time spent waiting is added to stats.
+def wait_for_lock(stats, fn, *args):
+    start = None
+    attempt = 0
+    while True:
+        try:
+            result = fn(*args)
+            break
+        except sqlite3.OperationalError as e:
+            if not str(e).startswith("database is locked"):
+                raise
+            now = time.time()
+            if start is None:
+                start = now
+            elif now - start >= BUSY_TIMEOUT:
+                stats.add(now - start)
+                raise
+            time.sleep(BUSY_DELAYS[min(attempt, len(BUSY_DELAYS) - 1)])
+            attempt += 1
+    stats.add(None if start is None else time.time() - start)
+    return result
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        return wait_for_lock(self.connection.lock_stats, sqlite3.Cursor.execute, self, *args)
+    
+    def executemany(self, *args):
+        return wait_for_lock(self.connection.lock_stats, sqlite3.Cursor.executemany, self, *args)
+
+# A connection that waits for locks with wait_for_lock. A pinned
+# connection holds a read transaction, which commit and rollback
+# leave open (SQLAlchemy rolls back connections when they are
+# returned to the pool); release ends it.
+class TimedConnection(sqlite3.Connection):
+    lock_stats = None
+    pinned = False
+    
+    def cursor(self, factory=TimedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+    
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+    
+    def commit(self):
+        if not self.pinned:
+            sqlite3.Connection.commit(self)
+    
+    def rollback(self):
+        if not self.pinned:
+            sqlite3.Connection.rollback(self)
+    
+    def release(self):
+        if self.pinned:
+            self.pinned = False
+            sqlite3.Connection.rollback(self)
+
+# Open a TimedConnection to the database at path
+def connect(path, stats, check_same_thread=True):
+    conn = sqlite3.connect(path, timeout=0, factory=TimedConnection,
+        check_same_thread=check_same_thread)
+    conn.lock_stats = stats
+    return conn
+
+# Returns True if the database at path is in WAL mode
+def is_wal(path, stats):
+    conn = connect(path, stats)
+    try:
+        return conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+    finally:
+        conn.close()
+
+# Create an SQLAlchemy engine for the database at path, whose
+# connections add their lock waits to stats. If transaction is True,
+# every query is run on a single connection, in a read transaction
+# that is begun immediately and held until the engine's connection
+# is released (see release_engine).
+def create_engine(path, stats, transaction=False):
+    import sqlalchemy
+    if not transaction:
+        return sqlalchemy.create_engine("sqlite:///{0}".format(path),
+            creator=lambda: connect(path, stats))
+    from sqlalchemy.pool import StaticPool
+    conn = connect(path, stats, check_same_thread=False)
+    conn.isolation_level = None
+    conn.execute("BEGIN")
+    # the snapshot is taken by the first read
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+    conn.pinned = True
+    return sqlalchemy.create_engine("sqlite://", creator=lambda: conn, poolclass=StaticPool)
+
+# End the read transaction of an engine created with transaction=True
+def release_engine(engine):
+    conn = engine.raw_connection()
+    try:
+        conn.connection.release()
+    finally:
+        conn.close()
+
+# The (mtime, size) of the database and of its write-ahead log (or
+# None, if there is none)
+def get_source_state(source):
+    return list((os.path.getmtime(path), os.path.getsize(path)) if os.path.exists(path) else None
+        for path in (source, "{0}-wal".format(source)))
+
+# The file in which the state of the database when the snapshot was
+# started is recorded
+def get_state_file(dest):
+    return "{0}.source".format(dest)
+
+# Returns True if the database and its write-ahead log are unchanged
+# since the snapshot was started. The snapshot's own mtime is not
+# used, since it is modified when indexes are created on it.
+def is_current(source, dest):
+    state_file = get_state_file(dest)
+    if not os.path.exists(dest) or not os.path.exists(state_file):
+        return False
+    try:
+        with open(state_file, 'rb') as i:
+            state = pickle.load(i)
+    except Exception as e:
+        log.warning("Could not read {0}: {1}".format(state_file, e))
+        return False
+    return state == get_source_state(source)
+
+# Copy the database at source to dest, unless dest is already current.
+# The copy is consistent even if the database is being written to:
+# it is made with VACUUM INTO (SQLite 3.27+), or else with the online
+# backup API (Python 3.7+), or else by copying the file (and its
+# write-ahead log, if any) while holding a read lock. Waits for locks on source are added to stats (if not
+# None). Returns dest.
+def snapshot_database(source, dest, force=False, stats=None):
+    if not force and is_current(source, dest):
+        log.debug("Snapshot {0} is current".format(dest))
+        return dest
+    
+    state_file = get_state_file(dest)
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    state = get_source_state(source)
+    tmp = "{0}.tmp".format(dest)
+    wal = "{0}-wal".format(source)
+    tmp_wal = "{0}-wal".format(tmp)
+    for path in (tmp, tmp_wal):
+        if os.path.exists(path):
+            os.remove(path)
+    conn = connect(source, stats if stats is not None else LockStats())
+    try:
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            conn.execute("VACUUM INTO ?", (tmp,))
+        elif hasattr(conn, 'backup'):
+            target = sqlite3.connect(tmp)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+        else:
+            # a shared lock prevents writers from committing
+            # while the file is copied; in WAL mode, it prevents the
+            # log from being checkpointed into the file or restarted,
+            # so the log is copied too (frames appended meanwhile
+            # are ignored unless their transaction is complete)
+            conn.execute("BEGIN")
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+            shutil.copyfile(source, tmp)
+            if os.path.exists(wal):
+                shutil.copyfile(wal, tmp_wal)
+            conn.rollback()
+    finally:
+        conn.close()
+    
+    if os.path.exists(tmp_wal):
+        # fold the log into the copy, so that it is a single file
+        copy = sqlite3.connect(tmp)
+        try:
+            copy.execute("PRAGMA journal_mode=DELETE").fetchall()
+        finally:
+            copy.close()
+    
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(tmp, dest)
+    dump_atomic(state, state_file)
+    log.info("Copied Papers2 database to {0}".format(dest))
+    return dest
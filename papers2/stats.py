@@ -0,0 +1,198 @@
+# Summary statistics of a Papers2 library.
+#
+# Every count is computed by SQLite with a single GROUP BY (or
+# aggregate) query over the publications selected by
+# Papers2.get_publications, so the cost does not depend on the number
+# of related records of each publication. Attachment sizes are
+# gathered with one sweep of os.stat calls over all attachment paths,
+# made by a pool of threads since stat is dominated by I/O latency
+# (particularly on network or cloud-synced folders).
+
+from collections import OrderedDict
+import logging as log
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from .schema import KeywordType, label_num_to_label, pub_type_id_to_pub_type
+
+# Number of threads used to stat attachment files
+STAT_THREADS = 16
+
+# Upper bounds (in bytes) of the attachment size buckets
+SIZE_BUCKETS = (
+    ("<100KB",  100 * 1024),
+    ("<1MB",    1024 * 1024),
+    ("<10MB",   10 * 1024 * 1024),
+    ("<100MB",  100 * 1024 * 1024),
+    (">=100MB", None)
+)
+
+# Publication fields checked for missing values
+FIELDS = ("title", "summary", "doi", "publication_date", "bundle", "volume", "startpage")
+
+# Returns the size of a file, or None if it does not exist
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+# Stat paths with a pool of threads. Returns a list of sizes (None for
+# missing files) in the same order as paths.
+def stat_files(paths, threads=STAT_THREADS):
+    if len(paths) == 0:
+        return []
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(file_size, paths, chunksize=max(1, len(paths) // (threads * 4)))
+    finally:
+        pool.close()
+
+class LibraryStats(object):
+    def __init__(self, papers2, top_keywords=50, stat_threads=STAT_THREADS):
+        self.papers2 = papers2
+        self.top_keywords = top_keywords
+        self.stat_threads = stat_threads
+    
+    # Compute statistics over the publications selected by passing
+    # query_args to get_publications. Returns an OrderedDict that can
+    # be serialized as JSON. If files is False, attachment files are
+    # not stat'ed.
+    def compute(self, files=True, **query_args):
+        from sqlalchemy import func
+        self._func = func
+        start = time.time()
+        Publication = self.papers2.get_table("Publication")
+        self._pubs = self.papers2.get_publications(**query_args)
+        self._pub_ids = self._pubs.with_entities(Publication.ROWID)
+        
+        stats = OrderedDict()
+        for name, fn in (
+                ("publications", self._count),
+                ("types", self._types),
+                ("labels", self._labels),
+                ("years", self._years),
+                ("times_read", self._times_read),
+                ("missing", self._missing),
+                ("collections", self._collections),
+                ("keywords", self._keywords),
+                ("attachments", lambda: self._attachments(files))):
+            section_start = time.time()
+            stats[name] = fn()
+            log.debug("Computed {0} statistics in {1:.3f} seconds".format(
+                name, time.time() - section_start))
+        stats['seconds'] = round(time.time() - start, 3)
+        return stats
+    
+    def _count(self):
+        return self._pubs.count()
+    
+    def _group(self, column, key=None):
+        counts = OrderedDict()
+        for value, count in self._pubs.with_entities(column, self._func.count()
+                ).group_by(column).order_by(column):
+            counts[key(value) if key else value] = count
+        return counts
+    
+    def _types(self):
+        Publication = self.papers2.get_table("Publication")
+        return self._group(Publication.subtype, lambda t: pub_type_id_to_pub_type[t].name)
+    
+    def _labels(self):
+        Publication = self.papers2.get_table("Publication")
+        return self._group(Publication.label, lambda l: label_num_to_label[l].name
+            if l in label_num_to_label else str(l))
+    
+    def _years(self):
+        Publication = self.papers2.get_table("Publication")
+        return self._group(self._func.substr(Publication.publication_date, 3, 4),
+            lambda y: y or "unknown")
+    
+    def _times_read(self):
+        Publication = self.papers2.get_table("Publication")
+        return self._group(Publication.times_read, lambda n: str(n or 0))
+    
+    # Number of publications missing each field, and with no authors
+    # or attachments
+    def _missing(self):
+        from sqlalchemy import case, or_
+        Publication = self.papers2.get_table("Publication")
+        OrderedAuthor = self.papers2.get_table("OrderedAuthor")
+        PDF = self.papers2.get_table("PDF")
+        session = self.papers2.get_session()
+        sums = []
+        for field in FIELDS:
+            column = getattr(Publication, field)
+            sums.append(self._func.sum(case([(or_(column == None, column == ""), 1)], else_=0)))
+        sums.append(self._func.sum(case([(Publication.ROWID.in_(
+            session.query(OrderedAuthor.object_id)), 0)], else_=1)))
+        sums.append(self._func.sum(case([(Publication.ROWID.in_(
+            session.query(PDF.object_id)), 0)], else_=1)))
+        row = self._pubs.with_entities(*sums).one()
+        return OrderedDict(zip(FIELDS + ("authors", "attachments"), (v or 0 for v in row)))
+    
+    def _collections(self):
+        CollectionItem = self.papers2.get_table("CollectionItem")
+        paths = self.papers2.get_collection_paths()
+        counts = OrderedDict()
+        for collection, count in self.papers2.get_session().query(
+                    CollectionItem.collection, self._func.count(CollectionItem.object_id.distinct())
+                ).filter(CollectionItem.object_id.in_(self._pub_ids)
+                ).group_by(CollectionItem.collection):
+            if collection in paths:
+                counts["/".join(paths[collection])] = count
+        return OrderedDict(sorted(counts.iteritems()))
+    
+    # Number of keyword assignments of each type, and the most
+    # frequently assigned keywords of each type
+    def _keywords(self):
+        Keyword = self.papers2.get_table("Keyword")
+        KeywordItem = self.papers2.get_table("KeywordItem")
+        types = dict((t, name.lower()) for t, name in KeywordType.__reverse_dict__.iteritems())
+        result = OrderedDict()
+        count = self._func.count(KeywordItem.object_id)
+        rows = self.papers2.get_session().query(KeywordItem.type, Keyword.name, count
+            ).join(Keyword, Keyword.ROWID == KeywordItem.keyword_id
+            ).filter(KeywordItem.object_id.in_(self._pub_ids)
+            ).group_by(KeywordItem.type, Keyword.name
+            ).order_by(KeywordItem.type, count.desc(), Keyword.name)
+        for kw_type, name, n in rows:
+            section = result.setdefault(types.get(kw_type, str(kw_type)), OrderedDict(
+                (("assignments", 0), ("distinct", 0), ("top", OrderedDict()))))
+            section['assignments'] += n
+            section['distinct'] += 1
+            if len(section['top']) < self.top_keywords:
+                section['top'][name] = n
+        return result
+    
+    # Number of attachments by MIME type, and (if files is True) their
+    # total size, size distribution and number of missing files
+    def _attachments(self, files):
+        PDF = self.papers2.get_table("PDF")
+        query = self.papers2.get_session().query(PDF).filter(PDF.object_id.in_(self._pub_ids))
+        result = OrderedDict()
+        result['count'] = query.count()
+        result['mime_types'] = OrderedDict((m or "unknown", n) for m, n in query.with_entities(
+            PDF.mime_type, self._func.count()).group_by(PDF.mime_type).order_by(PDF.mime_type))
+        if not files:
+            return result
+        
+        start = time.time()
+        paths = list(self.papers2.get_attachment_path(path)
+            for (path,) in query.with_entities(PDF.path) if path is not None)
+        sizes = stat_files(paths, self.stat_threads)
+        found = list(s for s in sizes if s is not None)
+        buckets = OrderedDict((name, 0) for name, limit in SIZE_BUCKETS)
+        for size in found:
+            for name, limit in SIZE_BUCKETS:
+                if limit is None or size < limit:
+                    buckets[name] += 1
+                    break
+        result['missing'] = len(sizes) - len(found)
+        result['total_bytes'] = sum(found)
+        result['max_bytes'] = max(found) if len(found) > 0 else 0
+        result['sizes'] = buckets
+        log.info("Checked {0} attachment files in {1:.2f} seconds".format(
+            len(paths), time.time() - start))
+        return result
@@ -1,8 +1,14 @@
+from array import array
+from collections import namedtuple
+import hashlib
 import json
 import os
 import pickle
 import re
 import sys
+import threading
+import time
+import uuid
 
 from argparse import ArgumentParser
 from ConfigParser import SafeConfigParser as ConfigParser
@@ -32,41 +38,124 @@ def parse_with_config(add_args, sections, short_name="c", long_name="config",
     args = parser.parse_args(args=rest)
     return args
 
+# A queued item. The item is serialized to compact JSON when it is
+# added to the batch, so each record holds one string rather than a
+# tree of dicts, and the serialized form is what gets uploaded.
+# Attachments are stored as a flat array of (path, MIME type) IDs
+# into the batch's string table.
+class BatchRecord(object):
+    __slots__ = ('payload', 'notes', 'attachments', 'db_id')
+    
+    def __init__(self, payload, notes, attachments, db_id):
+        self.payload = payload
+        self.notes = notes
+        self.attachments = attachments
+        self.db_id = db_id
+    
+    # Decode the item. Only needed for logging and dry runs.
+    @property
+    def item(self):
+        return json.loads(self.payload)
+
+# Queue of items to upload. The batch is full when it holds max_size
+# items or, if max_bytes is set, when another item would make the
+# request body larger than max_bytes. started is the time the first
+# item was added, or None if the batch is empty.
 class Batch(object):
-    def __init__(self, max_size):
-        self.items = []
-        self.notes = []
-        self.attachments = []
+    def __init__(self, max_size, max_bytes=None):
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.clear()
+    
+    # Serialize an item the same way it is sent to the server
+    @staticmethod
+    def serialize(item):
+        return json.dumps(item, separators=(',', ':'))
     
     @property
     def size(self):
-        return len(self.items)
+        return len(self.records)
     
     @property
     def is_full(self):
-        return self.size >= self.max_size
+        return self.size >= self.max_size or (
+            self.max_bytes is not None and self.bytes >= self.max_bytes)
     
     @property
     def is_empty(self):
-        return len(self.items) == 0
+        return len(self.records) == 0
+    
+    # Size of the request body for the items in the batch
+    @property
+    def bytes(self):
+        return self._bytes + max(len(self.records) - 1, 0) + 2
+    
+    # Whether a serialized item can be added without exceeding max_bytes.
+    # An item always fits in an empty batch.
+    def fits(self, payload):
+        return self.is_empty or self.max_bytes is None or (
+            self.bytes + len(payload) + 1 <= self.max_bytes)
     
-    def add(self, item, notes, attachments):
-        self.items.append(item)
-        self.notes.append(notes)
-        self.attachments.append(attachments)
+    # Add an item, which is either a dict or a string returned by serialize.
+    def add(self, item, notes, attachments, db_id=None):
+        payload = item if isinstance(item, basestring) else Batch.serialize(item)
+        ids = array('i')
+        for path, mime in attachments:
+            ids.append(self._intern(path))
+            ids.append(self._intern(mime))
+        self.records.append(BatchRecord(payload, tuple(notes), ids, db_id))
+        self._bytes += len(payload)
+        if self.started is None:
+            self.started = time.time()
     
-    def iter(self):
-        for item in zip(self.items, self.notes, self.attachments):
-            yield item
+    def _intern(self, s):
+        try:
+            return self._string_ids[s]
+        except KeyError:
+            self._string_ids[s] = len(self._strings)
+            self._strings.append(s)
+            return self._string_ids[s]
+    
+    # Get the (path, MIME type) tuples of a record's attachments
+    def get_attachments(self, record):
+        ids = record.attachments
+        return list((self._strings[ids[i]], self._strings[ids[i+1]])
+            for i in xrange(0, len(ids), 2))
+    
+    # Request body for uploading all items in the batch
+    def get_payload(self):
+        return "[{0}]".format(",".join(r.payload for r in self.records))
+    
+    def __iter__(self):
+        return iter(self.records)
+    
+    def __getitem__(self, idx):
+        return self.records[idx]
     
     def clear(self):
-        self.items = []
-        self.notes = []
-        self.attachments = []
+        self.records = []
+        self._bytes = 0
+        self.started = None
+        self._strings = []
+        self._string_ids = {}
+
+# Pickle an object (or write it with another dump function, e.g.
+# json.dump) to a file. The object is written to a temporary file that
+# then replaces the target, so an interrupted write never leaves a
+# truncated file behind.
+def dump_atomic(obj, filename, dump=pickle.dump):
+    tmp = "{0}.tmp".format(filename)
+    with open(tmp, 'wb') as o:
+        dump(obj, o)
+        o.flush()
+        os.fsync(o.fileno())
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
 
 # Simple checkpointing facility that maintains a
 # set of items IDs and pickles them on commit.
+# Methods may be called from multiple threads.
 class Checkpoint(object):
     def __init__(self, filename):
         self.filename = filename
@@ -76,25 +165,335 @@ class Checkpoint(object):
         else:
             self.ids = set()
         self._uncommitted = []
+        self._lock = threading.Lock()
     
     def add(self, db_id):
-        self._uncommitted.append(db_id)
+        with self._lock:
+            self._uncommitted.append(db_id)
     
     def remove(self, db_id):
-        del self._uncommitted[db_id]
+        with self._lock:
+            if db_id in self._uncommitted:
+                self._uncommitted.remove(db_id)
     
     def commit(self):
-        self.ids.update(self._uncommitted)
-        with open(self.filename, 'wb') as o:
-            pickle.dump(self.ids, o)
-        self._uncommitted = []
+        with self._lock:
+            self.ids.update(self._uncommitted)
+            dump_atomic(self.ids, self.filename)
+            self._uncommitted = []
     
     def rollback(self):
-        self._uncommitted = []
+        with self._lock:
+            self._uncommitted = []
     
     def contains(self, db_id):
         return db_id in self.ids
 
+# The Zotero item created from a Papers2 publication: the item key,
+# the item version after the last write, and a hash of each field
+# of the last payload that was sent.
+ItemVersion = namedtuple("ItemVersion", ("key", "version", "hashes"))
+
+# Hash each field of a Zotero item payload
+def hash_fields(item):
+    return dict((k, hashlib.md5(json.dumps(v, sort_keys=True)).hexdigest())
+        for k, v in item.iteritems() if k not in ('key', 'version'))
+
+# Persistent record of the Zotero items created from Papers2
+# publications, along with the last-seen Zotero library version.
+# Like Checkpoint, changes are only written on commit, and
+# methods may be called from multiple threads.
+class ItemVersions(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.library_version = 0
+        self.items = {}
+        if os.path.exists(filename):
+            with open(filename, "rb") as i:
+                self.library_version, self.items = pickle.load(i)
+        self._uncommitted = {}
+        self._lock = threading.Lock()
+    
+    def get(self, db_id):
+        return self.items.get(db_id)
+    
+    def set(self, db_id, key, version, hashes):
+        with self._lock:
+            self._uncommitted[db_id] = ItemVersion(key, version, hashes)
+    
+    def commit(self, library_version=None):
+        with self._lock:
+            self.items.update(self._uncommitted)
+            if library_version is not None:
+                self.library_version = max(self.library_version, library_version)
+            dump_atomic((self.library_version, self.items), self.filename)
+            self._uncommitted = {}
+    
+    def rollback(self):
+        with self._lock:
+            self._uncommitted = {}
+
+# A batch of items being uploaded, as recorded in the journal. Each
+# item is a dict with the publication ID (id), serialized item
+# (payload), notes, attachments, field hashes (hashes) and the write
+# token used to create its notes (note_token). status is the server's
+# response to the item upload, or None if the upload has not completed.
+class JournalEntry(object):
+    def __init__(self, items, token=None):
+        self.token = token or new_write_token()
+        self.items = items
+        self.status = None
+        self.library_version = None
+        self.notes_done = set()
+        self.attachments_done = set()
+
+def new_write_token():
+    return uuid.uuid4().hex
+
+# Write-ahead journal of uploads. Before a batch is uploaded, its
+# contents and the Zotero write token for the request are appended to
+# the journal, followed by a record as each step of the upload (item
+# creation, then the notes and attachments of each item) completes.
+# Records are flushed to disk before the next step starts. Batches that
+# were not completed (e.g. because the process was killed) are loaded
+# on startup so that only their unfinished steps are repeated. Once
+# every batch is complete, the journal is truncated. Methods may be
+# called from multiple threads.
+class Journal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = self._load()
+        self._fh = open(filename, 'a')
+        self._lock = threading.RLock()
+    
+    def _load(self):
+        pending = {}
+        if not os.path.exists(self.filename):
+            return pending
+        with open(self.filename) as i:
+            for line in i:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record may have been partially written
+                    break
+                op, token = record['op'], record['token']
+                if op == 'begin':
+                    pending[token] = JournalEntry(record['items'], token)
+                    continue
+                entry = pending.get(token)
+                if entry is None:
+                    continue
+                if op == 'created':
+                    entry.status = record['status']
+                    entry.library_version = record['version']
+                elif op == 'notes':
+                    entry.notes_done.add(record['item'])
+                elif op == 'attachments':
+                    entry.attachments_done.add(record['item'])
+                elif op == 'done':
+                    del pending[token]
+        return pending
+    
+    def _write(self, op, entry, **kwargs):
+        kwargs.update(op=op, token=entry.token)
+        line = "{0}\n".format(json.dumps(kwargs))
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+    
+    def begin(self, entry):
+        with self._lock:
+            self.pending[entry.token] = entry
+            self._write('begin', entry, items=entry.items)
+    
+    def created(self, entry):
+        self._write('created', entry, status=entry.status, version=entry.library_version)
+    
+    def notes_done(self, entry, idx):
+        entry.notes_done.add(idx)
+        self._write('notes', entry, item=idx)
+    
+    def attachments_done(self, entry, idx):
+        entry.attachments_done.add(idx)
+        self._write('attachments', entry, item=idx)
+    
+    def complete(self, entry):
+        with self._lock:
+            self.pending.pop(entry.token, None)
+            if len(self.pending) == 0:
+                self._fh.truncate(0)
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+            else:
+                self._write('done', entry)
+    
+    def close(self):
+        self._fh.close()
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) == 0:
+            os.remove(self.filename)
+
+# Number of attempts, and seconds to wait after the first failed
+# attempt, before a failed upload is given up on
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 5
+
+# Stages at which an upload can fail
+RETRY_CREATE = "create"         # the item was not created
+RETRY_CHILDREN = "children"     # the item was created, but not all of its
+                                # notes and attachments were uploaded
+RETRY_BATCH = "batch"           # the request to create a batch of items failed
+
+# A failed upload: the stage at which it failed, the data needed to
+# retry it (the item dict recorded in the journal, with only the notes
+# and attachments still to upload; or, for RETRY_BATCH, the
+# JournalEntry of the batch), the Zotero key of the item (for
+# RETRY_CHILDREN), the number of failed attempts, the time at which
+# it is next due, and the last error.
+class RetryEntry(object):
+    def __init__(self, stage, data, item_key=None):
+        self.stage = stage
+        self.data = data
+        self.item_key = item_key
+        self.attempts = 0
+        self.next_attempt = 0
+        self.error = None
+
+# Persistent queue of failed uploads, keyed by publication ID (or, for
+# RETRY_BATCH, by the write token of the batch). Uploads are retried
+# with exponential backoff (backoff, 2 * backoff, ... seconds after
+# each failure); after max_attempts failures, an upload is
+# dead-lettered, and is not retried again during this run. Only
+# RETRY_CHILDREN entries are retried by later runs: items that were
+# not created are not in the checkpoint, so the next run exports them
+# again, and failed batches remain in the journal. Like Checkpoint,
+# changes are only written on commit, and methods may be called from
+# multiple threads.
+class RetryQueue(object):
+    def __init__(self, filename=None, max_attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.entries = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "rb") as i:
+                for key, entry in pickle.load(i).iteritems():
+                    if entry.stage == RETRY_CHILDREN:
+                        entry.attempts = 0
+                        entry.next_attempt = 0
+                        self.entries[key] = entry
+        # attempts of entries that were taken to be retried as part
+        # of another upload
+        self._taken = {}
+        self._lock = threading.Lock()
+    
+    # Record a failed attempt. Returns the RetryEntry.
+    def fail(self, key, stage, data, error, item_key=None):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.stage != stage:
+                entry = self.entries[key] = RetryEntry(stage, data, item_key)
+                if stage == RETRY_CREATE:
+                    entry.attempts = self._taken.pop(key, 0)
+            entry.data = data
+            entry.attempts += 1
+            entry.next_attempt = time.time() + self.backoff * 2 ** (entry.attempts - 1)
+            entry.error = error
+            return entry
+    
+    # Remove an entry that failed at the given stage, once it succeeds
+    def succeed(self, key, stage):
+        with self._lock:
+            self._taken.pop(key, None)
+            entry = self.entries.get(key)
+            if entry is not None and entry.stage == stage:
+                del self.entries[key]
+    
+    # Remove an entry in order to retry it as part of another upload;
+    # if that fails, the entry's attempts are carried over
+    def take(self, key):
+        with self._lock:
+            entry = self.entries.pop(key)
+            self._taken[key] = entry.attempts
+            return entry
+    
+    def is_dead(self, entry):
+        return entry.attempts >= self.max_attempts
+    
+    # Get the (key, RetryEntry) tuples that are due for another attempt
+    def get_due(self):
+        now = time.time()
+        with self._lock:
+            return list((key, entry) for key, entry in self.entries.iteritems()
+                if not self.is_dead(entry) and entry.next_attempt <= now)
+    
+    # Time at which the next entry is due, or None if every entry is dead
+    def get_next_attempt(self):
+        with self._lock:
+            times = list(entry.next_attempt for entry in self.entries.itervalues()
+                if not self.is_dead(entry))
+        return min(times) if len(times) > 0 else None
+    
+    # Get the (key, RetryEntry) tuples that will not be retried again
+    def get_dead(self):
+        with self._lock:
+            return list((key, entry) for key, entry in self.entries.iteritems()
+                if self.is_dead(entry))
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def commit(self):
+        if self.filename is None:
+            return
+        with self._lock:
+            if len(self.entries) > 0:
+                dump_atomic(self.entries, self.filename)
+            elif os.path.exists(self.filename):
+                os.remove(self.filename)
+
+# Limits the rate of an operation, across threads, to at most
+# rate calls per second. If rate is None, calls are not limited.
+class RateLimiter(object):
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+    
+    # Block until the next call is allowed
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# Counts of the work done by an export (publications read, items
+# exported, requests sent, bytes uploaded), which may be added to from
+# multiple threads. Adding is cheap enough to be done for every
+# publication.
+class Counters(object):
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+    
+    def add(self, **counts):
+        with self._lock:
+            for name, n in counts.iteritems():
+                self.values[name] = self.values.get(name, 0) + n
+    
+    def get(self, name):
+        return self.values.get(name, 0)
+    
+    # A consistent copy of all the counts
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
 # Create an enumerated type
 def enum(name, **enums):
     _enums = enums.copy()
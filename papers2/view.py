@@ -0,0 +1,291 @@
+# Materialized export view of a Papers2 library.
+#
+# Building one Zotero item from the Papers2 database reads about ten
+# tables. The export view denormalizes each publication, along with
+# its authors, identifiers, URLs, keywords, collections, reviews,
+# attachments and bundle title, into a single row of a sidecar SQLite
+# database, with the related records stored as JSON. Once the view is
+# built, a publication is read with a single lookup (or a whole chunk
+# of publications with a single sequential scan) rather than a query
+# per table.
+#
+# Like the search index, each row records the publication's
+# updated_at time, so update() only has to rebuild the rows of
+# publications that were added or changed since the last update.
+# Changes to related records that do not touch the publication's
+# updated_at time are only picked up by rebuild().
+#
+# ExportView provides the same per-publication accessors as Papers2
+# (get_pub_authors, get_keywords, get_attachments, etc.), taking a
+# ViewRecord in place of a Publication, so code that uses them can read
+# from either.
+
+from collections import namedtuple
+import json
+import logging as log
+import sqlite3
+import time
+
+from .schema import pub_type_id_to_pub_type, label_num_to_label
+
+VIEW_FILE = "view.sqlite"
+
+# Incremented whenever the layout of the rows changes; views with an
+# older version are rebuilt.
+VIEW_VERSION = 1
+
+# Number of publications to read from Papers2 (or the view) at a time
+CHUNK_SIZE = 500
+
+# JSON columns of the view, in order
+COLUMNS = ("publication", "authors", "identifiers", "urls", "keywords",
+    "collections", "reviews", "attachments")
+
+# Rows of the related records of a publication, with the same
+# attribute names as the rows returned by Papers2
+ViewAuthor = namedtuple("ViewAuthor", ("id", "type", "prename", "surname", "institutional"))
+ViewIdentifier = namedtuple("ViewIdentifier", ("source_id", "remote_id"))
+ViewKeyword = namedtuple("ViewKeyword", ("name", "type"))
+ViewCollection = namedtuple("ViewCollection", ("ROWID",))
+ViewReview = namedtuple("ViewReview", ("content", "rating", "is_mine"))
+ViewBundle = namedtuple("ViewBundle", ("title",))
+
+# A publication read from the view. The columns of the Publication
+# table are attributes (e.g. record.ROWID, record.title), as are the
+# lists of related records and the title of the bundle.
+class ViewRecord(object):
+    def __init__(self, row):
+        pub_id, bundle = row[0], row[-1]
+        (publication, authors, identifiers, urls, keywords, collections, reviews,
+            attachments) = (json.loads(value) for value in row[1:-1])
+        self.__dict__.update(publication)
+        self.ROWID = pub_id
+        self.authors = list(ViewAuthor(*a) for a in authors)
+        self.identifiers = list(ViewIdentifier(*i) for i in identifiers)
+        self.urls = urls
+        self.keywords = list(ViewKeyword(*k) for k in keywords)
+        self.collections = collections
+        self.reviews = list(ViewReview(*r) for r in reviews)
+        self.attachments = list(tuple(a) for a in attachments)
+        self.bundle_title = bundle
+
+# Returns a value of a Publication column if it can be stored as JSON;
+# BLOBs (and undecodable byte strings) are dropped.
+def _json_value(value):
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    if value is None or isinstance(value, (unicode, int, long, float, bool)):
+        return value
+    return None
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+class ExportView(object):
+    def __init__(self, papers2, filename=None):
+        self.papers2 = papers2
+        self.filename = filename or papers2.get_cache_file(VIEW_FILE)
+        self._conn = sqlite3.connect(self.filename)
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != VIEW_VERSION:
+            with self._conn:
+                self._conn.execute("DROP TABLE IF EXISTS pubs")
+                self._conn.execute("PRAGMA user_version = {0}".format(VIEW_VERSION))
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pubs (
+                id INTEGER PRIMARY KEY,
+                updated_at REAL,
+                {0},
+                bundle TEXT)""".format(", ".join("{0} TEXT".format(c) for c in COLUMNS)))
+    
+    def close(self):
+        self._conn.close()
+    
+    # Bring the view up to date with the Papers2 database.
+    # Returns the number of publications (re-)materialized.
+    def update(self):
+        start = time.time()
+        Publication = self.papers2.get_table("Publication")
+        current = dict(self.papers2.get_publications().with_entities(
+            Publication.ROWID, Publication.updated_at))
+        stored = dict(self._conn.execute("SELECT id, updated_at FROM pubs"))
+        
+        removed = list(i for i in stored if i not in current)
+        changed = list(i for i, updated_at in current.iteritems()
+            if i not in stored or stored[i] != updated_at)
+        changed.sort()
+        
+        authors = None
+        if len(changed) > 0:
+            authors = dict((a.id, a) for a in self.papers2.get_authors())
+        
+        with self._conn:
+            for i in xrange(0, len(removed), CHUNK_SIZE):
+                self._delete(removed[i:i+CHUNK_SIZE])
+            for i in xrange(0, len(changed), CHUNK_SIZE):
+                self._materialize(changed[i:i+CHUNK_SIZE], authors)
+        
+        log.info("Export view updated in {0:.2f} seconds: {1} publications materialized, "\
+            "{2} removed".format(time.time() - start, len(changed), len(removed)))
+        return len(changed)
+    
+    # Drop all publications and rebuild the view
+    def rebuild(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM pubs")
+        return self.update()
+    
+    def _delete(self, pub_ids):
+        self._conn.execute("DELETE FROM pubs WHERE id IN ({0})".format(
+            ",".join("?" * len(pub_ids))), pub_ids)
+    
+    # Read the publications in pub_ids, and their related records,
+    # with one query per table, and (re-)write their rows
+    def _materialize(self, pub_ids, all_authors):
+        p = self.papers2
+        session = p.get_session()
+        Publication = p.get_table("Publication")
+        columns = list(Publication.__table__.columns)
+        pubs = list(p.get_publications(row_ids=pub_ids).with_entities(*columns))
+        uuids = dict((pub.uuid, pub.ROWID) for pub in pubs)
+        
+        def related():
+            return dict((pub_id, []) for pub_id in pub_ids)
+        
+        authors = related()
+        for pub_id, author_id, author_type in p.get_ordered_authors(pub_ids):
+            author = all_authors.get(author_id)
+            if author is not None:
+                authors[pub_id].append((author_id, author_type, author.prename,
+                    author.surname, author.institutional))
+        
+        # identifiers in table order; urls most recent first
+        SyncEvent = p.get_table("SyncEvent")
+        identifiers = related()
+        urls = related()
+        events = session.query(SyncEvent.device_id, SyncEvent.source_id, SyncEvent.remote_id,
+                SyncEvent.updated_at
+            ).filter(SyncEvent.device_id.in_(list(uuids))
+            ).order_by(SyncEvent.ROWID)
+        for device_id, source_id, remote_id, updated_at in events:
+            pub_id = uuids[device_id]
+            identifiers[pub_id].append((source_id, remote_id))
+            if remote_id is not None and remote_id.lower().startswith("http"):
+                urls[pub_id].append((updated_at, remote_id))
+        for pub_id, pub_urls in urls.iteritems():
+            pub_urls.sort(key=lambda url: url[0], reverse=True)
+            urls[pub_id] = list(url for updated_at, url in pub_urls)
+        
+        keywords = related()
+        for kw in p.get_pub_keywords(pub_ids):
+            keywords[kw.object_id].append((kw.name, kw.type))
+        
+        Collection = p.get_table("Collection")
+        CollectionItem = p.get_table("CollectionItem")
+        collections = related()
+        for pub_id, collection_id in session.query(CollectionItem.object_id, Collection.ROWID
+                ).join(Collection, Collection.ROWID == CollectionItem.collection
+                ).filter(CollectionItem.object_id.in_(pub_ids), Collection.type.in_((0,5))
+                ).order_by(CollectionItem.ROWID):
+            collections[pub_id].append(collection_id)
+        
+        Review = p.get_table("Review")
+        reviews = related()
+        for r in session.query(Review).filter(Review.object_id.in_(pub_ids)):
+            reviews[r.object_id].append((r.content, r.rating, r.is_mine))
+        
+        attachments = related()
+        for a in p.get_pub_attachments(pub_ids):
+            attachments[a.object_id].append((a.path, a.mime_type))
+        
+        bundle_ids = set()
+        for pub in pubs:
+            try:
+                bundle_ids.add(int(pub.bundle))
+            except (TypeError, ValueError):
+                pass
+        bundles = {}
+        if len(bundle_ids) > 0:
+            bundles = dict(session.query(Publication.ROWID, Publication.title
+                ).filter(Publication.ROWID.in_(bundle_ids)))
+        
+        rows = []
+        for pub in pubs:
+            try:
+                bundle = bundles.get(int(pub.bundle))
+            except (TypeError, ValueError):
+                bundle = None
+            publication = dict((c.key, _json_value(v)) for c, v in zip(columns, pub))
+            rows.append((pub.ROWID, pub.updated_at, _dumps(publication),
+                _dumps(authors[pub.ROWID]), _dumps(identifiers[pub.ROWID]),
+                _dumps(urls[pub.ROWID]), _dumps(keywords[pub.ROWID]),
+                _dumps(collections[pub.ROWID]), _dumps(reviews[pub.ROWID]),
+                _dumps(attachments[pub.ROWID]), bundle))
+        
+        self._delete(pub_ids)
+        self._conn.executemany("INSERT INTO pubs (id, updated_at, {0}, bundle) "\
+            "VALUES (?, ?, {1}, ?)".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+            rows)
+    
+    # Get ViewRecords for all publications in the view (or only those
+    # in pub_ids, in that order). Records are read CHUNK_SIZE at a
+    # time; publications that are not in the view are skipped.
+    def get_records(self, pub_ids=None):
+        sql = "SELECT id, {0}, bundle FROM pubs".format(", ".join(COLUMNS))
+        if pub_ids is None:
+            for row in self._conn.execute("{0} ORDER BY id".format(sql)):
+                yield ViewRecord(row)
+            return
+        pub_ids = list(pub_ids)
+        for i in xrange(0, len(pub_ids), CHUNK_SIZE):
+            chunk = pub_ids[i:i+CHUNK_SIZE]
+            rows = dict((row[0], row) for row in self._conn.execute(
+                "{0} WHERE id IN ({1})".format(sql, ",".join("?" * len(chunk))), chunk))
+            for pub_id in chunk:
+                if pub_id in rows:
+                    yield ViewRecord(rows[pub_id])
+    
+    # Get the ViewRecord of a single publication, or None
+    def get_record(self, pub_id):
+        for record in self.get_records((pub_id,)):
+            return record
+        return None
+    
+    # Per-publication accessors, equivalent to those of Papers2. These
+    # return lists rather than queries.
+    
+    def get_bundle(self, record):
+        if record.bundle_title is None:
+            return None
+        return ViewBundle(record.bundle_title)
+    
+    def get_pub_type(self, record):
+        return pub_type_id_to_pub_type[record.subtype]
+    
+    def get_label_name(self, record):
+        return label_num_to_label[record.label].name
+    
+    def get_pub_authors(self, record):
+        return record.authors
+    
+    def get_identifiers(self, record, id_source):
+        return list(i for i in record.identifiers if i.source_id == id_source)
+    
+    def get_urls(self, record):
+        return list(ViewIdentifier(None, url) for url in record.urls)
+    
+    def get_attachments(self, record):
+        return list((self.papers2.get_attachment_path(path), mime_type)
+            for path, mime_type in record.attachments)
+    
+    def get_keywords(self, record, kw_type=None):
+        return list(k for k in record.keywords if kw_type is None or k.type == kw_type)
+    
+    def get_collections(self, record):
+        return list(ViewCollection(c) for c in record.collections)
+    
+    def get_reviews(self, record, mine_only=True):
+        return list(r for r in record.reviews if not mine_only or r.is_mine == 1)
@@ -0,0 +1,93 @@
+# Watching a Papers2 library for new and modified publications.
+#
+# Papers2 writes to its database (and, in WAL mode, to its write-ahead
+# log) whenever a publication is added or edited. LibraryWatcher polls
+# the modification times and sizes of those files, which is cheap and,
+# unlike inotify or FSEvents, works the same on every platform and on
+# network and cloud-synced folders. Once they have changed and then
+# stopped changing for a moment (so that a save in progress is not read
+# half-way), only the publications whose ROWID or updated_at is beyond
+# the largest seen so far are selected, so the library is never
+# rescanned.
+
+import logging as log
+import os
+import time
+
+# Seconds between checks of the database files
+POLL_INTERVAL = 1.0
+
+# Seconds the database files must stay unchanged before they are read
+SETTLE_TIME = 0.5
+
+class LibraryWatcher(object):
+    def __init__(self, papers2, query_args={}, interval=POLL_INTERVAL, settle=SETTLE_TIME):
+        if papers2.snapshot is not None:
+            raise Exception("Cannot watch a snapshot of the Papers2 database")
+        self.papers2 = papers2
+        self.query_args = query_args
+        self.interval = interval
+        self.settle = settle
+        self._files = (papers2.db, "{0}-wal".format(papers2.db))
+        self._state = self._get_state()
+        self.max_rowid, self.max_updated = self._get_marks()
+    
+    # (mtime, size) of the database and its write-ahead log
+    def _get_state(self):
+        state = []
+        for path in self._files:
+            try:
+                st = os.stat(path)
+                state.append((st.st_mtime, st.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+    
+    # The largest ROWID and updated_at of all publications
+    def _get_marks(self):
+        from sqlalchemy import func
+        Publication = self.papers2.get_table("Publication")
+        max_rowid, max_updated = self.papers2.get_session().query(
+            func.max(Publication.ROWID), func.max(Publication.updated_at)).one()
+        return (max_rowid or 0, max_updated or 0)
+    
+    # Wait until the database has changed and settled, or until timeout
+    # seconds have passed (if timeout is not None). Returns True if the
+    # database changed.
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            state = self._get_state()
+            if state != self._state:
+                while True:
+                    time.sleep(self.settle)
+                    settled = self._get_state()
+                    if settled == state:
+                        break
+                    state = settled
+                self._state = state
+                return True
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return False
+            time.sleep(delay)
+    
+    # Get the publications (matching query_args) that were added or
+    # modified since the last poll, in ROWID order
+    def poll(self):
+        from sqlalchemy import or_
+        Publication = self.papers2.get_table("Publication")
+        session = self.papers2.get_session()
+        # reload publications that were read before they were modified
+        session.expire_all()
+        pubs = self.papers2.get_publications(**self.query_args).filter(or_(
+                Publication.ROWID > self.max_rowid,
+                Publication.updated_at > self.max_updated)
+            ).order_by(Publication.ROWID).all()
+        for pub in pubs:
+            self.max_rowid = max(self.max_rowid, pub.ROWID)
+            self.max_updated = max(self.max_updated, pub.updated_at or 0)
+        log.debug("Found {0} new or modified publications".format(len(pubs)))
+        return pubs
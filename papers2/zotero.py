@@ -6,13 +6,24 @@
 # TODO: user-definable date format; for now using YYYY-MM-DD
 # TODO: use relations to link book chapters to parent volume
 
+from collections import OrderedDict
 from datetime import datetime
+from itertools import groupby
 import logging as log
+from multiprocessing.pool import ThreadPool
+import os
+import json
+import pickle
+import random
 import sys
+import threading
+import time
 
-from pyzotero.zotero import Zotero
+from . import dates
+from .remote import RemoteLibrary
 from .schema import PubType, IDSource, KeywordType, Label
-from .util import Batch, JSONWriter
+from .util import (Batch, BatchRecord, Counters, JournalEntry, JSONWriter, RateLimiter,
+    dump_atomic, hash_fields, new_write_token, RETRY_BATCH, RETRY_CHILDREN, RETRY_CREATE)
 
 # mapping of papers2 publication types 
 # to Zotero item types 
@@ -32,6 +43,31 @@ ITEM_TYPES = {
     PubType.PROTOCOL            : 'report'
 }
 
+# Max number of objects the Zotero API accepts in one write request
+MAX_WRITE_OBJECTS = 50
+
+# Number of collections to request per page
+COLLECTION_PAGE_SIZE = 100
+
+# Number of threads used to make concurrent requests
+FETCH_THREADS = 4
+
+# Default max number of requests that ConcurrentZoteroImporter
+# has in flight at once, and number of batches uploaded at once
+MAX_REQUESTS = 16
+MAX_BATCHES = 4
+
+# Characters used in Zotero object keys
+KEY_CHARS = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+
+_random = random.SystemRandom()
+
+# Generate a new Zotero object key. Items are created with keys
+# generated by the client, so that it can later check whether an
+# item was created even if the server's response was lost.
+def new_key():
+    return "".join(_random.choice(KEY_CHARS) for i in xrange(8))
+
 class Extract(object):
     def __init__(self, fn=None, num_values=1):
         self.fn = fn
@@ -95,7 +131,7 @@ class ExtractTimestamp(Extract):
 
 class ExtractBundle(Extract):
     def get_value(self, pub, context):
-        journal = context.papers2.get_bundle(pub)
+        journal = context.source.get_bundle(pub)
         if journal is not None:
             return journal.title
         else:
@@ -103,43 +139,67 @@ class ExtractBundle(Extract):
 
 class ExtractPubdate(Extract):
     def format(self, pub_date):
-        date_str = ''
-        
-        year = pub_date[2:6]
-        if year is not None:
-            date_str = year
-            
-            month = pub_date[6:8]
-            if month is not None:
-                if month == "00":
-                    month = "01"
-                date_str += "-" + month
-                
-                day = pub_date[8:10]
-                if day is not None:
-                    if day == "00":
-                        day = "01"
-                    date_str += "-" + day
-        
-        # TODO: check date for validity
-        
-        return date_str
+        return dates.to_iso(dates.decode(pub_date))
 
-class ExtractCreators(Extract):
-    def __init__(self):
-        Extract.__init__(self, num_values=None)
+# Zotero creator types for Papers2 OrderedAuthor types
+CREATOR_TYPES = {
+    0 : u'author',
+    1 : u'editor'
+}
+
+# Index of pre-formatted Zotero creators for every publication,
+# built from one scan of the Author table and one grouped scan of
+# the OrderedAuthor table. Each (author, creator type) pair is
+# converted to a creator dict only once, and the same dict is
+# shared by every publication that author appears in.
+class CreatorIndex(object):
+    def __init__(self, papers2, pub_ids=None):
+        self.papers2 = papers2
+        self.pub_ids = pub_ids
+        self._pub_creators = None
+        self._unsupported = None
     
-    def get_value(self, pub, context):
-        return context.papers2.get_pub_authors(pub)
+    def _build(self):
+        self._pub_creators = {}
+        self._unsupported = {}
+        self._add(self.papers2.get_authors(), self.pub_ids)
     
-    def format(self, author):
-        if author.type == 0:
-            creator_type = u'author'
-        elif author.type == 1:
-            creator_type = u'editor'
-        else:
-            raise Exception("Unsupported author type {0}".format(author.type))
-        
+    # Add the creators of publications in pub_ids (or all publications)
+    def _add(self, authors, pub_ids):
+        authors = dict((a.id, a) for a in authors)
+        creators = {}
+        pub_creators = self._pub_creators
+        unsupported = self._unsupported
+        for pub_id, author_id, author_type in self.papers2.get_ordered_authors(pub_ids):
+            if author_type not in CREATOR_TYPES:
+                unsupported[pub_id] = author_type
+                continue
+            key = (author_id, author_type)
+            creator = creators.get(key)
+            if creator is None:
+                author = authors.get(author_id)
+                if author is None:
+                    continue
+                creator = creators[key] = self._format(author, CREATOR_TYPES[author_type])
+            pub_creators.setdefault(pub_id, []).append(creator)
+    
+    # Re-read the creators of publications that were added or
+    # modified since the index was built
+    def refresh(self, pub_ids):
+        if self._pub_creators is None:
+            return
+        pub_ids = list(pub_ids)
+        for pub_id in pub_ids:
+            self._pub_creators.pop(pub_id, None)
+            self._unsupported.pop(pub_id, None)
+        Author = self.papers2.get_table("Author")
+        OrderedAuthor = self.papers2.get_table("OrderedAuthor")
+        authors = self.papers2.get_authors().filter(Author.ROWID.in_(
+            self.papers2.get_session().query(OrderedAuthor.author_id).filter(
+                OrderedAuthor.object_id.in_(pub_ids))))
+        self._add(authors, pub_ids)
+    
+    def _format(self, author, creator_type):
         if author.institutional > 0:
             return { 
                 u'creatorType': creator_type,
@@ -151,6 +211,122 @@ class ExtractCreators(Extract):
                 u'firstName': author.prename,
                 u'lastName': author.surname
             }
+    
+    # Returns the list of creator dicts for a publication, in order.
+    def get_creators(self, pub):
+        if self._pub_creators is None:
+            self._build()
+        if pub.ROWID in self._unsupported:
+            raise Exception("Unsupported author type {0}".format(self._unsupported[pub.ROWID]))
+        return self._pub_creators.get(pub.ROWID, ())
+
+# Creator index for publications read from an ExportView, whose
+# records already hold their authors. As in CreatorIndex, each
+# (author, creator type) pair is only converted once.
+class ViewCreatorIndex(CreatorIndex):
+    def __init__(self):
+        CreatorIndex.__init__(self, None)
+        self._creators = {}
+    
+    def get_creators(self, pub):
+        creators = []
+        for author in pub.authors:
+            if author.type not in CREATOR_TYPES:
+                raise Exception("Unsupported author type {0}".format(author.type))
+            key = (author.id, author.type)
+            creator = self._creators.get(key)
+            if creator is None:
+                creator = self._creators[key] = self._format(author, CREATOR_TYPES[author.type])
+            creators.append(creator)
+        return creators
+
+# Tags for each publication, built the same way as CreatorIndex: the
+# keywords of the selected types are read for all publications with a
+# single query, and the tag of each keyword is stored once (by keyword
+# ROWID) and shared by every publication it is assigned to. Labels are
+# converted to tags with a table indexed by label number.
+class TagIndex(object):
+    def __init__(self, papers2, keyword_types, label_map, pub_ids=None):
+        self.papers2 = papers2
+        self.pub_ids = pub_ids
+        # user keywords come before automatic ones
+        self.kw_types = tuple(kw_type for name, kw_type in (
+            ('user', KeywordType.USER), ('auto', KeywordType.AUTO)) if name in keyword_types)
+        self.label_tags = {}
+        if 'label' in keyword_types:
+            self.label_tags = dict((l.num, label_map.get(l.name)) for l in Label.__values__)
+        self._tags = {}
+        self._pub_tags = None
+    
+    def _build(self):
+        self._pub_tags = {}
+        self._add(self.pub_ids)
+    
+    # Add the tags of publications in pub_ids (or all publications)
+    def _add(self, pub_ids):
+        if len(self.kw_types) == 0:
+            return
+        KeywordItem = self.papers2.get_table("KeywordItem")
+        tags = self._tags
+        rows = self.papers2.get_pub_keywords(pub_ids).filter(
+            KeywordItem.type.in_(self.kw_types))
+        for pub_id, rows in groupby(rows, lambda row: row.object_id):
+            by_type = dict((kw_type, []) for kw_type in self.kw_types)
+            for row in rows:
+                tag = tags.get(row.keyword_id)
+                if tag is None:
+                    tag = tags[row.keyword_id] = row.name
+                by_type[row.type].append(tag)
+            self._pub_tags[pub_id] = tuple(tag
+                for kw_type in self.kw_types for tag in by_type[kw_type])
+    
+    # Re-read the tags of publications that were added or modified
+    # since the index was built
+    def refresh(self, pub_ids):
+        if self._pub_tags is None:
+            return
+        pub_ids = list(pub_ids)
+        for pub_id in pub_ids:
+            self._pub_tags.pop(pub_id, None)
+        self._add(pub_ids)
+    
+    def get_label_tag(self, pub):
+        return self.label_tags.get(pub.label)
+    
+    # Returns the tuple of tags for a publication: its keywords, in
+    # order, followed by its label
+    def get_tags(self, pub):
+        if self._pub_tags is None:
+            self._build()
+        tags = self._pub_tags.get(pub.ROWID, ())
+        label = self.get_label_tag(pub)
+        if label is not None:
+            tags += (label,)
+        return tags
+
+# Tag index for publications read from an ExportView, whose records
+# already hold their keywords. Each distinct tag is stored once.
+class ViewTagIndex(TagIndex):
+    def __init__(self, keyword_types, label_map):
+        TagIndex.__init__(self, None, keyword_types, label_map)
+    
+    def get_tags(self, pub):
+        tags = []
+        for kw_type in self.kw_types:
+            for keyword in pub.keywords:
+                if keyword.type == kw_type:
+                    tags.append(self._tags.setdefault(keyword.name, keyword.name))
+        label = self.get_label_tag(pub)
+        if label is not None:
+            tags.append(label)
+        return tuple(tags)
+
+class ExtractCreators(Extract):
+    def __init__(self):
+        Extract.__init__(self, num_values=None)
+    
+    def get_value(self, pub, context):
+        return context.creators.get_creators(pub)
 
 class ExtractIdentifier(Extract):
     def __init__(self, id_sources, num_values=1):
@@ -160,7 +336,7 @@ class ExtractIdentifier(Extract):
     def get_value(self, pub, context):
         idents = []
         for src in self.id_sources:
-            idents.extend(context.papers2.get_identifiers(pub, src))
+            idents.extend(context.source.get_identifiers(pub, src))
         return idents
     
     def format_value(self, value):
@@ -175,7 +351,7 @@ class ExtractPubmedID(ExtractIdentifier):
 
 class ExtractUrl(Extract):
     def get_value(self, pub, context):
-        return context.papers2.get_urls(pub)
+        return context.source.get_urls(pub)
         
     def format(self, value):
         return value.remote_id
@@ -185,27 +361,21 @@ class ExtractKeywords(Extract):
         Extract.__init__(self, num_values=None)
         
     def get_value(self, pub, context):
-        keywords = []
-        if 'user' in context.keyword_types:
-            keywords.extend(k.name for k in context.papers2.get_keywords(pub, KeywordType.USER))
-        if 'auto' in context.keyword_types:
-            keywords.extend(k.name for k in context.papers2.get_keywords(pub, KeywordType.AUTO))
-        if 'label' in context.keyword_types:
-            label = context.label_map.get(context.papers2.get_label_name(pub), None)
-            if label is not None:
-                keywords.append(label)
-        return keywords
+        return context.tags.get_tags(pub)
 
 class ExtractCollections(Extract):
     def __init__(self):
         Extract.__init__(self, num_values=None)
     
+    # Returns the ROWIDs of the collections of a publication that are
+    # exported; each target maps them to its own keys (see
+    # Extraction.get_item)
     def get_value(self, pub, context):
         if len(context.collections) > 0:
             collections = []
-            for c in context.papers2.get_collections(pub):
-                if c.name in context.collections:
-                    collections.append(context.collections[c.name])
+            for c in context.source.get_collections(pub):
+                if c.ROWID in context.collections:
+                    collections.append(c.ROWID)
             return collections
                 
 class AttrExtract(Extract):
@@ -242,181 +412,899 @@ EXTRACTORS = dict(
     volume=                 Extract(lambda pub: pub.volume)
 )
 
+# The context in which publications are converted to Zotero items:
+# the source they are read from, the indexes of their creators and
+# tags, and the ROWIDs of the Papers2 collections that are exported.
+# get_template returns the template of a Zotero item type. Each
+# ZoteroImporter creates its own Extractor unless it is given one;
+# several targets can share one (see papers2.fanout) so that each
+# publication is only extracted once.
+class Extractor(object):
+    def __init__(self, papers2, get_template, keyword_types=('user','label'), label_map={},
+            view=None):
+        self.papers2 = papers2
+        # publications are either Publications read from papers2, or
+        # ViewRecords read from an ExportView
+        self.source = view if view is not None else papers2
+        self.get_template = get_template
+        self.creators = CreatorIndex(papers2) if view is None else ViewCreatorIndex()
+        self.tags = TagIndex(papers2, keyword_types, label_map) if view is None \
+            else ViewTagIndex(keyword_types, label_map)
+        self.collections = set()
+    
+    # Re-read the data cached for publications that were added or
+    # modified since the extractor was created
+    def refresh(self, pub_ids):
+        pub_ids = list(pub_ids)
+        self.creators.refresh(pub_ids)
+        self.tags.refresh(pub_ids)
+    
+    def extract(self, pub):
+        # convert the Papers2 publication type to a Zotero item type
+        item_type = ITEM_TYPES[self.source.get_pub_type(pub)]
+        
+        # get the template to fill in for an item of this type
+        item = self.get_template(item_type)
+        
+        # fill in template fields
+        for key, value in item.iteritems():
+            if key in EXTRACTORS:
+                value = EXTRACTORS[key].extract(pub, self, value)
+                if value is not None:
+                    item[key] = value
+        
+        return Extraction(pub, self.source, item)
+
+# A publication converted by an Extractor. item holds the fields of
+# the Zotero item, with collections as Papers2 ROWIDs. The notes and
+# attachments are only read when they are first needed, since they
+# are only uploaded with new items, unless load is called. An
+# extraction that is shared by several targets must be marked as
+# shared, so that each gets its own copy of the item to modify.
+class Extraction(object):
+    def __init__(self, pub, source, item):
+        self.rowid = pub.ROWID
+        self.title = pub.title
+        self.times_read = pub.times_read
+        self.publication_date = pub.publication_date
+        self.item = item
+        self.shared = False
+        self._pub = pub
+        self._source = source
+        self._notes = None
+        self._attachments = None
+    
+    # Get the item (or, if shared, a copy), with its collections
+    # mapped by collections (a dict of Papers2 collection ROWIDs to
+    # keys)
+    def get_item(self, collections):
+        item = dict(self.item) if self.shared else self.item
+        if len(item.get('collections', ())) > 0:
+            item['collections'] = list(collections[c] for c in item['collections']
+                if c in collections)
+        return item
+    
+    def get_notes(self):
+        if self._notes is None:
+            notes = []
+            if self._pub.notes is not None and len(self._pub.notes) > 0:
+                notes.append(self._pub.notes)
+            for r in self._source.get_reviews(self._pub):
+                notes.append("{0} Rating: {1}".format(r.content, r.rating))
+            self._notes = notes
+        return self._notes
+    
+    # Get the (path, MIME type) of each attachment
+    def get_attachments(self):
+        if self._attachments is None:
+            self._attachments = list(self._source.get_attachments(self._pub))
+        return self._attachments
+    
+    # Read the notes and attachments, and release the publication, so
+    # that the extraction can be used by other threads without
+    # touching the database session
+    def load(self):
+        self.get_notes()
+        self.get_attachments()
+        self._pub = self._source = None
+
 class ZoteroImporter(object):
     def __init__(self, library_id, library_type, api_key, papers2,
             keyword_types=('user','label'), label_map={}, add_to_collections=[], 
-            upload_attachments="all", batch_size=50, checkpoint=None, dryrun=None):
-        self.client = Zotero(library_id, library_type, api_key)
+            upload_attachments="all", batch_size=50, checkpoint=None, dryrun=None,
+            collection_cache=None, library_cache=None, on_match=None, versions=None,
+            sync=False, batch_bytes=None, journal=None, endpoint=None, view=None,
+            attachment_index=None, retry_queue=None, extractor=None, counters=None):
+        self.library_id = library_id
+        self.library_type = library_type
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.client = self._new_client()
         self.papers2 = papers2
-        self.keyword_types = keyword_types
-        self.label_map = label_map
         self.upload_attachments = upload_attachments
+        self.attachment_index = attachment_index
+        # (publication ROWID, path, problem) of attachments that were
+        # not uploaded because their files are missing or empty
+        self.skipped_attachments = []
         self.checkpoint = checkpoint
         self.dryrun = JSONWriter(dryrun) if dryrun is not None else None
-        self._batch = Batch(batch_size)
+        self.journal = journal if self.dryrun is None else None
+        self.retry_queue = retry_queue if self.dryrun is None else None
+        self.collection_cache = collection_cache
+        # items exported, and requests and bytes sent while uploading,
+        # for progress reports
+        self.counters = counters if counters is not None else Counters()
+        self._pool = ThreadPool(FETCH_THREADS)
+        if extractor is None:
+            extractor = Extractor(papers2, lambda item_type: self.client.item_template(item_type),
+                keyword_types, label_map, view)
+        self.extractor = extractor
+        self.versions = versions
+        self.sync = sync
+        self._hashes = {}
+        self._remote_changes = self._get_remote_changes()
+        self.on_match = on_match
+        self.remote_library = None
+        if on_match is not None and self.dryrun is None:
+            self.remote_library = RemoteLibrary(self._new_client, library_cache, FETCH_THREADS,
+                (self.library_type, str(self.library_id)))
+            self.remote_library.sync()
+        self.batch_size = batch_size
+        self._batch = Batch(batch_size, batch_bytes)
         self._load_collections(add_to_collections)
+        self.extractor.collections.update(self.collections)
+        if self.journal is not None:
+            self._resume()
+    
+    # Get the keys of items that were modified in Zotero since the last
+    # write, which must not be overwritten when syncing.
+    def _get_remote_changes(self):
+        if not self.sync or self.versions is None or self.dryrun is not None \
+                or self.versions.library_version == 0:
+            return set()
+        return set(self.client.item_versions(since=self.versions.library_version))
     
-    # Load Zotero collections and create any
-    # Papers2 collections that don't exist.
-    # TODO: need to handle collection hierarchies
+    # Upload a batch of pre-serialized items (a JSON array string).
+    # This is equivalent to client.create_items, except that the items
+    # are not serialized again. Returns the decoded write response, or
+    # None if the write token has already been used (i.e. the same
+    # request was already processed by the server).
+    def _create_items(self, payload, token):
+        import requests
+        self.counters.add(requests=1, bytes=len(payload))
+        headers = {"Zotero-Write-Token": token, "Content-Type": "application/json"}
+        headers.update(self.client.default_headers())
+        req = requests.post(url="{0}/{1}/{2}/items".format(
+                self.client.endpoint, self.client.library_type, self.client.library_id),
+            data=payload, headers=headers)
+        self.client.request = req
+        if req.status_code == 412:
+            return None
+        req.raise_for_status()
+        return req.json()
+    
+    # pyzotero (and requests) are only imported once a client is
+    # needed, so that importing this module is cheap
+    def _new_client(self):
+        from pyzotero.zotero import Zotero
+        client = Zotero(self.library_id, self.library_type, self.api_key)
+        if self.endpoint is not None:
+            client.endpoint = self.endpoint
+        return client
+    
+    # Load Zotero collections and create any Papers2 collections
+    # that don't exist. Collection hierarchies are preserved: each
+    # collection is nested under its closest ancestor that is also
+    # being imported. self.collections maps Papers2 collection ROWIDs
+    # to Zotero collection keys.
     def _load_collections(self, add_to_collections):
         self.collections = {}
-        if add_to_collections is None:
-            add_to_collections = list(c.name for c in self.papers2.get_collections())
-
-        if len(add_to_collections) > 0:
-            if self.dryrun is not None:
-                for c in add_to_collections:
-                    self.collections[c] = "<{0}>".format(c)
-                
-            else:
-                # fetch existing zotero collections
-                existing_collections = {}
-                for zc in self.client.collections():
-                    data = zc['data']
-                    existing_collections[data['name']] = data['key']
-                
-                # add any papers2 collections that do not already exist
-                payload = []
-                for pc in add_to_collections:
-                    if pc not in existing_collections:
-                        payload.append(dict(name=pc))
-                if len(payload) > 0:
-                    self.client.create_collection(payload)
+        if add_to_collections is not None and len(add_to_collections) == 0:
+            return
+        
+        paths = self.papers2.get_collection_paths()
+        if add_to_collections is not None:
+            add_to_collections = set(add_to_collections)
+            paths = dict((rowid, path) for rowid, path in paths.iteritems()
+                if path[-1] in add_to_collections)
+        
+        # drop unselected ancestors from each path
+        selected = set(paths.itervalues())
+        targets = {}
+        for rowid, path in paths.iteritems():
+            targets[rowid] = tuple(name for i, name in enumerate(path) 
+                if path[0:i+1] in selected)
+        
+        if self.dryrun is not None:
+            for rowid, path in targets.iteritems():
+                self.collections[rowid] = "<{0}>".format("/".join(path))
+        
+        else:
+            keys = self._get_collection_keys(set(targets.itervalues()))
+            for rowid, path in targets.iteritems():
+                if path in keys:
+                    self.collections[rowid] = keys[path]
+    
+    # Returns a dict mapping collection paths to Zotero keys,
+    # creating any of the given paths that don't exist. The
+    # mapping is cached locally, along with the version of each
+    # collection, so the remote collections are only fetched if the
+    # cache is missing any of the paths, or if any of their
+    # collections has been deleted, renamed or moved in Zotero since
+    # (which is checked by fetching just the collection versions).
+    def _get_collection_keys(self, paths):
+        keys, versions = self._load_collection_cache()
+        if keys is not None and all(p in keys for p in paths):
+            remote_versions = self.client.collection_versions()
+            if all(remote_versions.get(keys[p]) == versions.get(keys[p]) for p in paths):
+                return keys
+            log.info("Collections have changed in Zotero; fetching them again")
+        
+        keys, versions = self._fetch_collection_keys()
+        created = False
+        
+        # create missing collections in order of depth, so that
+        # parents exist before their children
+        missing = sorted((p for p in paths if p not in keys), key=len)
+        for depth, level in groupby(missing, len):
+            level = list(level)
+            payloads = []
+            for path in level:
+                payload = dict(name=path[-1])
+                if depth > 1:
+                    if path[0:-1] not in keys:
+                        log.error("Cannot create collection {0}; parent does not exist".format(
+                            "/".join(path)))
+                        continue
+                    payload['parentCollection'] = keys[path[0:-1]]
+                payloads.append((path, payload))
             
-                # re-fetch zotero collections in order to get keys
-                for zc in self.client.collections():
-                    data = zc['data']
-                    if data['name'] in add_to_collections:
-                        self.collections[data['name']] = data['key']
+            chunks = list(payloads[i:i+MAX_WRITE_OBJECTS] 
+                for i in xrange(0, len(payloads), MAX_WRITE_OBJECTS))
+            def create(chunk):
+                return self._new_client().create_collections(list(p for path, p in chunk))
+            for chunk, status in zip(chunks, self._pool.map(create, chunks)):
+                for idx, key in status['success'].iteritems():
+                    keys[chunk[int(idx)][0]] = key
+                    created = True
+                for idx, msg in status['failed'].iteritems():
+                    log.error("Failed to create collection {0}; code {1}; {2}".format(
+                        "/".join(chunk[int(idx)][0]), msg['code'], msg['message']))
+        
+        if self.collection_cache is not None:
+            if created:
+                versions = self.client.collection_versions()
+            dump_atomic(dict(library=(self.library_type, str(self.library_id)), keys=keys,
+                versions=versions), self.collection_cache)
+        
+        return keys
     
-    def add_pub(self, pub):
-        # ignore publications we've already imported
-        if self.checkpoint is not None and self.checkpoint.contains(pub.ROWID):
+    # Returns the (path -> key, key -> version) dicts of the collection
+    # cache, or (None, None) if there is no cache, or it was written
+    # for another library (or by an older version, without versions)
+    def _load_collection_cache(self):
+        if self.collection_cache is None or not os.path.exists(self.collection_cache):
+            return None, None
+        with open(self.collection_cache, "rb") as i:
+            cache = pickle.load(i)
+        if not isinstance(cache, dict) or \
+                cache.get('library') != (self.library_type, str(self.library_id)):
+            log.info("Ignoring collection cache {0}, which is not for {1} library {2}".format(
+                self.collection_cache, self.library_type, self.library_id))
+            return None, None
+        return cache['keys'], cache['versions']
+    
+    # Fetch all Zotero collections, requesting all pages after
+    # the first concurrently, and return dicts mapping collection
+    # paths to keys, and keys to versions.
+    def _fetch_collection_keys(self):
+        collections = list(self.client.collections(limit=COLLECTION_PAGE_SIZE))
+        total = int(self.client.request.headers.get('Total-Results', len(collections)))
+        starts = xrange(COLLECTION_PAGE_SIZE, total, COLLECTION_PAGE_SIZE)
+        def fetch(start):
+            return self._new_client().collections(start=start, limit=COLLECTION_PAGE_SIZE)
+        for page in self._pool.map(fetch, starts):
+            collections.extend(page)
+        
+        parents = dict((zc['data']['key'], zc['data']) for zc in collections)
+        paths = {}
+        def get_path(key):
+            if key not in paths:
+                paths[key] = ()
+                data = parents[key]
+                parent = data.get('parentCollection')
+                if parent in parents:
+                    paths[key] = get_path(parent) + (data['name'],)
+                else:
+                    paths[key] = (data['name'],)
+            return paths[key]
+        
+        versions = dict((zc['data']['key'], zc['data'].get('version', zc.get('version')))
+            for zc in collections)
+        return dict((get_path(key), key) for key in parents), versions
+    
+    # Returns the versions state of a publication that was already
+    # imported, if it is to be synced; otherwise None
+    def _get_state(self, db_id):
+        if self.sync and self.versions is not None:
+            return self.versions.get(db_id)
+    
+    # Returns False if a publication does not need to be exported,
+    # i.e. it was already imported (and is not to be synced)
+    def wants(self, pub):
+        # ignore publications we've already imported; when syncing,
+        # they are re-extracted and compared to the last payload sent
+        if self._get_state(pub.ROWID) is None and self.checkpoint is not None \
+                and self.checkpoint.contains(pub.ROWID):
             log.debug("Skipping already imported publication {0}".format(pub.ROWID))
             return False
+        return True
+    
+    def add_pub(self, pub):
+        if not self.wants(pub):
+            return False
+        return self.add_extraction(self.extractor.extract(pub))
+    
+    # Add a publication extracted by self.extractor (or an Extractor
+    # shared with other targets) to the batch. Returns True if it was
+    # added.
+    def add_extraction(self, extraction):
+        db_id = extraction.rowid
+        state = self._get_state(db_id)
+        item = extraction.get_item(self.collections)
+        hashes = hash_fields(item)
         
-        # convert the Papers2 publication type to a Zotero item type
-        item_type = ITEM_TYPES[self.papers2.get_pub_type(pub)]
-        
-        # get the template to fill in for an item of this type
-        item = self.client.item_template(item_type)
-
-        # fill in template fields
-        for key, value in item.iteritems():
-            if key in EXTRACTORS:
-                value = EXTRACTORS[key].extract(pub, self, value)
-                if value is not None:
-                    item[key] = value
+        if state is not None:
+            if state.key in self._remote_changes:
+                log.warning(u"Not updating Zotero item {0} from publication {1}; "\
+                    "it has been modified in Zotero since the last export".format(state.key, db_id))
+                return False
+            
+            # send only the fields that changed, using the item
+            # version as a precondition
+            changed = list(k for k, h in hashes.iteritems() if state.hashes.get(k) != h)
+            if len(changed) == 0:
+                log.debug("Skipping unchanged publication {0}".format(db_id))
+                return False
+            item = dict((k, item[k]) for k in changed)
+            item['key'] = state.key
+            item['version'] = state.version
+            self._add_to_batch(db_id, item, [], [], hashes)
+            return True
 
-        # add notes, if any
+        # check whether the item already exists in the Zotero library
+        existing = None
+        if self.remote_library is not None:
+            existing = self.remote_library.match(item)
+        
         notes = []
-        if pub.notes is not None and len(pub.notes) > 0:
-            notes.append(pub.notes)
+        attachments = []
+        if existing is not None:
+            if self.on_match == "skip":
+                log.info(u"Skipping publication {0}; already exists as Zotero item {1}".format(
+                    db_id, existing.key))
+                if self.checkpoint is not None:
+                    self.checkpoint.add(db_id)
+                return False
+            
+            # posting an item with a key and version updates it;
+            # the existing item's notes and attachments are kept
+            log.debug(u"Updating Zotero item {0} from publication {1}".format(
+                existing.key, db_id))
+            item['key'] = existing.key
+            item['version'] = existing.version
         
-        reviews = self.papers2.get_reviews(pub)
-        for r in reviews:
-            notes.append("{0} Rating: {1}".format(r.content, r.rating))
+        else:
+            # with a journal or retry queue, an upload whose response
+            # was lost is checked for (or resent without duplicating)
+            # items by their keys
+            if self.journal is not None or self.retry_queue is not None:
+                item['key'] = new_key()
+            
+            # add notes and reviews, if any
+            notes = list(extraction.get_notes())
+            
+            # get paths to attachments
+            if self.upload_attachments == "all" or (
+                    self.upload_attachments == "unread" and extraction.times_read == 0):
+                attachments = self._check_attachments(db_id, extraction.get_attachments())
         
-        # get paths to attachments
-        attachments = []
-        if self.upload_attachments == "all" or (
-                self.upload_attachments == "unread" and pub.times_read == 0):
-            attachments = list(self.papers2.get_attachments(pub))
+        self._add_to_batch(db_id, item, notes, attachments, hashes)
+        return True
+    
+    # Drop the attachments that the attachment index found to be
+    # missing or empty
+    def _check_attachments(self, db_id, attachments):
+        if self.attachment_index is None:
+            return list(attachments)
+        checked = []
+        for path, mime_type in attachments:
+            if self.attachment_index.is_uploadable(path):
+                checked.append((path, mime_type))
+            else:
+                problem = self.attachment_index.get(path).problem
+                log.warning(u"Not uploading {0} attachment {1} of publication {2}".format(
+                    problem, path, db_id))
+                self.skipped_attachments.append((db_id, path, problem))
+        return checked
+    
+    def _add_to_batch(self, db_id, item, notes, attachments, hashes):
+        # serialize the item once; commit the current batch first if
+        # the item would make the request too large
+        payload = Batch.serialize(item)
+        if not self._batch.fits(payload):
+            self._commit_batch(force=True)
         
-        # add to batch and checkpoint
-        self._batch.add(item, notes, attachments)
-        if self.checkpoint is not None:
-            self.checkpoint.add(pub.ROWID)
+        # add to batch; publications are added to the checkpoint
+        # once they have been uploaded
+        self._batch.add(payload, notes, attachments, db_id)
+        self._hashes[db_id] = hashes
         
         # commit the batch if it's full
         self._commit_batch()
-        
-        return True
     
     def close(self):
         if self._batch is not None:
             self._commit_batch(force=True)
             self._batch = None
+        self._retry(wait=True)
+        self._report_failures()
+        if self.checkpoint is not None:
+            # publications skipped since the last batch
+            self.checkpoint.commit()
         if self.dryrun is not None:
             self.dryrun.close()
+        if self.journal is not None:
+            self.journal.close()
+        if len(self.skipped_attachments) > 0:
+            log.warning("{0} attachments were not uploaded because their files are missing "\
+                "or empty".format(len(self.skipped_attachments)))
+        self._pool.close()
+    
+    # Number of items waiting at each stage of the export (in the
+    # current batch and the retry queue; for ConcurrentZoteroImporter,
+    # the number of batches being uploaded), for progress reports. May
+    # be called from any thread.
+    def get_queue_depths(self):
+        batch = self._batch
+        depths = OrderedDict()
+        depths['batch'] = batch.size if batch is not None else 0
+        if self.retry_queue is not None:
+            depths['retry'] = len(self.retry_queue)
+        return depths
+    
+    # Seconds since the first item of the current batch was added, or
+    # None if the batch is empty
+    @property
+    def batch_age(self):
+        if self._batch is None or self._batch.started is None:
+            return None
+        return time.time() - self._batch.started
+    
+    # Upload the current batch before it is full, if it is at least
+    # max_age seconds old (or, if max_age is None, whatever its age).
+    # Returns True if the batch was committed.
+    def flush(self, max_age=None):
+        age = self.batch_age
+        if age is None or (max_age is not None and age < max_age):
+            return False
+        self._commit_batch(force=True)
+        return True
+    
+    # Re-read the data cached for publications that were added or
+    # modified since the importer was created
+    def refresh(self, pub_ids):
+        self.extractor.refresh(pub_ids)
+    
+    # Finish uploading the batches left in the journal by a previous run
+    def _resume(self):
+        for entry in list(self.journal.pending.itervalues()):
+            log.info("Resuming upload of {0} items interrupted by a previous run".format(
+                len(entry.items)))
+            self._upload_batch(self._get_entry_batch(entry), entry)
+    
+    # Rebuild the batch of a journal entry
+    def _get_entry_batch(self, entry):
+        batch = Batch(len(entry.items))
+        for item in entry.items:
+            batch.add(item['payload'], item['notes'],
+                list(tuple(a) for a in item['attachments']), item['id'])
+        return batch
+    
+    # Retry the failed uploads that are due. If wait is True, keep
+    # retrying (waiting for each to be due) until every upload has
+    # succeeded or been given up on.
+    def _retry(self, wait=False):
+        if self.retry_queue is None:
+            return
+        while True:
+            creates = []
+            for key, retry in self.retry_queue.get_due():
+                log.info("Retrying {0} upload of {1} (attempt {2})".format(
+                    retry.stage, key, retry.attempts + 1))
+                if retry.stage == RETRY_BATCH:
+                    self._upload_batch(self._get_entry_batch(retry.data), retry.data)
+                elif retry.stage == RETRY_CHILDREN:
+                    self._retry_children(key, retry)
+                else:
+                    creates.append(self.retry_queue.take(key).data)
+            
+            # items that failed are uploaded again in new batches
+            for i in xrange(0, len(creates), self.batch_size):
+                entry = JournalEntry(creates[i:i+self.batch_size])
+                if self.journal is not None:
+                    self.journal.begin(entry)
+                self._upload_batch(self._get_entry_batch(entry), entry)
+            self.retry_queue.commit()
+            
+            next_attempt = self.retry_queue.get_next_attempt()
+            if not wait or next_attempt is None:
+                return
+            time.sleep(max(next_attempt - time.time(), 0))
+    
+    # Retry uploading the notes and attachments of a created item
+    def _retry_children(self, db_id, retry):
+        item = dict(retry.data)
+        try:
+            if len(item['notes']) > 0:
+                self._create_notes(BatchRecord(item['payload'], item['notes'], None, db_id),
+                    retry.item_key, item['note_token'])
+                item['notes'] = []
+            if len(item['attachments']) > 0:
+                self._upload_files(list(path for path, mime in item['attachments']),
+                    retry.item_key)
+            self.retry_queue.succeed(db_id, RETRY_CHILDREN)
+        except Exception as e:
+            self._retry_later(db_id, RETRY_CHILDREN, item, e, retry.item_key)
+    
+    # Add a failed upload to the retry queue
+    def _retry_later(self, key, stage, data, error, item_key=None):
+        retry = self.retry_queue.fail(key, stage, data, u"{0}".format(error), item_key)
+        if self.retry_queue.is_dead(retry):
+            log.error(u"Giving up on {0} upload of {1} after {2} attempts: {3}".format(
+                stage, key, retry.attempts, retry.error))
+        else:
+            log.warning(u"Will retry {0} upload of {1} in {2:.0f} seconds: {3}".format(
+                stage, key, retry.next_attempt - time.time(), retry.error))
+    
+    # Log the uploads that were given up on
+    def _report_failures(self):
+        if self.retry_queue is None:
+            return
+        failures = sorted(self.retry_queue.get_dead())
+        if len(failures) == 0:
+            return
+        log.error("{0} uploads failed after {1} attempts:".format(
+            len(failures), self.retry_queue.max_attempts))
+        for key, retry in failures:
+            if retry.stage == RETRY_BATCH:
+                what = "batch of {0} items (publications {1})".format(len(retry.data.items),
+                    ",".join(str(item['id']) for item in retry.data.items))
+            elif retry.stage == RETRY_CHILDREN:
+                what = "notes and attachments of publication {0} (item {1})".format(
+                    key, retry.item_key)
+            else:
+                what = "publication {0}".format(key)
+            log.error(u"  {0}: {1}".format(what, retry.error))
+        if self.retry_queue.filename is not None:
+            log.error("Notes and attachments that failed will be retried on the next run; "\
+                "publications that failed will be exported again.")
             
     def _commit_batch(self, force=False):
         if self._batch.is_full or (force and not self._batch.is_empty):
             try:
                 if self.dryrun is not None:
-                    for item, attachments in self._batch.iter():
-                        self.dryrun.write(item, attachments)
-                
+                    for record in self._batch:
+                        self.dryrun.write(record.item, self._batch.get_attachments(record))
+                    self.counters.add(exported=self._batch.size)
                 else:
-                    # upload metadata
-                    status = self.client.create_items(self._batch.items)
-                    
-                    if len(status['failed']) > 0:
-                        for status_idx, status_msg in status['failed'].iteritems():
-                            item_idx = int(status_idx)
-                            # remove failures from the checkpoint
-                            if self.checkpoint is not None:
-                                self.checkpoint.remove(item_idx)
-                            item = self._batch.items[item_idx]
-                            log.error("Upload failed for item {0}; code {1}; {2}".format(
-                               item['title'], status_msg['code'], status_msg['message']))
-                
-                    successes = {}
-                    successes.update(status['success'])
-                    successes.update(status['unchanged'])
-                    
-                    for k, objKey in successes.iteritems():
-                        item_idx = int(k)
-                        
-                        # add notes
-                        notes = self._batch.notes[item_idx]
-                        if len(notes) > 0:
-                            note_batch = []
-                            for note_text in notes:
-                                note = self.client.item_template('note')
-                                note['parentItem'] = objKey
-                                note['note'] = note_text
-                                note_batch.append(note)
-                            
-                            note_status = self.client.create_items(note_batch)
-                            
-                            if len(note_status['failed']) > 0:
-                                for status_idx, status_msg in note_status['failed'].iteritems():
-                                    note_idx = int(status_idx)
-                                    # just warn about these failures
-                                    note = note_batch[note_idx]
-                                    log.error("Failed to create note {0} for item item {1}; code {2}; {3}".format(
-                                       note['note'], self.batch.items[idx]['title'], 
-                                       status_msg['code'], status_msg['message']))
-                    
-                        # upload attachments and add items to collections
-                        if self.upload_attachments != "none":
-                        
-                            # TODO: modify pyzotero to pass MIME type for contentType key
-                            attachments = list(path for path, mime in self._batch.attachments[item_idx])
-                            if len(attachments) > 0:
-                                try:
-                                    self.client.attachment_simple(attachments, objKey)
-
-                                # This is to work around a bug in pyzotero where an exception is
-                                # thrown if an attachment already exists
-                                except KeyError:
-                                    log.info("One or more attachment already exists: {0}".format(",".join(attachments)))
-                
-                    # update checkpoint
-                    if self.checkpoint is not None:
-                        self.checkpoint.commit()
-                
-                    log.info("Batch committed: {0} items created and {1} items unchanged out of {2} attempted".format(
-                        len(status['success']), len(status['unchanged']), self._batch.size
-                    ))
+                    self._upload_batch(self._batch, self._begin_batch(self._batch))
+            finally:
+                self._batch.clear()
+                self._hashes.clear()
+            self._retry()
+    
+    # Create the journal entry for a batch, and record it in the
+    # journal before anything is sent.
+    def _begin_batch(self, batch):
+        entry = JournalEntry(list(dict(
+                id=record.db_id,
+                payload=record.payload,
+                notes=record.notes,
+                attachments=batch.get_attachments(record),
+                hashes=self._hashes.get(record.db_id),
+                note_token=new_write_token())
+            for record in batch))
+        if self.journal is not None:
+            self.journal.begin(entry)
+        return entry
+
+    # Upload a batch: create the items, then the notes and attachments
+    # of each item. If there is a journal, each step is recorded as it
+    # completes, and steps that were completed by an earlier attempt
+    # (recorded in entry) are skipped.
+    def _upload_batch(self, batch, entry):
+        try:
+            # upload metadata
+            if entry.status is None:
+                status = self._create_items(batch.get_payload(), entry.token)
+                if status is None:
+                    log.info("Batch was already uploaded; checking which items were created")
+                    status = self._get_created_items(batch)
+                entry.status = status
+                entry.library_version = int(self.client.request.headers.get('last-modified-version', 0))
+                if self.journal is not None:
+                    self.journal.created(entry)
+            status = entry.status
             
-            except:
-                log.error("Error importing {0} items to Zotero".format(self._batch.size))
-                if self.checkpoint is not None:
-                    self.checkpoint.rollback()
+            for status_idx, status_msg in status['failed'].iteritems():
+                record = batch[int(status_idx)]
+                log.error(u"Upload failed for item {0}; code {1}; {2}".format(
+                   record.item.get('title'), status_msg['code'], status_msg['message']))
+                if self.retry_queue is not None:
+                    self._retry_later(record.db_id, RETRY_CREATE, entry.items[int(status_idx)],
+                        u"code {0}; {1}".format(status_msg['code'], status_msg['message']))
+        
+            successes = {}
+            successes.update(status['success'])
+            successes.update(status['unchanged'])
+            successes = list((int(k), key) for k, key in successes.iteritems())
+            
+            # add notes and attachments
+            self._map(lambda success: self._upload_children(batch, entry, *success),
+                self._by_attachment_size(batch, successes))
+            
+            # update checkpoint
+            self._finish_batch(batch, entry, successes)
+        
+        except BaseException as e:
+            log.error("Error importing {0} items to Zotero".format(batch.size))
+            # the whole batch is retried later; it is resent with the
+            # same write token and item keys, and items that were
+            # created are found by their keys (see _get_created_items),
+            # so they are not duplicated
+            if self.retry_queue is None or not isinstance(e, Exception):
+                raise
+            self._retry_later(entry.token, RETRY_BATCH, entry, e)
+            return
+        
+        log.info("Batch committed: {0} items created and {1} items unchanged out of {2} attempted".format(
+            len(status['success']), len(status['unchanged']), batch.size
+        ))
+    
+    # Order (batch index, item key) tuples by the total size of the
+    # item's attachments, largest first, so that the longest uploads
+    # start first when they are made concurrently
+    def _by_attachment_size(self, batch, successes):
+        if self.attachment_index is None:
+            return successes
+        get_size = self.attachment_index.get_size
+        return sorted(successes, reverse=True, key=lambda success: sum(
+            get_size(path) for path, mime in batch.get_attachments(batch[success[0]])))
+    
+    # Call fn for each of the values; subclasses may do this concurrently
+    def _map(self, fn, values):
+        return map(fn, values)
+    
+    # Upload the notes and attachments of an item that was created
+    # If they fail, and there is a retry queue, the item is still
+    # recorded as uploaded, and its notes and attachments are retried.
+    def _upload_children(self, batch, entry, item_idx, key):
+        record = batch[item_idx]
+        try:
+            if len(record.notes) > 0 and item_idx not in entry.notes_done:
+                self._create_notes(record, key, entry.items[item_idx]['note_token'])
+                if self.journal is not None:
+                    self.journal.notes_done(entry, item_idx)
+            
+            if self.upload_attachments != "none" and item_idx not in entry.attachments_done:
+                attachments = list(path for path, mime in batch.get_attachments(record))
+                if len(attachments) > 0:
+                    self._upload_files(attachments, key)
+                    if self.journal is not None:
+                        self.journal.attachments_done(entry, item_idx)
+        
+        except Exception as e:
+            if self.retry_queue is None:
                 raise
+            log.error(u"Error uploading notes or attachments of item {0}".format(key), exc_info=e)
+            item = dict(entry.items[item_idx])
+            item['notes'] = [] if item_idx in entry.notes_done else list(record.notes)
+            item['attachments'] = [] if item_idx in entry.attachments_done or \
+                self.upload_attachments == "none" else batch.get_attachments(record)
+            self._retry_later(record.db_id, RETRY_CHILDREN, item, e, key)
+    
+    # Upload the attachment files that exist; pyzotero refuses to
+    # upload any of them if one does not exist
+    def _upload_files(self, attachments, key):
+        missing = list(path for path in attachments if not os.path.isfile(path))
+        if len(missing) > 0:
+            log.error(u"Not uploading missing attachments of item {0}: {1}".format(
+                key, ",".join(missing)))
+            attachments = list(path for path in attachments if path not in missing)
+        if len(attachments) > 0:
+            self._upload_attachments(attachments, key)
+    
+    def _upload_attachments(self, attachments, key):
+        # TODO: modify pyzotero to pass MIME type for contentType key
+        try:
+            self.client.attachment_simple(attachments, key)
+        
+        # This is to work around a bug in pyzotero where an exception is
+        # thrown if an attachment already exists
+        except KeyError:
+            log.info("One or more attachment already exists: {0}".format(",".join(attachments)))
+        # counted as one request per file, though pyzotero makes several
+        self.counters.add(requests=len(attachments),
+            bytes=sum(os.path.getsize(path) for path in attachments))
+    
+    # Record the uploaded items in the checkpoint and item versions.
+    # successes is a list of (batch index, item key) tuples.
+    def _finish_batch(self, batch, entry, successes):
+        status = entry.status
+        for item_idx, key in successes:
+            record = batch[item_idx]
+            if self.checkpoint is not None:
+                self.checkpoint.add(record.db_id)
             
-            finally:
-                self._batch.clear()
+            # record the new item version; unchanged items
+            # keep their previous version
+            if self.versions is not None:
+                version = entry.library_version
+                if str(item_idx) in status['unchanged']:
+                    version = record.item.get('version', entry.library_version)
+                self.versions.set(record.db_id, key, version, entry.items[item_idx]['hashes'])
+        
+        self.counters.add(exported=len(successes))
+        if self.checkpoint is not None:
+            self.checkpoint.commit()
+        if self.versions is not None:
+            self.versions.commit(entry.library_version)
+        if self.retry_queue is not None:
+            for item_idx, key in successes:
+                self.retry_queue.succeed(batch[item_idx].db_id, RETRY_CREATE)
+            self.retry_queue.succeed(entry.token, RETRY_BATCH)
+            self.retry_queue.commit()
+        if self.journal is not None:
+            self.journal.complete(entry)
+    
+    def _create_notes(self, record, key, token):
+        note_batch = []
+        for note_text in record.notes:
+            note = self.client.item_template('note')
+            note['parentItem'] = key
+            note['note'] = note_text
+            note_batch.append(note)
+        
+        note_status = self._create_items(json.dumps(note_batch), token)
+        if note_status is None:
+            log.debug("Notes for item {0} were already created".format(key))
+            return
+        
+        if len(note_status['failed']) > 0:
+            for status_idx, status_msg in note_status['failed'].iteritems():
+                note_idx = int(status_idx)
+                # just warn about these failures
+                note = note_batch[note_idx]
+                log.error(u"Failed to create note {0} for item {1}; code {2}; {3}".format(
+                   note['note'], record.item.get('title'), 
+                   status_msg['code'], status_msg['message']))
+    
+    # Reconstruct the server's response to an item upload whose
+    # response was lost, by checking which of the items exist (new
+    # items) or have a newer version (updated items) in Zotero.
+    def _get_created_items(self, batch):
+        items = list(record.item for record in batch)
+        keys = list(item['key'] for item in items if 'key' in item)
+        versions = {}
+        if len(keys) > 0:
+            self.counters.add(requests=1)
+            versions = self.client.items(itemKey=",".join(keys), format='versions',
+                limit=MAX_WRITE_OBJECTS)
+        status = dict(success={}, unchanged={}, failed={})
+        for idx, item in enumerate(items):
+            version = versions.get(item.get('key'))
+            if version is not None and version > item.get('version', 0):
+                status['success'][str(idx)] = item['key']
+            else:
+                status['failed'][str(idx)] = dict(code=412,
+                    message="Item was not created by the interrupted upload")
+        return status
+
+# Importer that uploads batches in the background while publications
+# are extracted, and creates the notes and attachments of each batch
+# concurrently. Up to max_batches batches are uploaded at once; when
+# that many are in flight, add_pub blocks until one completes. All
+# requests share a limit of max_requests in flight at once and, if
+# requests_per_second is set, a rate limit. Publications are still
+# extracted on the calling thread, since the database session is not
+# thread-safe. Each thread uses its own Zotero client.
+class ConcurrentZoteroImporter(ZoteroImporter):
+    def __init__(self, *args, **kwargs):
+        self.max_requests = kwargs.pop('max_requests', MAX_REQUESTS)
+        self.max_batches = kwargs.pop('max_batches', MAX_BATCHES)
+        self._local = threading.local()
+        self._requests = threading.BoundedSemaphore(self.max_requests)
+        self._rate_limiter = RateLimiter(kwargs.pop('requests_per_second', None))
+        self._batches = threading.BoundedSemaphore(self.max_batches)
+        self._batch_pool = ThreadPool(self.max_batches)
+        # write tokens of the batches being uploaded
+        self._uploading = set()
+        self._request_pool = ThreadPool(self.max_requests)
+        self._errors = []
+        super(ConcurrentZoteroImporter, self).__init__(*args, **kwargs)
+    
+    # The Zotero client of the current thread
+    @property
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._new_client()
+        return client
+    
+    @client.setter
+    def client(self, client):
+        self._local.client = client
+    
+    # Wait for a request slot and the rate limit, then call fn
+    def _throttle(self, fn, *args):
+        with self._requests:
+            self._rate_limiter.wait()
+            return fn(*args)
+    
+    def _create_items(self, payload, token):
+        return self._throttle(super(ConcurrentZoteroImporter, self)._create_items, payload, token)
+    
+    def _upload_attachments(self, attachments, key):
+        return self._throttle(super(ConcurrentZoteroImporter, self)._upload_attachments, attachments, key)
+    
+    def _get_created_items(self, batch):
+        return self._throttle(super(ConcurrentZoteroImporter, self)._get_created_items, batch)
+    
+    def _map(self, fn, values):
+        # one value per task, so values are started in order
+        return self._request_pool.map(fn, values, chunksize=1)
+    
+    # Hand the batch off to a background thread and start a new one
+    def _commit_batch(self, force=False):
+        if self.dryrun is not None:
+            return super(ConcurrentZoteroImporter, self)._commit_batch(force)
+        if self._batch.is_full or (force and not self._batch.is_empty):
+            batch = self._batch
+            entry = self._begin_batch(batch)
+            self._batch = Batch(batch.max_size, batch.max_bytes)
+            self._hashes = {}
+            self._batches.acquire()
+            self._uploading.add(entry.token)
+            self._batch_pool.apply_async(self._upload_batch_async, (batch, entry))
+            self._retry()
+    
+    def _upload_batch_async(self, batch, entry):
+        try:
+            self._upload_batch(batch, entry)
+        except Exception as e:
+            # the batch remains in the journal, if any, and
+            # is resumed on the next run
+            log.error("Error uploading batch", exc_info=e)
+            self._errors.append(e)
+        finally:
+            self._uploading.discard(entry.token)
+            self._batches.release()
+    
+    def get_queue_depths(self):
+        depths = super(ConcurrentZoteroImporter, self).get_queue_depths()
+        depths['uploading'] = len(self._uploading)
+        return depths
+    
+    # Upload the remaining batch and wait for all uploads to finish
+    def close(self):
+        if self._batch is not None:
+            self._commit_batch(force=True)
+            self._batch = None
+        self._batch_pool.close()
+        self._batch_pool.join()
+        self._retry(wait=True)
+        self._request_pool.close()
+        super(ConcurrentZoteroImporter, self).close()
+        if len(self._errors) > 0:
+            log.error("{0} batches failed to upload".format(len(self._errors)))